@@ -1,12 +1,40 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, g, Response
 import sqlite3
 import os
+import json
+import threading
+import time
+import click
 from flask_cors import CORS
 from datetime import datetime
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+import metrics
+import profiling
+import history_archive
+import maintenance
+import change_feed
+import partial_update
+import idempotency
+import cache
+import sla
+import eta
+import autocomplete
+import search
+import current_state
+import gps
+import spatial
+import sqlite_writer
+import replicas
+import conditional
+import repositories
+import invoices
 
 app = Flask(__name__, static_folder="../dist", static_url_path="/")
+metrics.init_app(app)
+profiling.init_app(app)
+maintenance.init_app(app)
 # SOLUTION COMPLÈTE CORS - TOUTES LES SOLUTIONS STACK OVERFLOW APPLIQUÉES
 from flask_cors import CORS
 # Configuration CORS complète - Solution Stack Overflow #1
@@ -14,32 +42,36 @@ CORS(app, resources={
     r"/*": {
         "origins": ["*"],  # Allow all origins explicitly
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"],
-        "allow_headers": ["Content-Type", "Authorization", "X-Requested-With", "Accept", "Origin", "Access-Control-Request-Method", "Access-Control-Request-Headers", "X-Admin-Request"],
+        "allow_headers": ["Content-Type", "Authorization", "X-Requested-With", "Accept", "Origin", "Access-Control-Request-Method", "Access-Control-Request-Headers", "X-Admin-Request", "If-Match", "Idempotency-Key", "X-Recent-Write"],
         "supports_credentials": False,  # Important pour éviter les conflits
-        "expose_headers": ["Content-Type", "Authorization"],
+        "expose_headers": ["Content-Type", "Authorization", "ETag", "Idempotent-Replayed", "X-Recent-Write"],
         "max_age": 86400
     }
 })
 
 # Solution Stack Overflow #2 - Headers manuels complets - VERSION ULTRA PERMISSIVE
-@app.after_request
-def add_cors_headers(response):
-    # Allow all origins dynamically
-    origin = request.headers.get('Origin', '*')
-    response.headers['Access-Control-Allow-Origin'] = origin if origin != 'null' else '*'
-
-    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS, PATCH'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With, Accept, Origin, Access-Control-Request-Method, Access-Control-Request-Headers, X-Admin-Request'
-    response.headers['Access-Control-Allow-Credentials'] = 'true'
-    response.headers['Access-Control-Max-Age'] = '86400'
-    response.headers['Access-Control-Expose-Headers'] = 'Content-Type, Authorization'
-
+# Also sent by the async routes of asgi.py
+CORS_RESPONSE_HEADERS = {
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS, PATCH',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Requested-With, Accept, Origin, Access-Control-Request-Method, Access-Control-Request-Headers, X-Admin-Request, If-Match, Idempotency-Key, X-Recent-Write',
+    'Access-Control-Allow-Credentials': 'true',
+    'Access-Control-Max-Age': '86400',
+    'Access-Control-Expose-Headers': 'Content-Type, Authorization, ETag, Idempotent-Replayed, X-Recent-Write',
     # Additional headers for maximum browser compatibility
-    response.headers['Access-Control-Allow-Private-Network'] = 'true'
-    response.headers['Cross-Origin-Embedder-Policy'] = 'unsafe-none'
-    response.headers['Cross-Origin-Opener-Policy'] = 'unsafe-none'
-    response.headers['Cross-Origin-Resource-Policy'] = 'cross-origin'
+    'Access-Control-Allow-Private-Network': 'true',
+    'Cross-Origin-Embedder-Policy': 'unsafe-none',
+    'Cross-Origin-Opener-Policy': 'unsafe-none',
+    'Cross-Origin-Resource-Policy': 'cross-origin',
+}
 
+def allowed_origin(origin):
+    # Allow all origins dynamically
+    return origin if origin != 'null' else '*'
+
+@app.after_request
+def add_cors_headers(response):
+    response.headers['Access-Control-Allow-Origin'] = allowed_origin(request.headers.get('Origin', '*'))
+    response.headers.update(CORS_RESPONSE_HEADERS)
     return response
 
 # Solution Stack Overflow #3 - Gestion OPTIONS explicite - VERSION ULTRA PERMISSIVE
@@ -49,7 +81,7 @@ def handle_options(path):
     origin = request.headers.get('Origin', '*')
     response.headers['Access-Control-Allow-Origin'] = origin if origin != 'null' else '*'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS, PATCH'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With, Accept, Origin, Access-Control-Request-Method, Access-Control-Request-Headers, X-Admin-Request'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With, Accept, Origin, Access-Control-Request-Method, Access-Control-Request-Headers, X-Admin-Request, If-Match, Idempotency-Key, X-Recent-Write'
     response.headers['Access-Control-Max-Age'] = '86400'
     response.headers['Access-Control-Allow-Private-Network'] = 'true'
     response.headers['Access-Control-Allow-Credentials'] = 'true'
@@ -63,7 +95,7 @@ def handle_preflight_request():
         origin = request.headers.get('Origin', '*')
         response.headers['Access-Control-Allow-Origin'] = origin if origin != 'null' else '*'
         response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS, PATCH'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With, Accept, Origin, Access-Control-Request-Method, Access-Control-Request-Headers, X-Admin-Request'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With, Accept, Origin, Access-Control-Request-Method, Access-Control-Request-Headers, X-Admin-Request, If-Match, Idempotency-Key, X-Recent-Write'
         response.headers['Access-Control-Max-Age'] = '86400'
         response.headers['Access-Control-Allow-Private-Network'] = 'true'
         response.headers['Access-Control-Allow-Credentials'] = 'true'
@@ -81,266 +113,643 @@ else:
     DATABASE = os.environ.get('DATABASE_PATH', 'database.db')
     print(f"Using SQLite: {DATABASE}")
 
+# Route statements are written once and built for the dialect here, see repositories.py
+repositories.configure(USE_POSTGRESQL)
+
+# Connection pool settings - one pool per worker process (see gunicorn.conf.py)
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 8))
+db_pool = None
+
+class PooledConnection(psycopg2.extensions.connection):
+    # commit() leaves the transaction open while `deferred` is set: idempotency.py then
+    # commits the handler's writes together with the response it stores
+    deferred = False
+
+    def commit(self):
+        if not self.deferred:
+            super().commit()
+
+def init_pool():
+    # Must be called after fork: psycopg2 connections cannot be shared between processes
+    global db_pool
+    if USE_POSTGRESQL and db_pool is None:
+        db_pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, connection_factory=PooledConnection,
+                                         cursor_factory=metrics.InstrumentedCursor)
+        print(f"PostgreSQL pool ready (pid {os.getpid()}, max {DB_POOL_MAX} connections)")
+        replicas.start()
+    return db_pool
+
+def close_pool():
+    global db_pool
+    if db_pool is not None:
+        db_pool.closeall()
+        db_pool = None
+        print(f"PostgreSQL pool closed (pid {os.getpid()})")
+    replicas.stop()
+
 def get_db():
+    # One connection per request/app context, returned to the pool on teardown
+    if 'db' not in g:
+        if USE_POSTGRESQL:
+            # PostgreSQL connection
+            started = time.perf_counter()
+            pool = init_pool()
+            borrowed = replicas.borrow() if g.get('read_only') else None
+            if borrowed is not None:
+                g.db_replica, g.db = borrowed
+            else:
+                g.db = pool.getconn()
+            metrics.record_pool_wait(time.perf_counter() - started)
+            if g.get('read_only'):
+                replicas.replica_reads.inc((borrowed[0].name if borrowed else 'primary',))
+        else:
+            # SQLite: every write queues for the worker's writer (see sqlite_writer.py);
+            # write requests hold it from their first statement
+            g.db = sqlite_writer.session(DATABASE, serialized=bool(g.get('write_request')))
+    return g.db
+
+# GET handlers that never write, served by the replicas when DATABASE_REPLICA_URLS is set
+USE_REPLICAS = USE_POSTGRESQL and replicas.enabled()
+REPLICA_ENDPOINTS = {
+    'handle_locations', 'handle_zones', 'handle_shipping_rates', 'handle_pickup_rates', 'handle_shipments',
+    'track_shipment', 'handle_tracking_history', 'handle_shipment_progress', 'get_shipment_route',
+    'get_nearby_shipments', 'get_shipments_within', 'search_shipments', 'list_invoices', 'invoice_summary',
+}
+
+@app.before_request
+def classify_request():
+    # Kept on this request's app context only: init_db, CLI commands and the background
+    # threads open their own contexts and get plain primary connections (SQLite: sessions
+    # that take the writer at their first write)
+    g.write_request = request.method in sqlite_writer.WRITE_METHODS
+    g.read_only = (USE_REPLICAS and request.method == 'GET' and request.endpoint in REPLICA_ENDPOINTS
+                   and not replicas.pinned(request))
+
+@app.after_request
+def pin_recent_writer(response):
+    # Read-your-writes across the replicas, see replicas.py
+    if USE_REPLICAS and g.get('write_request') and response.status_code < 400:
+        replicas.mark_write(response)
+    return response
+
+if USE_REPLICAS:
+    cache.read_lag = replicas.read_lag
+
+def pool_stats():
+    if db_pool is None:
+        return None
+    return {'in_use': len(db_pool._used), 'idle': len(db_pool._pool), 'max': db_pool.maxconn}
+
+metrics.Gauge('tracksite_db_pool_in_use', 'Pooled connections checked out', lambda: (pool_stats() or {}).get('in_use'))
+metrics.Gauge('tracksite_db_pool_idle', 'Pooled connections idle', lambda: (pool_stats() or {}).get('idle'))
+metrics.Gauge('tracksite_db_pool_max', 'Pool size limit', lambda: (pool_stats() or {}).get('max'))
+
+@app.teardown_appcontext
+def release_db(exception):
+    db = g.pop('db', None)
+    if db is None:
+        return
+    replica = g.pop('db_replica', None)
+    if replica is not None:
+        replicas.give_back(replica, db)
+        return
+    db.deferred = False
     if USE_POSTGRESQL:
-        # PostgreSQL connection
-        conn = psycopg2.connect(DATABASE_URL)
-        conn.cursor_factory = RealDictCursor
-        return conn
+        # Discard anything left uncommitted so the next borrower gets a clean connection
+        if not db.closed:
+            db.rollback()
+        if db_pool is not None:
+            db_pool.putconn(db, close=bool(db.closed))
+        else:
+            db.close()
     else:
-        # SQLite connection (fallback)
-        db = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
-        return db
+        # Thread connections stay open to keep their page cache
+        db.rollback()
 
-def init_db():
-    with app.app_context():
-        db = get_db()
+def create_base_tables(db):
+    if USE_POSTGRESQL:
+        # PostgreSQL table creation - use cursor
+        cursor = db.cursor()
+        cursor.execute('''CREATE TABLE IF NOT EXISTS locations (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            slug TEXT UNIQUE NOT NULL,
+            country TEXT NOT NULL
+        )''')
+    else:
+        # SQLite table creation
+        db.execute('''CREATE TABLE IF NOT EXISTS locations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            slug TEXT UNIQUE NOT NULL,
+            country TEXT NOT NULL
+        )''')
+
+    # Zones table
+    if USE_POSTGRESQL:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS zones (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            slug TEXT UNIQUE NOT NULL,
+            locations TEXT NOT NULL,
+            description TEXT
+        )''')
+    else:
+        db.execute('''CREATE TABLE IF NOT EXISTS zones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            slug TEXT UNIQUE NOT NULL,
+            locations TEXT NOT NULL,
+            description TEXT
+        )''')
+
+    # Shipping rates table
+    if USE_POSTGRESQL:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS shipping_rates (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            type TEXT NOT NULL CHECK(type IN ('flat', 'weight')),
+            min_weight REAL NOT NULL DEFAULT 0,
+            max_weight REAL NOT NULL DEFAULT 0,
+            rate REAL NOT NULL,
+            insurance REAL NOT NULL DEFAULT 0,
+            description TEXT
+        )''')
+    else:
+        db.execute('''CREATE TABLE IF NOT EXISTS shipping_rates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            type TEXT NOT NULL CHECK(type IN ('flat', 'weight')),
+            min_weight REAL NOT NULL DEFAULT 0,
+            max_weight REAL NOT NULL DEFAULT 0,
+            rate REAL NOT NULL,
+            insurance REAL NOT NULL DEFAULT 0,
+            description TEXT
+        )''')
+
+    # Pickup rates table
+    if USE_POSTGRESQL:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS pickup_rates (
+            id SERIAL PRIMARY KEY,
+            zone TEXT NOT NULL,
+            min_weight REAL NOT NULL DEFAULT 0,
+            max_weight REAL NOT NULL DEFAULT 0,
+            rate REAL NOT NULL,
+            description TEXT
+        )''')
+    else:
+        db.execute('''CREATE TABLE IF NOT EXISTS pickup_rates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            zone TEXT NOT NULL,
+            min_weight REAL NOT NULL DEFAULT 0,
+            max_weight REAL NOT NULL DEFAULT 0,
+            rate REAL NOT NULL,
+            description TEXT
+        )''')
+
+    # Shipments table
+    if USE_POSTGRESQL:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS shipments (
+            id SERIAL PRIMARY KEY,
+            tracking_number TEXT UNIQUE,
+            shipper_name TEXT NOT NULL,
+            shipper_address TEXT NOT NULL,
+            shipper_phone TEXT NOT NULL,
+            shipper_email TEXT NOT NULL,
+            receiver_name TEXT NOT NULL,
+            receiver_address TEXT NOT NULL,
+            receiver_phone TEXT NOT NULL,
+            receiver_email TEXT NOT NULL,
+            origin TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            status TEXT NOT NULL CHECK(status IN ('pending_confirmation', 'processing', 'picked_up', 'in_transit', 'delivered', 'delayed', 'rejected', 'cancelled')),
+            packages INTEGER NOT NULL DEFAULT 1,
+            total_weight REAL NOT NULL,
+            product TEXT,
+            quantity INTEGER DEFAULT 1,
+            payment_mode TEXT DEFAULT 'Cash',
+            total_freight REAL DEFAULT 0,
+            expected_delivery TEXT,
+            departure_time TEXT,
+            pickup_date TEXT,
+            pickup_time TEXT,
+            comments TEXT,
+            date_created TEXT NOT NULL
+        )''')
+    else:
+        db.execute('''CREATE TABLE IF NOT EXISTS shipments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tracking_number TEXT UNIQUE,
+            shipper_name TEXT NOT NULL,
+            shipper_address TEXT NOT NULL,
+            shipper_phone TEXT NOT NULL,
+            shipper_email TEXT NOT NULL,
+            receiver_name TEXT NOT NULL,
+            receiver_address TEXT NOT NULL,
+            receiver_phone TEXT NOT NULL,
+            receiver_email TEXT NOT NULL,
+            origin TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            status TEXT NOT NULL CHECK(status IN ('pending_confirmation', 'processing', 'picked_up', 'in_transit', 'delivered', 'delayed', 'rejected', 'cancelled')),
+            packages INTEGER NOT NULL DEFAULT 1,
+            total_weight REAL NOT NULL,
+            product TEXT,
+            quantity INTEGER DEFAULT 1,
+            payment_mode TEXT DEFAULT 'Cash',
+            total_freight REAL DEFAULT 0,
+            expected_delivery TEXT,
+            departure_time TEXT,
+            pickup_date TEXT,
+            pickup_time TEXT,
+            comments TEXT,
+            date_created TEXT NOT NULL
+        )''')
+
+    # Tracking history table
+    if USE_POSTGRESQL:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS tracking_history (
+            id SERIAL PRIMARY KEY,
+            shipment_id INTEGER NOT NULL,
+            date_time TEXT NOT NULL,
+            location TEXT NOT NULL,
+            status TEXT NOT NULL,
+            description TEXT,
+            latitude REAL,
+            longitude REAL,
+            FOREIGN KEY (shipment_id) REFERENCES shipments (id) ON DELETE CASCADE
+        )''')
+    else:
+        db.execute('''CREATE TABLE IF NOT EXISTS tracking_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            shipment_id INTEGER NOT NULL,
+            date_time TEXT NOT NULL,
+            location TEXT NOT NULL,
+            status TEXT NOT NULL,
+            description TEXT,
+            latitude REAL,
+            longitude REAL,
+            FOREIGN KEY (shipment_id) REFERENCES shipments (id) ON DELETE CASCADE
+        )''')
+
+    # Shipment progress table for cross-device persistence
+    if USE_POSTGRESQL:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS shipment_progress (
+            id SERIAL PRIMARY KEY,
+            shipment_id INTEGER NOT NULL,
+            progress REAL NOT NULL DEFAULT 0,
+            current_lat REAL,
+            current_lng REAL,
+            last_updated TEXT NOT NULL,
+            FOREIGN KEY (shipment_id) REFERENCES shipments (id) ON DELETE CASCADE
+        )''')
+    else:
+        db.execute('''CREATE TABLE IF NOT EXISTS shipment_progress (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            shipment_id INTEGER NOT NULL,
+            progress REAL NOT NULL DEFAULT 0,
+            current_lat REAL,
+            current_lng REAL,
+            last_updated TEXT NOT NULL,
+            FOREIGN KEY (shipment_id) REFERENCES shipments (id) ON DELETE CASCADE
+        )''')
+
+    # Users table
+    if USE_POSTGRESQL:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL DEFAULT 'user',
+            branch TEXT,
+            status TEXT NOT NULL DEFAULT 'active',
+            last_login TEXT,
+            created_at TEXT NOT NULL
+        )''')
+    else:
+        db.execute('''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL DEFAULT 'user',
+            branch TEXT,
+            status TEXT NOT NULL DEFAULT 'active',
+            last_login TEXT,
+            created_at TEXT NOT NULL
+        )''')
+
+def create_lookup_indexes(db):
+    # Indexes behind the per-shipment and status lookups of the API routes. The unique
+    # index on shipment_progress also backs the ON CONFLICT (shipment_id) upsert.
+    statements = [
+        'CREATE INDEX IF NOT EXISTS idx_tracking_history_shipment ON tracking_history (shipment_id, date_time)',
+        'CREATE INDEX IF NOT EXISTS idx_shipments_status_created ON shipments (status, date_created)',
+        'CREATE INDEX IF NOT EXISTS idx_shipments_date_created ON shipments (date_created)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_shipment_progress_shipment ON shipment_progress (shipment_id)',
+    ]
+    if USE_POSTGRESQL:
+        cursor = db.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+    else:
+        for statement in statements:
+            db.execute(statement)
+
+def create_history_archive(db):
+    history_archive.create_archive_table(db, USE_POSTGRESQL)
+
+def partition_history(db):
+    history_archive.partition_tracking_history(db, USE_POSTGRESQL)
+
+def create_maintenance_runs(db):
+    maintenance.create_runs_table(db, USE_POSTGRESQL)
+
+def create_change_feed(db):
+    change_feed.install(db, USE_POSTGRESQL)
+
+def create_idempotency_keys(db):
+    idempotency.create_table(db, USE_POSTGRESQL)
+
+def create_invalidation_triggers(db):
+    cache.install_triggers(db, USE_POSTGRESQL)
+
+def create_sla_index(db):
+    sla.create_index(db, USE_POSTGRESQL)
+
+def add_location_coordinates(db):
+    eta.add_coordinates(db, USE_POSTGRESQL)
+
+def create_shipment_search(db):
+    search.install(db, USE_POSTGRESQL)
+
+def create_current_state(db):
+    current_state.install(db, USE_POSTGRESQL)
+
+def create_gps_blocks(db):
+    gps.create_table(db, USE_POSTGRESQL)
+
+def create_spatial_index(db):
+    spatial.install(db, USE_POSTGRESQL)
+
+def create_resource_versions(db):
+    conditional.install(db, USE_POSTGRESQL)
+
+def create_invoices(db):
+    invoices.install(db, USE_POSTGRESQL)
+
+def skip_archived_tombstones(db):
+    change_feed.skip_archived_tombstones(db, USE_POSTGRESQL)
+
+def skip_moved_tombstones(db):
+    change_feed.skip_moved_tombstones(db, USE_POSTGRESQL)
+
+# Schema migrations, applied in order. The index + 1 is the schema version it brings
+# the database to; append new steps at the end, never edit an applied one.
+SCHEMA_MIGRATIONS = [
+    create_base_tables,
+    create_lookup_indexes,
+    create_history_archive,
+    partition_history,
+    create_maintenance_runs,
+    create_change_feed,
+    create_idempotency_keys,
+    create_invalidation_triggers,
+    create_sla_index,
+    add_location_coordinates,
+    create_shipment_search,
+    create_current_state,
+    create_gps_blocks,
+    create_spatial_index,
+    create_resource_versions,
+    create_invoices,
+    skip_archived_tombstones,
+    skip_moved_tombstones,
+]
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+SCHEMA_LOCK_ID = 720101
+
+def get_schema_version(db):
+    try:
         if USE_POSTGRESQL:
-            # PostgreSQL table creation - use cursor
             cursor = db.cursor()
-            cursor.execute('''CREATE TABLE IF NOT EXISTS locations (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                slug TEXT UNIQUE NOT NULL,
-                country TEXT NOT NULL
-            )''')
-        else:
-            # SQLite table creation
-            db.execute('''CREATE TABLE IF NOT EXISTS locations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                slug TEXT UNIQUE NOT NULL,
-                country TEXT NOT NULL
-            )''')
-
-        # Zones table
-        if USE_POSTGRESQL:
-            cursor.execute('''CREATE TABLE IF NOT EXISTS zones (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                slug TEXT UNIQUE NOT NULL,
-                locations TEXT NOT NULL,
-                description TEXT
-            )''')
-        else:
-            db.execute('''CREATE TABLE IF NOT EXISTS zones (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                slug TEXT UNIQUE NOT NULL,
-                locations TEXT NOT NULL,
-                description TEXT
-            )''')
-
-        # Shipping rates table
-        if USE_POSTGRESQL:
-            cursor.execute('''CREATE TABLE IF NOT EXISTS shipping_rates (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                type TEXT NOT NULL CHECK(type IN ('flat', 'weight')),
-                min_weight REAL NOT NULL DEFAULT 0,
-                max_weight REAL NOT NULL DEFAULT 0,
-                rate REAL NOT NULL,
-                insurance REAL NOT NULL DEFAULT 0,
-                description TEXT
-            )''')
-        else:
-            db.execute('''CREATE TABLE IF NOT EXISTS shipping_rates (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                type TEXT NOT NULL CHECK(type IN ('flat', 'weight')),
-                min_weight REAL NOT NULL DEFAULT 0,
-                max_weight REAL NOT NULL DEFAULT 0,
-                rate REAL NOT NULL,
-                insurance REAL NOT NULL DEFAULT 0,
-                description TEXT
-            )''')
-
-        # Pickup rates table
-        if USE_POSTGRESQL:
-            cursor.execute('''CREATE TABLE IF NOT EXISTS pickup_rates (
-                id SERIAL PRIMARY KEY,
-                zone TEXT NOT NULL,
-                min_weight REAL NOT NULL DEFAULT 0,
-                max_weight REAL NOT NULL DEFAULT 0,
-                rate REAL NOT NULL,
-                description TEXT
-            )''')
+            cursor.execute('SELECT version FROM schema_version WHERE id = 1')
+            row = cursor.fetchone()
         else:
-            db.execute('''CREATE TABLE IF NOT EXISTS pickup_rates (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                zone TEXT NOT NULL,
-                min_weight REAL NOT NULL DEFAULT 0,
-                max_weight REAL NOT NULL DEFAULT 0,
-                rate REAL NOT NULL,
-                description TEXT
-            )''')
-
-        # Shipments table
-        if USE_POSTGRESQL:
-            cursor.execute('''CREATE TABLE IF NOT EXISTS shipments (
-                id SERIAL PRIMARY KEY,
-                tracking_number TEXT UNIQUE,
-                shipper_name TEXT NOT NULL,
-                shipper_address TEXT NOT NULL,
-                shipper_phone TEXT NOT NULL,
-                shipper_email TEXT NOT NULL,
-                receiver_name TEXT NOT NULL,
-                receiver_address TEXT NOT NULL,
-                receiver_phone TEXT NOT NULL,
-                receiver_email TEXT NOT NULL,
-                origin TEXT NOT NULL,
-                destination TEXT NOT NULL,
-                status TEXT NOT NULL CHECK(status IN ('pending_confirmation', 'processing', 'picked_up', 'in_transit', 'delivered', 'delayed', 'rejected', 'cancelled')),
-                packages INTEGER NOT NULL DEFAULT 1,
-                total_weight REAL NOT NULL,
-                product TEXT,
-                quantity INTEGER DEFAULT 1,
-                payment_mode TEXT DEFAULT 'Cash',
-                total_freight REAL DEFAULT 0,
-                expected_delivery TEXT,
-                departure_time TEXT,
-                pickup_date TEXT,
-                pickup_time TEXT,
-                comments TEXT,
-                date_created TEXT NOT NULL
-            )''')
-        else:
-            db.execute('''CREATE TABLE IF NOT EXISTS shipments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tracking_number TEXT UNIQUE,
-                shipper_name TEXT NOT NULL,
-                shipper_address TEXT NOT NULL,
-                shipper_phone TEXT NOT NULL,
-                shipper_email TEXT NOT NULL,
-                receiver_name TEXT NOT NULL,
-                receiver_address TEXT NOT NULL,
-                receiver_phone TEXT NOT NULL,
-                receiver_email TEXT NOT NULL,
-                origin TEXT NOT NULL,
-                destination TEXT NOT NULL,
-                status TEXT NOT NULL CHECK(status IN ('pending_confirmation', 'processing', 'picked_up', 'in_transit', 'delivered', 'delayed', 'rejected', 'cancelled')),
-                packages INTEGER NOT NULL DEFAULT 1,
-                total_weight REAL NOT NULL,
-                product TEXT,
-                quantity INTEGER DEFAULT 1,
-                payment_mode TEXT DEFAULT 'Cash',
-                total_freight REAL DEFAULT 0,
-                expected_delivery TEXT,
-                departure_time TEXT,
-                pickup_date TEXT,
-                pickup_time TEXT,
-                comments TEXT,
-                date_created TEXT NOT NULL
-            )''')
-
-        # Tracking history table
-        if USE_POSTGRESQL:
-            cursor.execute('''CREATE TABLE IF NOT EXISTS tracking_history (
-                id SERIAL PRIMARY KEY,
-                shipment_id INTEGER NOT NULL,
-                date_time TEXT NOT NULL,
-                location TEXT NOT NULL,
-                status TEXT NOT NULL,
-                description TEXT,
-                latitude REAL,
-                longitude REAL,
-                FOREIGN KEY (shipment_id) REFERENCES shipments (id) ON DELETE CASCADE
-            )''')
-        else:
-            db.execute('''CREATE TABLE IF NOT EXISTS tracking_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                shipment_id INTEGER NOT NULL,
-                date_time TEXT NOT NULL,
-                location TEXT NOT NULL,
-                status TEXT NOT NULL,
-                description TEXT,
-                latitude REAL,
-                longitude REAL,
-                FOREIGN KEY (shipment_id) REFERENCES shipments (id) ON DELETE CASCADE
-            )''')
-
-        # Shipment progress table for cross-device persistence
-        if USE_POSTGRESQL:
-            cursor.execute('''CREATE TABLE IF NOT EXISTS shipment_progress (
-                id SERIAL PRIMARY KEY,
-                shipment_id INTEGER NOT NULL,
-                progress REAL NOT NULL DEFAULT 0,
-                current_lat REAL,
-                current_lng REAL,
-                last_updated TEXT NOT NULL,
-                FOREIGN KEY (shipment_id) REFERENCES shipments (id) ON DELETE CASCADE
-            )''')
-        else:
-            db.execute('''CREATE TABLE IF NOT EXISTS shipment_progress (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                shipment_id INTEGER NOT NULL,
-                progress REAL NOT NULL DEFAULT 0,
-                current_lat REAL,
-                current_lng REAL,
-                last_updated TEXT NOT NULL,
-                FOREIGN KEY (shipment_id) REFERENCES shipments (id) ON DELETE CASCADE
-            )''')
-
-        # Users table
+            row = db.execute('SELECT version FROM schema_version WHERE id = 1').fetchone()
+        return row['version'] if row else 0
+    except (sqlite3.OperationalError, psycopg2.Error):
+        # Table does not exist yet: fresh database or deployment predating versioning
+        db.rollback()
+        return 0
+
+def create_schema_version_table(db):
+    if USE_POSTGRESQL:
+        cursor = db.cursor()
+        cursor.execute('CREATE TABLE IF NOT EXISTS schema_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)')
+    else:
+        db.execute('CREATE TABLE IF NOT EXISTS schema_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)')
+    db.commit()
+
+def set_schema_version(db, version):
+    # Not committed here: written in the transaction of the migration reaching `version`
+    if USE_POSTGRESQL:
+        cursor = db.cursor()
+        cursor.execute('INSERT INTO schema_version (id, version) VALUES (1, %s) ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version', (version,))
+    else:
+        db.execute('INSERT INTO schema_version (id, version) VALUES (1, ?) ON CONFLICT (id) DO UPDATE SET version = excluded.version', (version,))
+
+def apply_migration(db, version):
+    # One transaction per step, version included: a step that fails leaves the previous
+    # version recorded and nothing of its own, and runs again on the next boot. On SQLite
+    # the whole step, reads included, runs on the writer inside its transaction.
+    if not USE_POSTGRESQL:
+        db.begin()
+    SCHEMA_MIGRATIONS[version - 1](db)
+    set_schema_version(db, version)
+    db.commit()
+
+def needs_seed(db):
+    # Fresh database, including one whose first migration run was interrupted
+    if USE_POSTGRESQL:
+        cursor = db.cursor()
+        cursor.execute('SELECT 1 FROM locations LIMIT 1')
+        return cursor.fetchone() is None
+    return db.execute('SELECT 1 FROM locations LIMIT 1').fetchone() is None
+
+def init_db(seed=True):
+    # Cheap on warm starts: a single SELECT, DDL and seeding only run when the schema is behind
+    with app.app_context():
+        db = get_db()
+        current = get_schema_version(db)
+        if current >= SCHEMA_VERSION:
+            return False
+
         if USE_POSTGRESQL:
-            cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                role TEXT NOT NULL DEFAULT 'user',
-                branch TEXT,
-                status TEXT NOT NULL DEFAULT 'active',
-                last_login TEXT,
-                created_at TEXT NOT NULL
-            )''')
-        else:
-            db.execute('''CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                role TEXT NOT NULL DEFAULT 'user',
-                branch TEXT,
-                status TEXT NOT NULL DEFAULT 'active',
-                last_login TEXT,
-                created_at TEXT NOT NULL
-            )''')
+            # Serialize concurrent workers booting against a fresh database
+            cursor = db.cursor()
+            cursor.execute('SELECT pg_advisory_lock(%s)', (SCHEMA_LOCK_ID,))
+        try:
+            current = get_schema_version(db)
+            if current >= SCHEMA_VERSION:
+                return False
+            print(f"Migrating database schema from version {current} to {SCHEMA_VERSION}")
+            create_schema_version_table(db)
+            for version in range(current + 1, SCHEMA_VERSION + 1):
+                apply_migration(db, version)
+            if seed and needs_seed(db):
+                insert_default_data(db)
+            return True
+        finally:
+            # A failed step leaves its transaction aborted on Postgres
+            db.rollback()
+            if USE_POSTGRESQL:
+                cursor = db.cursor()
+                cursor.execute('SELECT pg_advisory_unlock(%s)', (SCHEMA_LOCK_ID,))
+                db.commit()
 
+# DB work is deferred to the first request so the server binds its port immediately
+db_ready = False
+db_ready_lock = threading.Lock()
+
+@app.before_request
+def ensure_db_ready():
+    if db_ready or request.endpoint in ('healthz', 'metrics_endpoint'):
+        return
+    start_services()
+
+def start_services():
+    # Schema check, then this worker's maintenance scheduler, ETA lane refresher and invalidation bus
+    global db_ready
+    with db_ready_lock:
+        if not db_ready:
+            init_db()
+            db_ready = True
+            maintenance.start(app, get_db, USE_POSTGRESQL)
+            eta.start(app, get_db, USE_POSTGRESQL)
+            cache.start(app, get_db, USE_POSTGRESQL, DATABASE_URL if USE_POSTGRESQL else None)
+
+# POSTs that honour an Idempotency-Key header; registered after ensure_db_ready
+idempotency.init_app(app, get_db, USE_POSTGRESQL, {'handle_shipments', 'confirm_shipment', 'reject_shipment', 'handle_tracking_history', 'ingest_gps_pings'})
+
+# Read-mostly payloads, evicted across workers by the invalidation bus started above
+reference_cache = cache.Cache('reference')
+track_cache = cache.Cache('track')
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create or migrate the database schema."""
+    if init_db(seed=False):
+        print(f"Schema migrated to version {SCHEMA_VERSION}")
+    else:
+        print(f"Schema already at version {SCHEMA_VERSION}")
+
+@app.cli.command('seed')
+def seed_command():
+    """Insert the default reference data (idempotent)."""
+    with app.app_context():
+        init_db(seed=False)
+        insert_default_data(get_db())
+    print("Default data inserted")
+
+@app.cli.command('archive-history')
+@click.option('--older-than-days', default=history_archive.ARCHIVE_AFTER_DAYS, help='Archive closed shipments whose last event is older than this')
+@click.option('--batch-size', default=history_archive.ARCHIVE_BATCH_SIZE)
+def archive_history_command(older_than_days, batch_size):
+    """Move the history of closed shipments into tracking_history_archive."""
+    init_db(seed=False)
+    with app.app_context():
+        db = get_db()
+        result = history_archive.archive_closed_shipments(db, USE_POSTGRESQL, older_than_days, batch_size)
+        print(f"Archived {result['events']} events of {result['shipments']} shipments (last event before {result['cutoff']})")
+        if USE_POSTGRESQL:
+            history_archive.ensure_partitions(db)
+            dropped = history_archive.drop_empty_partitions(db)
+            db.commit()
+            if dropped:
+                print(f"Dropped empty partitions: {', '.join(dropped)}")
+
+@app.cli.command('rebuild-current-state')
+def rebuild_current_state_command():
+    """Recompute shipment_current_state from tracking history and progress."""
+    init_db(seed=False)
+    with app.app_context():
+        db = get_db()
+        shipments = current_state.rebuild(db, USE_POSTGRESQL)
         db.commit()
+        print(f"Rebuilt the current state of {shipments} shipments")
 
-        # Insert default data
-        insert_default_data(db)
+@app.cli.command('maintenance')
+@click.argument('tasks', nargs=-1, type=click.Choice(list(maintenance.TASKS)))
+def maintenance_command(tasks):
+    """Run maintenance tasks now (all of them by default), ignoring their schedule."""
+    init_db(seed=False)
+    with app.app_context():
+        db = get_db()
+        for name in tasks or maintenance.TASKS:
+            result = maintenance.run_task(db, USE_POSTGRESQL, name)
+            print(f"{name}: {json.dumps(result)}")
+
+@app.cli.command('statements')
+@click.argument('period', required=False)
+@click.option('--workers', default=invoices.STATEMENT_WORKERS, help='Rendering processes')
+@click.option('--force', is_flag=True, help='Render every statement, even unchanged ones')
+def statements_command(period, workers, force):
+    """Write the shipper statements of PERIOD (YYYY-MM, last month by default)."""
+    period = period or invoices.previous_period()
+    try:
+        invoices.period_bounds(period)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='PERIOD')
+    init_db(seed=False)
+    with app.app_context():
+        result = invoices.generate_statements(get_db(), USE_POSTGRESQL, period, workers, force)
+    print(f"{period}: {result['rendered']} statements rendered, {result['unchanged']} unchanged, "
+          f"{result['removed']} removed in {os.path.join(invoices.STATEMENTS_DIR, period)}")
+
+@app.cli.command('profile-token')
+@click.argument('path')
+@click.option('--ttl', default=3600, help='Validity in seconds')
+def profile_token_command(path, ttl):
+    """Print an X-Profile header value that profiles requests to PATH."""
+    if not profiling.PROFILE_SECRET:
+        raise click.ClickException('PROFILE_SECRET is not set')
+    print(profiling.make_token(path, ttl))
+
+def insert_rows(db, table, columns, rows, unique_key=None):
+    # One multi-row INSERT per table instead of one statement (and cursor) per row.
+    # Tables without a unique key are only seeded while empty so reseeding never duplicates.
+    placeholder = '%s' if USE_POSTGRESQL else '?'
+    row_sql = '(' + ', '.join([placeholder] * len(columns)) + ')'
+    values_sql = ', '.join([row_sql] * len(rows))
+    params = [value for row in rows for value in row]
+    column_sql = ', '.join(columns)
+    if unique_key:
+        sql = f'INSERT INTO {table} ({column_sql}) VALUES {values_sql} ON CONFLICT ({unique_key}) DO NOTHING'
+    else:
+        sql = f'INSERT INTO {table} ({column_sql}) SELECT * FROM (VALUES {values_sql}) AS v WHERE NOT EXISTS (SELECT 1 FROM {table})'
+    if USE_POSTGRESQL:
+        cursor = db.cursor()
+        cursor.execute(sql, params)
+    else:
+        db.execute(sql, params)
 
 def insert_default_data(db):
     # Default locations
     locations = [
-        ('Paris', 'paris', 'France'),
-        ('Lyon', 'lyon', 'France'),
-        ('Marseille', 'marseille', 'France'),
-        ('Toulouse', 'toulouse', 'France'),
-        ('Nice', 'nice', 'France'),
-        ('Nantes', 'nantes', 'France'),
-        ('Strasbourg', 'strasbourg', 'France'),
-        ('Montpellier', 'montpellier', 'France'),
-        ('Bordeaux', 'bordeaux', 'France'),
-        ('Lille', 'lille', 'France')
+        ('Paris', 'paris', 'France', 48.8566, 2.3522),
+        ('Lyon', 'lyon', 'France', 45.764, 4.8357),
+        ('Marseille', 'marseille', 'France', 43.2965, 5.3698),
+        ('Toulouse', 'toulouse', 'France', 43.6047, 1.4442),
+        ('Nice', 'nice', 'France', 43.7102, 7.262),
+        ('Nantes', 'nantes', 'France', 47.2184, -1.5536),
+        ('Strasbourg', 'strasbourg', 'France', 48.5734, 7.7521),
+        ('Montpellier', 'montpellier', 'France', 43.6108, 3.8767),
+        ('Bordeaux', 'bordeaux', 'France', 44.8378, -0.5792),
+        ('Lille', 'lille', 'France', 50.6292, 3.0573)
     ]
 
-    for loc in locations:
-        try:
-            try:
-                if USE_POSTGRESQL:
-                    cursor = db.cursor()
-                    cursor.execute('INSERT INTO locations (name, slug, country) VALUES (%s, %s, %s) ON CONFLICT (slug) DO NOTHING', loc)
-                else:
-                    db.execute('INSERT OR IGNORE INTO locations (name, slug, country) VALUES (?, ?, ?)', loc)
-            except Exception as e:
-                print(f"Error inserting location {loc}: {e}")
-        except (sqlite3.IntegrityError, psycopg2.IntegrityError):
-            pass
-
     # Default zones
     zones = [
         ('France North', 'france-north', 'Paris,Lille,Strasbourg', 'Northern regions of France'),
@@ -349,16 +758,6 @@ def insert_default_data(db):
         ('France Central', 'france-central', 'Lyon,Clermont-Ferrand', 'Central regions of France')
     ]
 
-    for zone in zones:
-        try:
-            if USE_POSTGRESQL:
-                cursor = db.cursor()
-                cursor.execute('INSERT INTO zones (name, slug, locations, description) VALUES (%s, %s, %s, %s) ON CONFLICT (slug) DO NOTHING', zone)
-            else:
-                db.execute('INSERT OR IGNORE INTO zones (name, slug, locations, description) VALUES (?, ?, ?, ?)', zone)
-        except Exception as e:
-            print(f"Error inserting zone {zone}: {e}")
-
     # Default shipping rates
     shipping_rates = [
         ('Standard Shipping', 'weight', 0, 5, 12.5, 2.0, 'Standard shipping for small packages'),
@@ -367,16 +766,6 @@ def insert_default_data(db):
         ('Door to Door', 'flat', 0, 20, 35.0, 7.5, 'Premium door to door delivery service')
     ]
 
-    for rate in shipping_rates:
-        try:
-            if USE_POSTGRESQL:
-                cursor = db.cursor()
-                cursor.execute('INSERT INTO shipping_rates (name, type, min_weight, max_weight, rate, insurance, description) VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING', rate)
-            else:
-                db.execute('INSERT OR IGNORE INTO shipping_rates (name, type, min_weight, max_weight, rate, insurance, description) VALUES (?, ?, ?, ?, ?, ?, ?)', rate)
-        except Exception as e:
-            print(f"Error inserting shipping rate {rate}: {e}")
-
     # Default pickup rates
     pickup_rates = [
         ('France North', 0, 5, 8.5, 'Standard pickup for small packages in Northern France'),
@@ -386,16 +775,6 @@ def insert_default_data(db):
         ('France West', 0, 10, 12.0, 'Standard pickup in Western France')
     ]
 
-    for rate in pickup_rates:
-        try:
-            if USE_POSTGRESQL:
-                cursor = db.cursor()
-                cursor.execute('INSERT INTO pickup_rates (zone, min_weight, max_weight, rate, description) VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING', rate)
-            else:
-                db.execute('INSERT OR IGNORE INTO pickup_rates (zone, min_weight, max_weight, rate, description) VALUES (?, ?, ?, ?, ?)', rate)
-        except Exception as e:
-            print(f"Error inserting pickup rate {rate}: {e}")
-
     # Default users
     users = [
         ('Jean Dupont', 'jean.dupont@colisselect.com', 'password123', 'admin', 'Paris HQ', 'active', '2023-05-18 14:30', '2023-01-01'),
@@ -405,16 +784,11 @@ def insert_default_data(db):
         ('Thomas Petit', 'thomas.petit@colisselect.com', 'password123', 'manager', 'Toulouse Branch', 'active', '2023-05-18 08:05', '2023-01-05')
     ]
 
-    for user in users:
-        try:
-            if USE_POSTGRESQL:
-                cursor = db.cursor()
-                cursor.execute('INSERT INTO users (name, email, password, role, branch, status, last_login, created_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (email) DO NOTHING', user)
-            else:
-                db.execute('INSERT OR IGNORE INTO users (name, email, password, role, branch, status, last_login, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', user)
-        except Exception as e:
-            print(f"Error inserting user {user}: {e}")
-
+    insert_rows(db, 'locations', ('name', 'slug', 'country', 'latitude', 'longitude'), locations, 'slug')
+    insert_rows(db, 'zones', ('name', 'slug', 'locations', 'description'), zones, 'slug')
+    insert_rows(db, 'shipping_rates', ('name', 'type', 'min_weight', 'max_weight', 'rate', 'insurance', 'description'), shipping_rates)
+    insert_rows(db, 'pickup_rates', ('zone', 'min_weight', 'max_weight', 'rate', 'description'), pickup_rates)
+    insert_rows(db, 'users', ('name', 'email', 'password', 'role', 'branch', 'status', 'last_login', 'created_at'), users, 'email')
     db.commit()
 
 # API Routes
@@ -428,36 +802,37 @@ def handle_locations():
     elif request.method == 'POST':
         return create_location()
 
+def reference_response(resource, loader):
+    # Conditional on the resource's version stamp; the body is cached under the same
+    # stamp, so it is never older than the ETag sent with it
+    stamp = conditional.reference_stamp(get_db(), USE_POSTGRESQL, resource)
+    key = (resource, stamp['version'] if stamp else None)
+    return conditional.respond(resource, stamp, lambda: jsonify(reference_cache.get_or_load(key, [(resource, None)], loader)),
+                               conditional.REFERENCE_CACHE_CONTROL)
+
 def get_locations():
-    db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('SELECT * FROM locations ORDER BY name')
-        locations = cursor.fetchall()
-    else:
-        locations = db.execute('SELECT * FROM locations ORDER BY name').fetchall()
-    return jsonify([dict(row) for row in locations])
+    return reference_response('locations', load_locations)
+
+def load_locations():
+    return repositories.as_dicts(repositories.locations.list(get_db()))
 
 def create_location():
     data = request.get_json()
     name = data.get('name')
     country = data.get('country')
     slug = data.get('slug') or name.lower().replace(' ', '-')
+    latitude = data.get('latitude')
+    longitude = data.get('longitude')
 
     if not name or not country:
         return jsonify({'error': 'Name and country are required'}), 400
 
     db = get_db()
     try:
-        if USE_POSTGRESQL:
-            cursor = db.cursor()
-            cursor.execute('INSERT INTO locations (name, slug, country) VALUES (%s, %s, %s)', (name, slug, country))
-            location_id = cursor.fetchone()[0] if cursor.description else cursor.lastrowid
-        else:
-            cursor = db.execute('INSERT INTO locations (name, slug, country) VALUES (?, ?, ?)', (name, slug, country))
-            location_id = cursor.lastrowid
+        location_id = repositories.locations.insert(db, (name, slug, country, latitude, longitude))
         db.commit()
-        return jsonify({'id': location_id, 'name': name, 'slug': slug, 'country': country})
+        autocomplete.notify_change()
+        return jsonify({'id': location_id, 'name': name, 'slug': slug, 'country': country, 'latitude': latitude, 'longitude': longitude})
     except (sqlite3.IntegrityError, psycopg2.IntegrityError):
         return jsonify({'error': 'Location with this slug already exists'}), 400
 
@@ -473,24 +848,16 @@ def handle_location(id):
 def update_location(id):
     data = request.get_json()
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('UPDATE locations SET name = %s, slug = %s, country = %s WHERE id = %s',
-                       (data['name'], data['slug'], data['country'], id))
-    else:
-        db.execute('UPDATE locations SET name = ?, slug = ?, country = ? WHERE id = ?',
-                   (data['name'], data['slug'], data['country'], id))
+    repositories.locations.update(db, id, (data['name'], data['slug'], data['country'], data.get('latitude'), data.get('longitude')))
     db.commit()
+    autocomplete.notify_change()
     return jsonify({'message': 'Location updated'})
 
 def delete_location(id):
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('DELETE FROM locations WHERE id = %s', (id,))
-    else:
-        db.execute('DELETE FROM locations WHERE id = ?', (id,))
+    repositories.locations.delete(db, id)
     db.commit()
+    autocomplete.notify_change()
     return jsonify({'message': 'Location deleted'})
 
 @app.route('/api/zones', methods=['GET', 'POST', 'OPTIONS'])
@@ -503,14 +870,10 @@ def handle_zones():
         return create_zone()
 
 def get_zones():
-    db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('SELECT * FROM zones ORDER BY name')
-        zones = cursor.fetchall()
-    else:
-        zones = db.execute('SELECT * FROM zones ORDER BY name').fetchall()
-    return jsonify([dict(row) for row in zones])
+    return reference_response('zones', load_zones)
+
+def load_zones():
+    return repositories.as_dicts(repositories.zones.list(get_db()))
 
 def create_zone():
     data = request.get_json()
@@ -524,16 +887,9 @@ def create_zone():
 
     db = get_db()
     try:
-        if USE_POSTGRESQL:
-            cursor = db.cursor()
-            cursor.execute('INSERT INTO zones (name, slug, locations, description) VALUES (%s, %s, %s, %s)',
-                           (name, slug, locations, description))
-            zone_id = cursor.fetchone()[0] if cursor.description else cursor.lastrowid
-        else:
-            cursor = db.execute('INSERT INTO zones (name, slug, locations, description) VALUES (?, ?, ?, ?)',
-                               (name, slug, locations, description))
-            zone_id = cursor.lastrowid
+        zone_id = repositories.zones.insert(db, (name, slug, locations, description))
         db.commit()
+        autocomplete.notify_change()
         return jsonify({'id': zone_id, 'name': name, 'slug': slug, 'locations': locations, 'description': description})
     except (sqlite3.IntegrityError, psycopg2.IntegrityError):
         return jsonify({'error': 'Zone with this slug already exists'}), 400
@@ -550,24 +906,16 @@ def handle_zone(id):
 def update_zone(id):
     data = request.get_json()
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('UPDATE zones SET name = %s, slug = %s, locations = %s, description = %s WHERE id = %s',
-                       (data['name'], data['slug'], data['locations'], data['description'], id))
-    else:
-        db.execute('UPDATE zones SET name = ?, slug = ?, locations = ?, description = ? WHERE id = ?',
-                   (data['name'], data['slug'], data['locations'], data['description'], id))
+    repositories.zones.update(db, id, (data['name'], data['slug'], data['locations'], data['description']))
     db.commit()
+    autocomplete.notify_change()
     return jsonify({'message': 'Zone updated'})
 
 def delete_zone(id):
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('DELETE FROM zones WHERE id = %s', (id,))
-    else:
-        db.execute('DELETE FROM zones WHERE id = ?', (id,))
+    repositories.zones.delete(db, id)
     db.commit()
+    autocomplete.notify_change()
     return jsonify({'message': 'Zone deleted'})
 
 @app.route('/api/shipping-rates', methods=['GET', 'POST', 'OPTIONS'])
@@ -580,14 +928,10 @@ def handle_shipping_rates():
         return create_shipping_rate()
 
 def get_shipping_rates():
-    db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('SELECT * FROM shipping_rates ORDER BY name')
-        rates = cursor.fetchall()
-    else:
-        rates = db.execute('SELECT * FROM shipping_rates ORDER BY name').fetchall()
-    return jsonify([dict(row) for row in rates])
+    return reference_response('shipping_rates', load_shipping_rates)
+
+def load_shipping_rates():
+    return repositories.as_dicts(repositories.shipping_rates.list(get_db()))
 
 def create_shipping_rate():
     data = request.get_json()
@@ -598,15 +942,7 @@ def create_shipping_rate():
         return jsonify({'error': 'Name and rate are required'}), 400
 
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('INSERT INTO shipping_rates (name, type, min_weight, max_weight, rate, insurance, description) VALUES (%s, %s, %s, %s, %s, %s, %s)',
-                       (name, data.get('type', 'flat'), data.get('min_weight', 0), data.get('max_weight', 0), rate, data.get('insurance', 0), data.get('description')))
-        rate_id = cursor.fetchone()[0] if cursor.description else cursor.lastrowid
-    else:
-        cursor = db.execute('INSERT INTO shipping_rates (name, type, min_weight, max_weight, rate, insurance, description) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                           (name, data.get('type', 'flat'), data.get('min_weight', 0), data.get('max_weight', 0), rate, data.get('insurance', 0), data.get('description')))
-        rate_id = cursor.lastrowid
+    rate_id = repositories.shipping_rates.insert(db, (name, data.get('type', 'flat'), data.get('min_weight', 0), data.get('max_weight', 0), rate, data.get('insurance', 0), data.get('description')))
     db.commit()
     return jsonify({'id': rate_id, 'name': name, 'type': data.get('type', 'flat'), 'min_weight': data.get('min_weight', 0), 'max_weight': data.get('max_weight', 0), 'rate': rate, 'insurance': data.get('insurance', 0), 'description': data.get('description')})
 
@@ -622,23 +958,13 @@ def handle_shipping_rate(id):
 def update_shipping_rate(id):
     data = request.get_json()
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('UPDATE shipping_rates SET name = %s, type = %s, min_weight = %s, max_weight = %s, rate = %s, insurance = %s, description = %s WHERE id = %s',
-                       (data['name'], data['type'], data['min_weight'], data['max_weight'], data['rate'], data['insurance'], data['description'], id))
-    else:
-        db.execute('UPDATE shipping_rates SET name = ?, type = ?, min_weight = ?, max_weight = ?, rate = ?, insurance = ?, description = ? WHERE id = ?',
-                   (data['name'], data['type'], data['min_weight'], data['max_weight'], data['rate'], data['insurance'], data['description'], id))
+    repositories.shipping_rates.update(db, id, (data['name'], data['type'], data['min_weight'], data['max_weight'], data['rate'], data['insurance'], data['description']))
     db.commit()
     return jsonify({'message': 'Shipping rate updated'})
 
 def delete_shipping_rate(id):
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('DELETE FROM shipping_rates WHERE id = %s', (id,))
-    else:
-        db.execute('DELETE FROM shipping_rates WHERE id = ?', (id,))
+    repositories.shipping_rates.delete(db, id)
     db.commit()
     return jsonify({'message': 'Shipping rate deleted'})
 
@@ -652,14 +978,10 @@ def handle_pickup_rates():
         return create_pickup_rate()
 
 def get_pickup_rates():
-    db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('SELECT * FROM pickup_rates ORDER BY zone')
-        rates = cursor.fetchall()
-    else:
-        rates = db.execute('SELECT * FROM pickup_rates ORDER BY zone').fetchall()
-    return jsonify([dict(row) for row in rates])
+    return reference_response('pickup_rates', load_pickup_rates)
+
+def load_pickup_rates():
+    return repositories.as_dicts(repositories.pickup_rates.list(get_db()))
 
 def create_pickup_rate():
     data = request.get_json()
@@ -670,15 +992,7 @@ def create_pickup_rate():
         return jsonify({'error': 'Zone and rate are required'}), 400
 
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('INSERT INTO pickup_rates (zone, min_weight, max_weight, rate, description) VALUES (%s, %s, %s, %s, %s)',
-                       (zone, data.get('min_weight', 0), data.get('max_weight', 0), rate, data.get('description')))
-        rate_id = cursor.fetchone()[0] if cursor.description else cursor.lastrowid
-    else:
-        cursor = db.execute('INSERT INTO pickup_rates (zone, min_weight, max_weight, rate, description) VALUES (?, ?, ?, ?, ?)',
-                           (zone, data.get('min_weight', 0), data.get('max_weight', 0), rate, data.get('description')))
-        rate_id = cursor.lastrowid
+    rate_id = repositories.pickup_rates.insert(db, (zone, data.get('min_weight', 0), data.get('max_weight', 0), rate, data.get('description')))
     db.commit()
     return jsonify({'id': rate_id, 'zone': zone, 'min_weight': data.get('min_weight', 0), 'max_weight': data.get('max_weight', 0), 'rate': rate, 'description': data.get('description')})
 
@@ -694,23 +1008,13 @@ def handle_pickup_rate(id):
 def update_pickup_rate(id):
     data = request.get_json()
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('UPDATE pickup_rates SET zone = %s, min_weight = %s, max_weight = %s, rate = %s, description = %s WHERE id = %s',
-                       (data['zone'], data['min_weight'], data['max_weight'], data['rate'], data['description'], id))
-    else:
-        db.execute('UPDATE pickup_rates SET zone = ?, min_weight = ?, max_weight = ?, rate = ?, description = ? WHERE id = ?',
-                   (data['zone'], data['min_weight'], data['max_weight'], data['rate'], data['description'], id))
+    repositories.pickup_rates.update(db, id, (data['zone'], data['min_weight'], data['max_weight'], data['rate'], data['description']))
     db.commit()
     return jsonify({'message': 'Pickup rate updated'})
 
 def delete_pickup_rate(id):
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('DELETE FROM pickup_rates WHERE id = %s', (id,))
-    else:
-        db.execute('DELETE FROM pickup_rates WHERE id = ?', (id,))
+    repositories.pickup_rates.delete(db, id)
     db.commit()
     return jsonify({'message': 'Pickup rate deleted'})
 
@@ -723,6 +1027,82 @@ def handle_shipment_progress(shipment_id):
     elif request.method == 'PUT':
         return update_shipment_progress(shipment_id)
 
+@app.route('/api/shipments/<int:shipment_id>/gps', methods=['POST', 'OPTIONS'])
+def ingest_gps_pings(shipment_id):
+    # {"pings": [{"lat", "lng", "progress"?, "timestamp"? (ms)}, ...]} or the bare list
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'success'}), 200
+    data = request.get_json(silent=True)
+    pings = data.get('pings') if isinstance(data, dict) else data
+    try:
+        result = gps.ingest(get_db(), USE_POSTGRESQL, shipment_id, pings)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if result is None:
+        return jsonify({'error': 'Shipment not found'}), 404
+    return jsonify(result), 201
+
+@app.route('/api/shipments/<int:shipment_id>/route', methods=['GET', 'OPTIONS'])
+def get_shipment_route(shipment_id):
+    # ?zoom=<map zoom level>: the path is simplified to about a pixel at that zoom
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'success'}), 200
+    zoom = request.args.get('zoom', gps.DEFAULT_ZOOM, type=int)
+    if not 0 <= zoom <= gps.MAX_ZOOM:
+        return jsonify({'error': f'zoom must be between 0 and {gps.MAX_ZOOM}'}), 400
+    result = gps.route(get_db(), USE_POSTGRESQL, shipment_id, zoom)
+    if result is None:
+        return jsonify({'error': 'Shipment not found'}), 404
+    return jsonify(result)
+
+@app.route('/api/shipments/nearby', methods=['GET', 'OPTIONS'])
+def get_nearby_shipments():
+    # ?lat=&lng=&radius=<km>&status=<comma-separated active statuses>&limit=
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'success'}), 200
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lng', type=float)
+    radius = request.args.get('radius', type=float)
+    limit = request.args.get('limit', spatial.LIMIT, type=int)
+    if latitude is None or longitude is None or radius is None:
+        return jsonify({'error': 'lat, lng and radius (km) are required'}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+    try:
+        statuses = spatial.parse_statuses(request.args.get('status'))
+        return jsonify(spatial.nearby(get_db(), USE_POSTGRESQL, latitude, longitude, radius, min(limit, spatial.MAX_LIMIT), statuses))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/shipments/within', methods=['GET', 'OPTIONS'])
+def get_shipments_within():
+    # ?bbox=west,south,east,north&status=&limit= for the admin map
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'success'}), 200
+    limit = request.args.get('limit', spatial.MAX_LIMIT, type=int)
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+    try:
+        west, south, east, north = spatial.parse_bbox(request.args.get('bbox'))
+        statuses = spatial.parse_statuses(request.args.get('status'))
+        return jsonify(spatial.within(get_db(), USE_POSTGRESQL, west, south, east, north, min(limit, spatial.MAX_LIMIT), statuses))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/shipments/search', methods=['GET', 'OPTIONS'])
+def search_shipments():
+    # ?q=<names, phone, email, address or tracking number fragments>&limit=&offset=
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'success'}), 200
+    limit = request.args.get('limit', search.LIMIT, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    if limit < 1 or offset < 0:
+        return jsonify({'error': 'limit must be positive and offset not negative'}), 400
+    try:
+        return jsonify(search.search(get_db(), USE_POSTGRESQL, request.args.get('q', ''), min(limit, search.MAX_LIMIT), offset))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
 @app.route('/api/shipments', methods=['GET', 'POST', 'OPTIONS'])
 def handle_shipments():
     if request.method == 'OPTIONS':
@@ -734,20 +1114,8 @@ def handle_shipments():
 
 def get_shipments():
     status = request.args.get('status')
-    db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        if status and status != 'all':
-            cursor.execute('SELECT * FROM shipments WHERE status = %s ORDER BY date_created DESC', (status,))
-        else:
-            cursor.execute('SELECT * FROM shipments ORDER BY date_created DESC')
-        shipments = cursor.fetchall()
-    else:
-        if status and status != 'all':
-            shipments = db.execute('SELECT * FROM shipments WHERE status = ? ORDER BY date_created DESC', (status,)).fetchall()
-        else:
-            shipments = db.execute('SELECT * FROM shipments ORDER BY date_created DESC').fetchall()
-    return jsonify([dict(row) for row in shipments])
+    shipments = repositories.list_shipments(get_db(), status if status != 'all' else None)
+    return jsonify(repositories.as_dicts(shipments))
 
 def create_shipment():
     data = request.get_json()
@@ -767,94 +1135,52 @@ def create_shipment():
         status = 'pending_confirmation'
         tracking_number = None
 
-    # Simple approach - just insert and get the ID
     db = get_db()
-    cursor = db.cursor()
+    # Filled in from the distance matrix and lane history when the client left it empty
+    expected_delivery = data.get('expected_delivery') or eta.expected_delivery(db, USE_POSTGRESQL, data['origin'], data['destination'], data.get('service'))
+    shipment = {
+        'tracking_number': tracking_number,
+        'shipper_name': data['shipper_name'],
+        'shipper_address': data.get('shipper_address', ''),
+        'shipper_phone': data.get('shipper_phone', ''),
+        'shipper_email': data.get('shipper_email', ''),
+        'receiver_name': data['receiver_name'],
+        'receiver_address': data.get('receiver_address', ''),
+        'receiver_phone': data.get('receiver_phone', ''),
+        'receiver_email': data.get('receiver_email', ''),
+        'origin': data['origin'],
+        'destination': data.get('destination', ''),
+        'status': status,
+        'packages': data.get('packages', 1),
+        'total_weight': data.get('total_weight', 0),
+        'product': data.get('product', ''),
+        'quantity': data.get('quantity', 1),
+        'payment_mode': data.get('payment_mode', 'Cash'),
+        'total_freight': data.get('total_freight', 0),
+        'expected_delivery': expected_delivery,
+        'departure_time': data.get('departure_time', ''),
+        'pickup_date': data.get('pickup_date', ''),
+        'pickup_time': data.get('pickup_time', ''),
+        'comments': data.get('comments', ''),
+        'date_created': datetime.now().strftime('%Y-%m-%d')
+    }
 
     try:
-        if USE_POSTGRESQL:
-            cursor.execute('''INSERT INTO shipments (
-                tracking_number, shipper_name, shipper_address, shipper_phone, shipper_email,
-                receiver_name, receiver_address, receiver_phone, receiver_email,
-                origin, destination, status, packages, total_weight, product, quantity,
-                payment_mode, total_freight, expected_delivery, departure_time,
-                pickup_date, pickup_time, comments, date_created
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id''',
-            (
-                tracking_number, data['shipper_name'], data.get('shipper_address', ''), data.get('shipper_phone', ''), data.get('shipper_email', ''),
-                data['receiver_name'], data.get('receiver_address', ''), data.get('receiver_phone', ''), data.get('receiver_email', ''),
-                data['origin'], data.get('destination', ''), status, data.get('packages', 1), data.get('total_weight', 0), data.get('product', ''),
-                data.get('quantity', 1), data.get('payment_mode', 'Cash'), data.get('total_freight', 0), data.get('expected_delivery', ''),
-                data.get('departure_time', ''), data.get('pickup_date', ''), data.get('pickup_time', ''), data.get('comments', ''),
-                datetime.now().strftime('%Y-%m-%d')
-            ))
-            result = cursor.fetchone()
-            shipment_id = result['id'] if result else None
-        else:
-            cursor.execute('''INSERT INTO shipments (
-                tracking_number, shipper_name, shipper_address, shipper_phone, shipper_email,
-                receiver_name, receiver_address, receiver_phone, receiver_email,
-                origin, destination, status, packages, total_weight, product, quantity,
-                payment_mode, total_freight, expected_delivery, departure_time,
-                pickup_date, pickup_time, comments, date_created
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-            (
-                tracking_number, data['shipper_name'], data.get('shipper_address', ''), data.get('shipper_phone', ''), data.get('shipper_email', ''),
-                data['receiver_name'], data.get('receiver_address', ''), data.get('receiver_phone', ''), data.get('receiver_email', ''),
-                data['origin'], data.get('destination', ''), status, data.get('packages', 1), data.get('total_weight', 0), data.get('product', ''),
-                data.get('quantity', 1), data.get('payment_mode', 'Cash'), data.get('total_freight', 0), data.get('expected_delivery', ''),
-                data.get('departure_time', ''), data.get('pickup_date', ''), data.get('pickup_time', ''), data.get('comments', ''),
-                datetime.now().strftime('%Y-%m-%d')
-            ))
-            shipment_id = cursor.lastrowid
-
-        db.commit()
+        shipment_id = repositories.insert_shipment(db, shipment)
+        if is_admin_request:
+            # Created already confirmed: billed in the same transaction
+            invoices.issue(db, shipment_id)
 
+        # The shipment, its invoice and its first event are committed together
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         if is_admin_request:
-            if USE_POSTGRESQL:
-                cursor = db.cursor()
-                cursor.execute('INSERT INTO tracking_history (shipment_id, date_time, location, status, description, latitude, longitude) VALUES (%s, %s, %s, %s, %s, %s, %s)',
-                               (shipment_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'Admin Office', 'processing', 'Shipment created by admin and ready for processing', 48.8566, 2.3522))
-            else:
-                db.execute('INSERT INTO tracking_history (shipment_id, date_time, location, status, description, latitude, longitude) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                           (shipment_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'Admin Office', 'processing', 'Shipment created by admin and ready for processing', 48.8566, 2.3522))
+            repositories.add_event(db, shipment_id, now, 'Admin Office', 'processing', 'Shipment created by admin and ready for processing', 48.8566, 2.3522)
         else:
-            if USE_POSTGRESQL:
-                cursor = db.cursor()
-                cursor.execute('INSERT INTO tracking_history (shipment_id, date_time, location, status, description, latitude, longitude) VALUES (%s, %s, %s, %s, %s, %s, %s)',
-                               (shipment_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'Origin Facility', 'pending_confirmation', 'Package received and awaiting admin confirmation', 48.8566, 2.3522))
-            else:
-                db.execute('INSERT INTO tracking_history (shipment_id, date_time, location, status, description, latitude, longitude) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                           (shipment_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'Origin Facility', 'pending_confirmation', 'Package received and awaiting admin confirmation', 48.8566, 2.3522))
+            repositories.add_event(db, shipment_id, now, 'Origin Facility', 'pending_confirmation', 'Package received and awaiting admin confirmation', 48.8566, 2.3522)
         db.commit()
+        autocomplete.notify_change()
 
-        return jsonify({
-            'id': shipment_id,
-            'tracking_number': tracking_number,
-            'shipper_name': data['shipper_name'],
-            'shipper_address': data.get('shipper_address', ''),
-            'shipper_phone': data.get('shipper_phone', ''),
-            'shipper_email': data.get('shipper_email', ''),
-            'receiver_name': data['receiver_name'],
-            'receiver_address': data.get('receiver_address', ''),
-            'receiver_phone': data.get('receiver_phone', ''),
-            'receiver_email': data.get('receiver_email', ''),
-            'origin': data['origin'],
-            'destination': data.get('destination', ''),
-            'status': status,
-            'packages': data.get('packages', 1),
-            'total_weight': data.get('total_weight', 0),
-            'product': data.get('product', ''),
-            'quantity': data.get('quantity', 1),
-            'payment_mode': data.get('payment_mode', 'Cash'),
-            'total_freight': data.get('total_freight', 0),
-            'expected_delivery': data.get('expected_delivery', ''),
-            'departure_time': data.get('departure_time', ''),
-            'pickup_date': data.get('pickup_date', ''),
-            'pickup_time': data.get('pickup_time', ''),
-            'comments': data.get('comments', ''),
-            'date_created': datetime.now().strftime('%Y-%m-%d')
-        })
+        return jsonify(dict(shipment, id=shipment_id))
     except Exception as e:
         db.rollback()
         print(f"Error creating shipment: {e}")
@@ -862,59 +1188,50 @@ def create_shipment():
         traceback.print_exc()
         return jsonify({'error': 'Internal server error', 'details': str(e)}), 500
 
-@app.route('/api/shipments/<int:id>', methods=['PUT', 'DELETE', 'OPTIONS'])
+@app.route('/api/shipments/<int:id>', methods=['PUT', 'PATCH', 'DELETE', 'OPTIONS'])
 def handle_shipment(id):
     if request.method == 'OPTIONS':
         return jsonify({'status': 'success'}), 200
     elif request.method == 'PUT':
         return update_shipment(id)
+    elif request.method == 'PATCH':
+        return patch_row('shipments', id, 'Shipment')
     elif request.method == 'DELETE':
         return delete_shipment(id)
 
 def update_shipment(id):
     data = request.get_json()
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('''UPDATE shipments SET
-            shipper_name = %s, shipper_address = %s, shipper_phone = %s, shipper_email = %s,
-            receiver_name = %s, receiver_address = %s, receiver_phone = %s, receiver_email = %s,
-            origin = %s, destination = %s, status = %s, packages = %s, total_weight = %s,
-            product = %s, quantity = %s, payment_mode = %s, total_freight = %s,
-            expected_delivery = %s, departure_time = %s, pickup_date = %s, pickup_time = %s, comments = %s
-            WHERE id = %s''',
-        (
-            data.get('shipper_name', ''), data.get('shipper_address', ''), data.get('shipper_phone', ''), data.get('shipper_email', ''),
-            data.get('receiver_name', ''), data.get('receiver_address', ''), data.get('receiver_phone', ''), data.get('receiver_email', ''),
-            data.get('origin', ''), data.get('destination', ''), data.get('status', 'processing'), data.get('packages', 1), data.get('total_weight', 0),
-            data.get('product', ''), data.get('quantity', 1), data.get('payment_mode', 'Cash'), data.get('total_freight', 0),
-            data.get('expected_delivery', ''), data.get('departure_time', ''), data.get('pickup_date', ''), data.get('pickup_time', ''), data.get('comments', ''), id
-        ))
-    else:
-        db.execute('''UPDATE shipments SET
-            shipper_name = ?, shipper_address = ?, shipper_phone = ?, shipper_email = ?,
-            receiver_name = ?, receiver_address = ?, receiver_phone = ?, receiver_email = ?,
-            origin = ?, destination = ?, status = ?, packages = ?, total_weight = ?,
-            product = ?, quantity = ?, payment_mode = ?, total_freight = ?,
-            expected_delivery = ?, departure_time = ?, pickup_date = ?, pickup_time = ?, comments = ?
-            WHERE id = ?''',
-        (
-            data.get('shipper_name', ''), data.get('shipper_address', ''), data.get('shipper_phone', ''), data.get('shipper_email', ''),
-            data.get('receiver_name', ''), data.get('receiver_address', ''), data.get('receiver_phone', ''), data.get('receiver_email', ''),
-            data.get('origin', ''), data.get('destination', ''), data.get('status', 'processing'), data.get('packages', 1), data.get('total_weight', 0),
-            data.get('product', ''), data.get('quantity', 1), data.get('payment_mode', 'Cash'), data.get('total_freight', 0),
-            data.get('expected_delivery', ''), data.get('departure_time', ''), data.get('pickup_date', ''), data.get('pickup_time', ''), data.get('comments', ''), id
-        ))
+    repositories.update_shipment(db, id, {
+        'shipper_name': data.get('shipper_name', ''),
+        'shipper_address': data.get('shipper_address', ''),
+        'shipper_phone': data.get('shipper_phone', ''),
+        'shipper_email': data.get('shipper_email', ''),
+        'receiver_name': data.get('receiver_name', ''),
+        'receiver_address': data.get('receiver_address', ''),
+        'receiver_phone': data.get('receiver_phone', ''),
+        'receiver_email': data.get('receiver_email', ''),
+        'origin': data.get('origin', ''),
+        'destination': data.get('destination', ''),
+        'status': data.get('status', 'processing'),
+        'packages': data.get('packages', 1),
+        'total_weight': data.get('total_weight', 0),
+        'product': data.get('product', ''),
+        'quantity': data.get('quantity', 1),
+        'payment_mode': data.get('payment_mode', 'Cash'),
+        'total_freight': data.get('total_freight', 0),
+        'expected_delivery': data.get('expected_delivery', ''),
+        'departure_time': data.get('departure_time', ''),
+        'pickup_date': data.get('pickup_date', ''),
+        'pickup_time': data.get('pickup_time', ''),
+        'comments': data.get('comments', '')
+    })
     db.commit()
     return jsonify({'message': 'Shipment updated'})
 
 def delete_shipment(id):
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('DELETE FROM shipments WHERE id = %s', (id,))
-    else:
-        db.execute('DELETE FROM shipments WHERE id = ?', (id,))
+    repositories.delete_shipment(db, id)
     db.commit()
     return jsonify({'message': 'Shipment deleted'})
 
@@ -928,14 +1245,7 @@ def handle_users():
         return create_user()
 
 def get_users():
-    db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('SELECT * FROM users ORDER BY name')
-        users = cursor.fetchall()
-    else:
-        users = db.execute('SELECT * FROM users ORDER BY name').fetchall()
-    return jsonify([dict(row) for row in users])
+    return jsonify(repositories.as_dicts(repositories.users.list(get_db())))
 
 def create_user():
     data = request.get_json()
@@ -948,49 +1258,33 @@ def create_user():
 
     db = get_db()
     try:
-        if USE_POSTGRESQL:
-            cursor = db.cursor()
-            cursor.execute('INSERT INTO users (name, email, password, role, branch, status, created_at) VALUES (%s, %s, %s, %s, %s, %s, %s)',
-                           (name, email, password, data.get('role', 'user'), data.get('branch', ''), data.get('status', 'active'), datetime.now().isoformat()))
-            user_id = cursor.fetchone()[0] if cursor.description else cursor.lastrowid
-        else:
-            cursor = db.execute('INSERT INTO users (name, email, password, role, branch, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                               (name, email, password, data.get('role', 'user'), data.get('branch', ''), data.get('status', 'active'), datetime.now().isoformat()))
-            user_id = cursor.lastrowid
+        user_id = repositories.users.insert(db, (name, email, password, data.get('role', 'user'), data.get('branch', ''), data.get('status', 'active'), datetime.now().isoformat()))
         db.commit()
         return jsonify({'id': user_id, 'name': name, 'email': email, 'role': data.get('role', 'user'), 'branch': data.get('branch', ''), 'status': data.get('status', 'active'), 'created_at': datetime.now().isoformat()})
     except (sqlite3.IntegrityError, psycopg2.IntegrityError):
         return jsonify({'error': 'User with this email already exists'}), 400
 
-@app.route('/api/users/<int:id>', methods=['PUT', 'DELETE', 'OPTIONS'])
+@app.route('/api/users/<int:id>', methods=['PUT', 'PATCH', 'DELETE', 'OPTIONS'])
 def handle_user(id):
     if request.method == 'OPTIONS':
         return jsonify({'status': 'success'}), 200
     elif request.method == 'PUT':
         return update_user(id)
+    elif request.method == 'PATCH':
+        return patch_row('users', id, 'User')
     elif request.method == 'DELETE':
         return delete_user(id)
 
 def update_user(id):
     data = request.get_json()
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('UPDATE users SET name = %s, email = %s, password = %s, role = %s, branch = %s, status = %s WHERE id = %s',
-                       (data['name'], data['email'], data.get('password', ''), data['role'], data['branch'], data['status'], id))
-    else:
-        db.execute('UPDATE users SET name = ?, email = ?, password = ?, role = ?, branch = ?, status = ? WHERE id = ?',
-                   (data['name'], data['email'], data.get('password', ''), data['role'], data['branch'], data['status'], id))
+    repositories.users.update(db, id, (data['name'], data['email'], data.get('password', ''), data['role'], data['branch'], data['status']))
     db.commit()
     return jsonify({'message': 'User updated'})
 
 def delete_user(id):
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('DELETE FROM users WHERE id = %s', (id,))
-    else:
-        db.execute('DELETE FROM users WHERE id = ?', (id,))
+    repositories.users.delete(db, id)
     db.commit()
     return jsonify({'message': 'User deleted'})
 
@@ -998,7 +1292,7 @@ def delete_user(id):
 def login():
     if request.method == 'OPTIONS':
         return jsonify({'status': 'success'}), 200
-    
+
     data = request.get_json()
     email = data.get('email')
     password = data.get('password')
@@ -1007,19 +1301,10 @@ def login():
         return jsonify({'error': 'Email and password are required'}), 400
 
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('SELECT * FROM users WHERE email = %s AND password = %s', (email, password))
-        user = cursor.fetchone()
-    else:
-        user = db.execute('SELECT * FROM users WHERE email = ? AND password = ?', (email, password)).fetchone()
+    user = repositories.find_user(db, email, password)
 
     if user:
-        if USE_POSTGRESQL:
-            cursor = db.cursor()
-            cursor.execute('UPDATE users SET last_login = %s WHERE id = %s', (datetime.now().isoformat(), user['id']))
-        else:
-            db.execute('UPDATE users SET last_login = ? WHERE id = ?', (datetime.now().isoformat(), user['id']))
+        repositories.record_login(db, user['id'], datetime.now().isoformat())
         db.commit()
         return jsonify({
             'id': user['id'],
@@ -1036,7 +1321,7 @@ def login():
 def register():
     if request.method == 'OPTIONS':
         return jsonify({'status': 'success'}), 200
-    
+
     data = request.get_json()
     name = data.get('name')
     email = data.get('email')
@@ -1047,15 +1332,7 @@ def register():
 
     db = get_db()
     try:
-        if USE_POSTGRESQL:
-            cursor = db.cursor()
-            cursor.execute('INSERT INTO users (name, email, password, role, status, created_at) VALUES (%s, %s, %s, %s, %s, %s)',
-                           (name, email, password, 'user', 'active', datetime.now().isoformat()))
-            user_id = cursor.fetchone()[0] if cursor.description else cursor.lastrowid
-        else:
-            cursor = db.execute('INSERT INTO users (name, email, password, role, status, created_at) VALUES (?, ?, ?, ?, ?, ?)',
-                               (name, email, password, 'user', 'active', datetime.now().isoformat()))
-            user_id = cursor.lastrowid
+        user_id = repositories.users.insert(db, (name, email, password, 'user', None, 'active', datetime.now().isoformat()))
         db.commit()
         return jsonify({
             'id': user_id,
@@ -1071,28 +1348,38 @@ def register():
 def track_shipment(tracking_number):
     if request.method == 'OPTIONS':
         return jsonify({'status': 'success'}), 200
-    
+
+    stamp = conditional.track_stamp(get_db(), USE_POSTGRESQL, tracking_number)
+
+    def build():
+        payload = track_cache.get_or_load((tracking_number, stamp['version'] if stamp else None),
+                                          lambda payload: [('shipments', payload['shipment']['id'])],
+                                          lambda: load_tracking(tracking_number))
+        if payload is None:
+            return jsonify({'error': 'Shipment not found'}), 404
+        return jsonify(payload)
+    return conditional.respond('track', stamp, build, conditional.TRACK_CACHE_CONTROL)
+
+def load_tracking(tracking_number):
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('SELECT * FROM shipments WHERE tracking_number = %s', (tracking_number,))
-        shipment = cursor.fetchone()
-    else:
-        shipment = db.execute('SELECT * FROM shipments WHERE tracking_number = ?', (tracking_number,)).fetchone()
+    shipment = repositories.shipment_by_tracking_number(db, tracking_number)
     if not shipment:
-        return jsonify({'error': 'Shipment not found'}), 404
+        return None
 
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('SELECT date_time, location, status, description, latitude, longitude FROM tracking_history WHERE shipment_id = %s ORDER BY date_time DESC', (shipment['id'],))
-        history = cursor.fetchall()
+    history = repositories.tracked_history(db, shipment['id'])
+
+    # Closed shipments may have had their history moved to the archive
+    if shipment['status'] in history_archive.CLOSED_STATUSES:
+        archived = history_archive.archived_events(db, USE_POSTGRESQL, shipment['id'])
+        history = history_archive.merge_history(history, archived, repositories.EVENT_COLUMNS)
     else:
-        history = db.execute('SELECT date_time, location, status, description, latitude, longitude FROM tracking_history WHERE shipment_id = ? ORDER BY date_time DESC', (shipment['id'],)).fetchall()
+        history = repositories.as_dicts(history)
 
-    return jsonify({
-        'shipment': dict(shipment),
-        'history': [dict(row) for row in history]
-    })
+    return {
+        'shipment': repositories.as_dict(shipment),
+        'current': current_state.fetch(db, USE_POSTGRESQL, shipment['id']),
+        'history': history
+    }
 
 @app.route('/api/tracking-history/<int:shipment_id>', methods=['GET', 'POST', 'OPTIONS'])
 def handle_tracking_history(shipment_id):
@@ -1105,13 +1392,11 @@ def handle_tracking_history(shipment_id):
 
 def get_tracking_history(shipment_id):
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('SELECT * FROM tracking_history WHERE shipment_id = %s ORDER BY date_time DESC', (shipment_id,))
-        history = cursor.fetchall()
-    else:
-        history = db.execute('SELECT * FROM tracking_history WHERE shipment_id = ? ORDER BY date_time DESC', (shipment_id,)).fetchall()
-    return jsonify([dict(row) for row in history])
+    history = repositories.as_dicts(repositories.history(db, shipment_id))
+    archived = history_archive.archived_events(db, USE_POSTGRESQL, shipment_id)
+    if archived:
+        history = history_archive.merge_history(history, archived)
+    return jsonify(history)
 
 def add_tracking_history(shipment_id):
     data = request.get_json()
@@ -1126,82 +1411,90 @@ def add_tracking_history(shipment_id):
         return jsonify({'error': 'Location and status are required'}), 400
 
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('INSERT INTO tracking_history (shipment_id, date_time, location, status, description, latitude, longitude) VALUES (%s, %s, %s, %s, %s, %s, %s)',
-                       (shipment_id, date_time, location, status, description, latitude, longitude))
-        history_id = cursor.fetchone()[0] if cursor.description else cursor.lastrowid
-    else:
-        cursor = db.execute('INSERT INTO tracking_history (shipment_id, date_time, location, status, description, latitude, longitude) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                           (shipment_id, date_time, location, status, description, latitude, longitude))
-        history_id = cursor.lastrowid
-    db.commit()
-
+    history_id = repositories.add_event(db, shipment_id, date_time, location, status, description, latitude, longitude)
     if status in ['pending_confirmation', 'processing', 'picked_up', 'in_transit', 'delivered', 'delayed', 'rejected']:
-        if USE_POSTGRESQL:
-            cursor = db.cursor()
-            cursor.execute('UPDATE shipments SET status = %s WHERE id = %s', (status, shipment_id))
-        else:
-            db.execute('UPDATE shipments SET status = ? WHERE id = ?', (status, shipment_id))
-        db.commit()
+        repositories.set_shipment_status(db, shipment_id, status)
+    db.commit()
 
     return jsonify({'id': history_id, 'shipment_id': shipment_id, 'date_time': date_time, 'location': location, 'status': status, 'description': description, 'latitude': latitude, 'longitude': longitude})
 
-@app.route('/api/tracking-history/<int:history_id>', methods=['PUT', 'DELETE', 'OPTIONS'])
+@app.route('/api/tracking-history/<int:history_id>', methods=['PUT', 'PATCH', 'DELETE', 'OPTIONS'])
 def handle_tracking_history_item(history_id):
     if request.method == 'OPTIONS':
         return jsonify({'status': 'success'}), 200
     elif request.method == 'PUT':
         return update_tracking_history(history_id)
+    elif request.method == 'PATCH':
+        return patch_row('tracking_history', history_id, 'Tracking history entry', sync_shipment_status)
     elif request.method == 'DELETE':
         return delete_tracking_history(history_id)
 
 def update_tracking_history(history_id):
     data = request.get_json()
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('UPDATE tracking_history SET date_time = %s, location = %s, status = %s, description = %s, latitude = %s, longitude = %s WHERE id = %s',
-                       (data['date_time'], data['location'], data['status'], data['description'], data.get('latitude'), data.get('longitude'), history_id))
-    else:
-        db.execute('UPDATE tracking_history SET date_time = ?, location = ?, status = ?, description = ?, latitude = ?, longitude = ? WHERE id = ?',
-                   (data['date_time'], data['location'], data['status'], data['description'], data.get('latitude'), data.get('longitude'), history_id))
+    repositories.update_event(db, history_id, data['date_time'], data['location'], data['status'], data['description'], data.get('latitude'), data.get('longitude'))
     db.commit()
 
     if 'status' in data and data['status'] in ['pending_confirmation', 'processing', 'picked_up', 'in_transit', 'delivered', 'delayed', 'rejected']:
-        if USE_POSTGRESQL:
-            cursor = db.cursor()
-            cursor.execute('SELECT shipment_id FROM tracking_history WHERE id = %s', (history_id,))
-            shipment_id = cursor.fetchone()['shipment_id']
-            cursor.execute('UPDATE shipments SET status = %s WHERE id = %s', (data['status'], shipment_id))
-        else:
-            shipment_id = db.execute('SELECT shipment_id FROM tracking_history WHERE id = ?', (history_id,)).fetchone()['shipment_id']
-            db.execute('UPDATE shipments SET status = ? WHERE id = ?', (data['status'], shipment_id))
+        repositories.set_shipment_status(db, repositories.event_shipment(db, history_id), data['status'])
         db.commit()
 
     return jsonify({'message': 'Tracking history updated'})
 
+def sync_shipment_status(db, history):
+    # Same rule as the PUT route: a status edit on an event moves its shipment too
+    if history['status'] in ['pending_confirmation', 'processing', 'picked_up', 'in_transit', 'delivered', 'delayed', 'rejected']:
+        repositories.set_shipment_status(db, history['shipment_id'], history['status'])
+
+def patch_row(table, id, label, after_update=None):
+    # Partial update guarded by If-Match / "version"; responds with the updated row and its ETag
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'A JSON object is required'}), 400
+    columns, unknown = partial_update.patch_columns(table, data)
+    if unknown:
+        return jsonify({'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+    if not columns:
+        return jsonify({'error': 'No fields to update'}), 400
+    invalid = partial_update.invalid_value(table, columns, data)
+    if invalid:
+        return jsonify({'error': invalid}), 400
+    try:
+        version = partial_update.expected_version(request.headers.get('If-Match'), data)
+    except ValueError:
+        return jsonify({'error': 'Invalid version'}), 400
+
+    db = get_db()
+    try:
+        outcome, value = partial_update.apply_patch(db, USE_POSTGRESQL, table, id, columns, data, version)
+        if outcome == 'updated' and after_update and 'status' in columns:
+            after_update(db, value)
+        db.commit()
+    except (sqlite3.IntegrityError, psycopg2.IntegrityError) as e:
+        db.rollback()
+        return jsonify({'error': f'{label} not updated: {e}'}), 400
+
+    if outcome == 'missing':
+        return jsonify({'error': f'{label} not found'}), 404
+    if outcome == 'conflict':
+        response = jsonify({'error': f'{label} was modified by someone else', 'version': value})
+        response.headers['ETag'] = partial_update.etag(value)
+        return response, 409
+    response = jsonify(value)
+    response.headers['ETag'] = partial_update.etag(value['version'])
+    return response
+
 def delete_tracking_history(history_id):
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('DELETE FROM tracking_history WHERE id = %s', (history_id,))
-    else:
-        db.execute('DELETE FROM tracking_history WHERE id = ?', (history_id,))
+    repositories.delete_event(db, history_id)
     db.commit()
     return jsonify({'message': 'Tracking history deleted'})
 
 def get_shipment_progress(shipment_id):
-    db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('SELECT * FROM shipment_progress WHERE shipment_id = %s ORDER BY last_updated DESC LIMIT 1', (shipment_id,))
-        progress = cursor.fetchone()
-    else:
-        progress = db.execute('SELECT * FROM shipment_progress WHERE shipment_id = ? ORDER BY last_updated DESC LIMIT 1', (shipment_id,)).fetchone()
+    progress = repositories.progress(get_db(), shipment_id)
 
     if progress:
-        return jsonify(dict(progress))
+        return jsonify(repositories.as_dict(progress))
     else:
         # Return default progress if none exists
         return jsonify({
@@ -1219,33 +1512,7 @@ def update_shipment_progress(shipment_id):
     current_lng = data.get('current_lng')
 
     db = get_db()
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        # Insert or update progress
-        cursor.execute('''
-            INSERT INTO shipment_progress (shipment_id, progress, current_lat, current_lng, last_updated)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (shipment_id) DO UPDATE SET
-                progress = EXCLUDED.progress,
-                current_lat = EXCLUDED.current_lat,
-                current_lng = EXCLUDED.current_lng,
-                last_updated = EXCLUDED.last_updated
-        ''', (shipment_id, progress, current_lat, current_lng, datetime.now().isoformat()))
-    else:
-        # For SQLite, we need to handle upsert differently
-        existing = db.execute('SELECT id FROM shipment_progress WHERE shipment_id = ?', (shipment_id,)).fetchone()
-        if existing:
-            db.execute('''
-                UPDATE shipment_progress SET
-                    progress = ?, current_lat = ?, current_lng = ?, last_updated = ?
-                WHERE shipment_id = ?
-            ''', (progress, current_lat, current_lng, datetime.now().isoformat(), shipment_id))
-        else:
-            db.execute('''
-                INSERT INTO shipment_progress (shipment_id, progress, current_lat, current_lng, last_updated)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (shipment_id, progress, current_lat, current_lng, datetime.now().isoformat()))
-
+    repositories.save_progress(db, shipment_id, progress, current_lat, current_lng, datetime.now().isoformat())
     db.commit()
     return jsonify({'message': 'Progress updated', 'progress': progress})
 
@@ -1253,78 +1520,148 @@ def update_shipment_progress(shipment_id):
 def confirm_shipment(id):
     if request.method == 'OPTIONS':
         return jsonify({'status': 'success'}), 200
-    
+
     data = request.get_json()
     db = get_db()
 
     import random
     tracking_number = f'SHIP{random.randint(100000000000, 999999999999)}-COLISSELECT'
 
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('''UPDATE shipments SET
-            tracking_number = %s,
-            status = 'processing',
-            total_freight = %s,
-            expected_delivery = %s,
-            comments = %s
-            WHERE id = %s''',
-            (tracking_number, data.get('total_freight', 0), data.get('expected_delivery', ''), data.get('comments', ''), id))
-    else:
-        db.execute('''UPDATE shipments SET
-            tracking_number = ?,
-            status = 'processing',
-            total_freight = ?,
-            expected_delivery = ?,
-            comments = ?
-            WHERE id = ?''',
-            (tracking_number, data.get('total_freight', 0), data.get('expected_delivery', ''), data.get('comments', ''), id))
-    db.commit()
+    expected_delivery = data.get('expected_delivery', '')
+    if not expected_delivery:
+        shipment = repositories.shipment_route(db, id)
+        if shipment:
+            expected_delivery = eta.expected_delivery(db, USE_POSTGRESQL, shipment['origin'], shipment['destination'], data.get('service'))
 
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('INSERT INTO tracking_history (shipment_id, date_time, location, status, description, latitude, longitude) VALUES (%s, %s, %s, %s, %s, %s, %s)',
-                       (id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'Admin Office', 'processing', 'Shipment confirmed and being processed', 48.8566, 2.3522))
-    else:
-        db.execute('INSERT INTO tracking_history (shipment_id, date_time, location, status, description, latitude, longitude) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                   (id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'Admin Office', 'processing', 'Shipment confirmed and being processed', 48.8566, 2.3522))
+    # The freight, its invoice and the confirmation event are committed together
+    repositories.confirm_shipment(db, id, tracking_number, data.get('total_freight', 0), expected_delivery, data.get('comments', ''))
+    invoices.issue(db, id)
+    repositories.add_event(db, id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'Admin Office', 'processing', 'Shipment confirmed and being processed', 48.8566, 2.3522)
     db.commit()
 
     print(f"EMAIL NOTIFICATION: Shipment {id} confirmed with tracking number {tracking_number}. Email to shipper.")
 
-    return jsonify({'message': 'Shipment confirmed', 'tracking_number': tracking_number})
+    return jsonify({'message': 'Shipment confirmed', 'tracking_number': tracking_number, 'expected_delivery': expected_delivery})
 
 @app.route('/api/shipments/<int:id>/reject', methods=['POST', 'OPTIONS'])
 def reject_shipment(id):
     if request.method == 'OPTIONS':
         return jsonify({'status': 'success'}), 200
-    
+
     data = request.get_json()
     reason = data.get('reason', 'No reason provided')
     db = get_db()
 
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('UPDATE shipments SET status = %s, comments = %s WHERE id = %s',
-                       ('rejected', f'Rejected: {reason}', id))
-    else:
-        db.execute('UPDATE shipments SET status = ?, comments = ? WHERE id = ?',
-                   ('rejected', f'Rejected: {reason}', id))
-    db.commit()
-
-    if USE_POSTGRESQL:
-        cursor = db.cursor()
-        cursor.execute('INSERT INTO tracking_history (shipment_id, date_time, location, status, description, latitude, longitude) VALUES (%s, %s, %s, %s, %s, %s, %s)',
-                       (id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'Admin Office', 'rejected', f'Shipment rejected: {reason}', 48.8566, 2.3522))
-    else:
-        db.execute('INSERT INTO tracking_history (shipment_id, date_time, location, status, description, latitude, longitude) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                   (id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'Admin Office', 'rejected', f'Shipment rejected: {reason}', 48.8566, 2.3522))
+    repositories.set_shipment_status(db, id, 'rejected', f'Rejected: {reason}')
+    repositories.add_event(db, id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'Admin Office', 'rejected', f'Shipment rejected: {reason}', 48.8566, 2.3522)
     db.commit()
 
     print(f"EMAIL NOTIFICATION: Shipment {id} rejected. Reason: {reason}. Email to shipper.")
 
     return jsonify({'message': 'Shipment rejected'})
 
+@app.route('/api/invoices', methods=['GET', 'OPTIONS'])
+def list_invoices():
+    # ?status=pending|paid|overdue&q=<invoice or tracking number prefix>&limit=; the next
+    # page is requested with ?before=<next> from the previous response
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'success'}), 200
+    status = request.args.get('status') or None
+    if status == 'all':
+        status = None
+    if status is not None and status not in invoices.STATUS_FILTERS:
+        return jsonify({'error': f"status must be one of {', '.join(invoices.STATUS_FILTERS)}"}), 400
+    before = request.args.get('before', type=int)
+    if 'before' in request.args and (before is None or before < 1):
+        return jsonify({'error': 'Invalid before'}), 400
+    limit = request.args.get('limit', invoices.PAGE_SIZE, type=int)
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+    limit = min(limit, invoices.MAX_PAGE_SIZE)
+    return jsonify(invoices.page(get_db(), status, request.args.get('q', '').strip(), before, limit))
+
+@app.route('/api/invoices/summary', methods=['GET', 'OPTIONS'])
+def invoice_summary():
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'success'}), 200
+    return jsonify(invoices.summary(get_db()))
+
+@app.route('/api/changes', methods=['GET', 'OPTIONS'])
+def get_changes():
+    # ?since=<cursor from the previous call>; without it, every row from the beginning
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'success'}), 200
+    tables = tuple(request.args.get('tables', ','.join(change_feed.TRACKED_TABLES)).split(','))
+    unknown = [table for table in tables if table not in change_feed.TRACKED_TABLES]
+    if unknown:
+        return jsonify({'error': f"Unknown tables: {', '.join(unknown)}"}), 400
+    limit = request.args.get('limit', change_feed.PAGE_SIZE, type=int)
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+    limit = min(limit, change_feed.MAX_PAGE_SIZE)
+    try:
+        return jsonify(change_feed.read_changes(get_db(), USE_POSTGRESQL, request.args.get('since'), limit, tables))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    except change_feed.CursorExpired:
+        return jsonify({'error': 'Cursor expired, sync again without since'}), 410
+
+@app.route('/api/eta', methods=['GET', 'OPTIONS'])
+def get_eta():
+    # ?origin=&destination= as location names, slugs or coordinates; &service=economy|standard|express
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'success'}), 200
+    origin = request.args.get('origin', '')
+    destination = request.args.get('destination', '')
+    if not origin or not destination:
+        return jsonify({'error': 'origin and destination are required'}), 400
+    try:
+        return jsonify(eta.estimate(get_db(), USE_POSTGRESQL, origin, destination, request.args.get('service', eta.DEFAULT_SERVICE)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/autocomplete', methods=['GET', 'OPTIONS'])
+def get_autocomplete():
+    # ?q=<prefix of any word>&limit=&kinds=location,zone,address; served from memory
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'success'}), 200
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', autocomplete.LIMIT, type=int)
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+    kinds = tuple(request.args.get('kinds', ','.join(autocomplete.KINDS)).split(','))
+    unknown = [kind for kind in kinds if kind not in autocomplete.KINDS]
+    if unknown:
+        return jsonify({'error': f"Unknown kinds: {', '.join(unknown)}"}), 400
+    suggestions = autocomplete.suggest(app, get_db, USE_POSTGRESQL, query, min(limit, autocomplete.MAX_LIMIT), kinds)
+    if suggestions is None:
+        return jsonify({'error': 'Autocomplete index is still loading, retry shortly'}), 503
+    return jsonify({'query': query, 'suggestions': suggestions})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # Liveness only: the process is up and serving, no database round trip
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    # Readiness: a pooled connection can be acquired and answers a trivial query
+    try:
+        db = get_db()
+        if USE_POSTGRESQL:
+            cursor = db.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+        else:
+            db.execute('SELECT 1').fetchone()
+    except Exception as e:
+        return jsonify({'status': 'unavailable', 'error': str(e), 'pool': pool_stats()}), 503
+    return jsonify({'status': 'ready', 'schema_version': SCHEMA_VERSION, 'pool': pool_stats()})
+
 @app.route('/api/hello', methods=['GET', 'OPTIONS'])
 def hello():
     if request.method == 'OPTIONS':
@@ -1400,6 +1737,5 @@ def serve_frontend(path):
     return send_from_directory(app.static_folder, "index.html")
 
 if __name__ == '__main__':
-    init_db()
     port = int(os.environ.get("PORT", 8080))  # Railway expects 8080
     app.run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,311 @@
+# Optional ASGI entrypoint for the public read path (Postgres):
+#   uvicorn --app-dir backend asgi:application --host 0.0.0.0 --port $PORT --workers N
+# GET /api/track/<tracking_number>, GET /api/shipments/<id>/progress and GET /api/hello
+# are served by coroutines reading through an asyncpg pool of ASYNC_POOL_MAX
+# connections. A lookup waiting on the database holds a coroutine rather than a
+# thread, so one process keeps thousands of them in flight. Every other request, and
+# these paths with other methods, goes to the Flask app, run on WSGI_THREADS threads
+# like a gunicorn gthread worker.
+#
+# The async routes answer like their Flask versions: same payloads and status codes,
+# the shared track cache, ETag / Last-Modified / 304 and the CORS headers. They read
+# from the primary, so a client's own writes are visible without replica pinning.
+# With SQLite every request goes to Flask.
+import asyncio
+import contextvars
+import os
+import re
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+from io import BytesIO
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import asyncpg
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag
+
+import app as wsgi
+import conditional
+import current_state
+import history_archive
+import metrics
+import repositories
+
+ASYNC_POOL_MIN = int(os.environ.get('ASYNC_POOL_MIN', 1))
+ASYNC_POOL_MAX = int(os.environ.get('ASYNC_POOL_MAX', 20))
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', wsgi.DB_POOL_MAX))
+# libpq options asyncpg would otherwise send to the server as settings
+LIBPQ_ONLY_OPTIONS = ('channel_binding', 'connect_timeout')
+
+TRACK_STAMP = repositories.numbered(conditional.TRACK_STAMP.sql)
+SHIPMENT = repositories.numbered(repositories.SHIPMENT_BY_TRACKING_NUMBER.sql)
+TRACKED_HISTORY = repositories.numbered(repositories.TRACKED_HISTORY.sql)
+ARCHIVED_EVENTS = repositories.numbered(history_archive.ARCHIVED_EVENTS_SQL)
+CURRENT_STATE = repositories.numbered(current_state.FETCH_SQL)
+PROGRESS = repositories.numbered(repositories.PROGRESS.sql)
+
+pool = None
+pool_lock = asyncio.Lock()
+wsgi_threads = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='wsgi')
+
+# [seconds, queries] of the request being served; per task, unlike metrics.current
+request_db = contextvars.ContextVar('request_db', default=None)
+
+metrics.Gauge('tracksite_async_pool_in_use', 'asyncpg connections checked out',
+              lambda: pool.get_size() - pool.get_idle_size() if pool is not None else None)
+metrics.Gauge('tracksite_async_pool_max', 'asyncpg pool size limit', lambda: ASYNC_POOL_MAX if pool is not None else None)
+
+
+def async_dsn(url):
+    parts = urlsplit(url)
+    query = [(name, value) for name, value in parse_qsl(parts.query) if name not in LIBPQ_ONLY_OPTIONS]
+    return parts._replace(query=urlencode(query)).geturl()
+
+
+async def init_connection(db):
+    # REAL columns as psycopg2 reads them, from their text form: 45.2 rather than the
+    # float32 value widened to 45.20000076293945
+    await db.set_type_codec('float4', schema='pg_catalog', encoder=str, decoder=float, format='text')
+
+
+async def get_pool():
+    global pool
+    if pool is None:
+        async with pool_lock:
+            if pool is None:
+                # Schema check, maintenance and the cache bus, as on a gunicorn worker's first request
+                await asyncio.get_running_loop().run_in_executor(wsgi_threads, wsgi.start_services)
+                # asyncpg prepares statements itself; its cache is off behind a transaction pooler
+                pool = await asyncpg.create_pool(
+                    async_dsn(wsgi.DATABASE_URL), min_size=ASYNC_POOL_MIN, max_size=ASYNC_POOL_MAX,
+                    statement_cache_size=1024 if repositories.PREPARED_STATEMENTS else 0, init=init_connection)
+                print(f"asyncpg pool ready (pid {os.getpid()}, max {ASYNC_POOL_MAX} connections)")
+    return pool
+
+
+@asynccontextmanager
+async def connection():
+    started = time.perf_counter()
+    async with (await get_pool()).acquire() as db:
+        metrics.record_pool_wait(time.perf_counter() - started)
+        yield db
+
+
+async def fetch(db, sql, *params):
+    started = time.perf_counter()
+    try:
+        return await db.fetch(sql, *params)
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.record_query(sql, elapsed, params)
+        totals = request_db.get()
+        if totals is not None:
+            totals[0] += elapsed
+            totals[1] += 1
+
+
+async def fetch_one(db, sql, *params):
+    rows = await fetch(db, sql, *params)
+    return rows[0] if rows else None
+
+
+def json_response(payload, status=200, headers=()):
+    # As jsonify: sorted keys, compact, trailing newline
+    body = (wsgi.app.json.dumps(payload, separators=(',', ':')) + '\n').encode()
+    return status, [('Content-Type', 'application/json')] + list(headers), body
+
+
+async def track(headers, tracking_number):
+    # track_shipment and load_tracking in app.py
+    async with connection() as db:
+        stamp = await fetch_one(db, TRACK_STAMP, tracking_number)
+        validators = []
+        if stamp is not None:
+            tag, modified = conditional.etag('track', stamp), conditional.last_modified(stamp)
+            validators = [('ETag', quote_etag(tag)), ('Last-Modified', http_date(modified)),
+                          ('Cache-Control', conditional.TRACK_CACHE_CONTROL), ('Vary', 'Origin')]
+            if conditional.is_fresh(tag, modified, parse_etags(headers.get('if-none-match')),
+                                    parse_date(headers.get('if-modified-since'))):
+                return 304, validators, b''
+        payload = await wsgi.track_cache.get_or_load_async((tracking_number, stamp['version'] if stamp else None),
+                                                           lambda payload: [('shipments', payload['shipment']['id'])],
+                                                           lambda: load_tracking(db, tracking_number))
+    if payload is None:
+        return json_response({'error': 'Shipment not found'}, 404)
+    return json_response(payload, headers=validators)
+
+
+async def load_tracking(db, tracking_number):
+    shipment = await fetch_one(db, SHIPMENT, tracking_number)
+    if not shipment:
+        return None
+    history = await fetch(db, TRACKED_HISTORY, shipment['id'])
+    if shipment['status'] in history_archive.CLOSED_STATUSES:
+        row = await fetch_one(db, ARCHIVED_EVENTS, shipment['id'])
+        archived = history_archive.unpack_events(shipment['id'], row['events']) if row else []
+        history = history_archive.merge_history(history, archived, repositories.EVENT_COLUMNS)
+    else:
+        history = [dict(row) for row in history]
+    current = await fetch_one(db, CURRENT_STATE, shipment['id'])
+    return {
+        'shipment': dict(shipment),
+        'current': dict(current) if current is not None else None,
+        'history': history,
+    }
+
+
+async def progress(headers, shipment_id):
+    # GET of handle_shipment_progress
+    shipment_id = int(shipment_id)
+    async with connection() as db:
+        row = await fetch_one(db, PROGRESS, shipment_id)
+    if row:
+        return json_response(dict(row))
+    return json_response({
+        'shipment_id': shipment_id,
+        'progress': 0,
+        'current_lat': None,
+        'current_lng': None,
+        'last_updated': datetime.now().isoformat(),
+    })
+
+
+async def hello(headers):
+    return json_response({"message": "Hello from Flask!"})
+
+
+# (path, Flask endpoint name for the metrics, handler); GET only
+ROUTES = (
+    (re.compile(r'/api/track/(?P<tracking_number>[^/]+)'), 'track_shipment', track),
+    (re.compile(r'/api/shipments/(?P<shipment_id>\d+)/progress'), 'handle_shipment_progress', progress),
+    (re.compile(r'/api/hello'), 'hello', hello),
+)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    if wsgi.USE_POSTGRESQL and scope['method'] == 'GET':
+        for pattern, endpoint, handler in ROUTES:
+            match = pattern.fullmatch(scope['path'])
+            if match:
+                return await serve(scope, send, endpoint, handler, match.groupdict())
+    await call_flask(scope, receive, send)
+
+
+async def serve(scope, send, endpoint, handler, params):
+    started = time.perf_counter()
+    totals = [0.0, 0]
+    request_db.set(totals)
+    headers = {}
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        headers[name] = f'{headers[name]}, {value}' if name in headers else value
+    try:
+        status, response_headers, body = await handler(headers, **params)
+    except Exception:
+        traceback.print_exc()
+        status, response_headers, body = json_response({'error': 'Internal server error'}, 500)
+    response_headers += [('Content-Length', str(len(body))),
+                         ('Access-Control-Allow-Origin', wsgi.allowed_origin(headers.get('origin', '*')))]
+    response_headers += wsgi.CORS_RESPONSE_HEADERS.items()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response_headers]})
+    await send({'type': 'http.response.body', 'body': body})
+    metrics.http_latency.observe(time.perf_counter() - started, (endpoint, 'GET'))
+    metrics.http_requests.inc((endpoint, 'GET', status))
+    metrics.request_db_time.observe(totals[0], (endpoint,))
+    metrics.request_db_queries.observe(totals[1], (endpoint,))
+
+
+async def call_flask(scope, receive, send):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    status, headers, body = await asyncio.get_running_loop().run_in_executor(
+        wsgi_threads, run_wsgi, wsgi_environ(scope, b''.join(chunks)))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        if key in environ:
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ', ') + value
+        environ[key] = value
+    # The body was read whole, chunked or not
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+def run_wsgi(environ):
+    # On a wsgi thread. The response is buffered: the API answers with small documents.
+    started = []
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(' ', 1)[0]),
+                      [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]]
+        return chunks.append
+
+    result = wsgi.app(environ, start_response)
+    try:
+        chunks.extend(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return started[0], started[1], b''.join(chunks)
+
+
+async def lifespan(receive, send):
+    # Database work waits for the first request, as under gunicorn, so the port opens at once
+    global pool
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if pool is not None:
+                await pool.close()
+                pool = None
+            wsgi_threads.shutdown(wait=False)
+            wsgi.close_pool()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,265 @@
+# In-memory prefix index behind GET /api/autocomplete: location names, zone names and
+# the addresses, origins and destinations of past shipments, ranked by how often they
+# were used. Each worker builds it once from the change feed and then applies only what
+# changed since, from a background thread, so lookups never touch the database.
+#
+# Every word start of a term is a key of one sorted list, so "paix" finds
+# "12 rue de la Paix". Prefixes of up to TOP_PREFIX_LENGTH characters, whose ranges span
+# a large share of the list, keep their best terms precomputed.
+import bisect
+import heapq
+import os
+import re
+import threading
+import time
+import unicodedata
+
+import change_feed
+
+REFRESH_SECONDS = float(os.environ.get('AUTOCOMPLETE_REFRESH_SECONDS', 2))
+# Full rebuild period, dropping terms nobody uses any more
+REBUILD_SECONDS = int(os.environ.get('AUTOCOMPLETE_REBUILD_SECONDS', 6 * 3600))
+# How long a request waits for the first build of its worker
+WARMUP_WAIT_SECONDS = 5
+TOP_PREFIX_LENGTH = 3
+TOP_SIZE = 50
+# Keys examined at most for a longer prefix before ranking
+SCAN_LIMIT = 5000
+LIMIT = 10
+MAX_LIMIT = 50
+FEED_TABLES = ('shipments', 'locations', 'zones')
+# Display priority when a text is several kinds at once
+KINDS = ('location', 'zone', 'address')
+
+WORD_START = re.compile(r'(?:^|(?<=[\s,;/()\-]))\w', re.UNICODE)
+
+
+def normalize(text):
+    # Case, accents and spacing do not matter: "Château  d'Eau" == "chateau d'eau"
+    text = unicodedata.normalize('NFKD', str(text or ''))
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(text.lower().split())
+
+
+def word_suffixes(normalized):
+    return {normalized[match.start():] for match in WORD_START.finditer(normalized)}
+
+
+def row_terms(table, row):
+    # (kind, text) pairs one row contributes; each counts as one use
+    if table == 'locations':
+        return (('location', row['name']),)
+    if table == 'zones':
+        return (('zone', row['name']),)
+    return tuple(('address', row[column]) for column in ('shipper_address', 'receiver_address', 'origin', 'destination') if row.get(column))
+
+
+class PrefixIndex:
+    def __init__(self):
+        self.entries = []  # sorted (key, term id)
+        self.texts = []
+        self.uses = []  # per term: {kind: count}
+        self.weights = []
+        self.ids = {}  # normalized text -> term id
+        self.top = {}  # short prefix -> term ids, best first
+        self.contributions = {}  # (table, row id) -> terms it added
+        self.lock = threading.Lock()
+        self.bulk = True
+
+    def score(self, term_id):
+        uses = self.uses[term_id]
+        priority = min((KINDS.index(kind) for kind, count in uses.items() if count > 0), default=len(KINDS))
+        return (self.weights[term_id], -priority, self.texts[term_id])
+
+    def kind(self, term_id):
+        return min((kind for kind, count in self.uses[term_id].items() if count > 0), key=KINDS.index, default='address')
+
+    def add(self, kind, text, delta):
+        normalized = normalize(text)
+        if not normalized:
+            return
+        term_id = self.ids.get(normalized)
+        if term_id is None:
+            term_id = len(self.texts)
+            self.ids[normalized] = term_id
+            self.texts.append(' '.join(str(text).split()))
+            self.uses.append({})
+            self.weights.append(0)
+            for key in word_suffixes(normalized):
+                if self.bulk:
+                    self.entries.append((key, term_id))
+                else:
+                    bisect.insort(self.entries, (key, term_id))
+        self.uses[term_id][kind] = self.uses[term_id].get(kind, 0) + delta
+        self.weights[term_id] += delta
+        if not self.bulk:
+            for prefix in self.short_prefixes(normalized):
+                self.rerank(prefix, term_id, delta < 0)
+
+    @staticmethod
+    def short_prefixes(normalized):
+        return {key[:length] for key in word_suffixes(normalized) for length in range(1, TOP_PREFIX_LENGTH + 1) if len(key) >= length}
+
+    def rerank(self, prefix, term_id, decreased):
+        best = self.top.setdefault(prefix, [])
+        if decreased and term_id in best:
+            # Something outside the list may now outrank it: recompute from the range
+            self.top[prefix] = self.scan(prefix, TOP_SIZE)
+            return
+        if term_id not in best:
+            best.append(term_id)
+        best.sort(key=self.score, reverse=True)
+        del best[TOP_SIZE:]
+
+    def scan(self, prefix, limit):
+        seen = set()
+        position = bisect.bisect_left(self.entries, (prefix,))
+        end = min(position + SCAN_LIMIT, len(self.entries))
+        while position < end:
+            key, term_id = self.entries[position]
+            if not key.startswith(prefix):
+                break
+            if self.weights[term_id] > 0:
+                seen.add(term_id)
+            position += 1
+        return heapq.nlargest(limit, seen, key=self.score)
+
+    def apply(self, table, row_id, terms):
+        # Replaces what this row contributed before, so edits and deletes are not counted twice
+        for kind, text in self.contributions.pop((table, row_id), ()):
+            self.add(kind, text, -1)
+        for kind, text in terms:
+            self.add(kind, text, 1)
+        if terms:
+            self.contributions[(table, row_id)] = terms
+
+    def apply_changes(self, page):
+        with self.lock:
+            for table in FEED_TABLES:
+                for row in page['changes'].get(table, ()):
+                    self.apply(table, row['id'], row_terms(table, row))
+                for row_id in page['deleted'].get(table, ()):
+                    self.apply(table, row_id, ())
+
+    def finish_bulk(self):
+        # One sort and one ranking pass instead of an insort per key
+        self.entries.sort()
+        candidates = {}
+        for normalized, term_id in self.ids.items():
+            if self.weights[term_id] > 0:
+                for prefix in self.short_prefixes(normalized):
+                    candidates.setdefault(prefix, []).append(term_id)
+        self.top = {prefix: heapq.nlargest(TOP_SIZE, ids, key=self.score) for prefix, ids in candidates.items()}
+        self.bulk = False
+
+    def search(self, query, limit=LIMIT, kinds=KINDS):
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        with self.lock:
+            if len(prefix) <= TOP_PREFIX_LENGTH:
+                candidates = [term_id for term_id in self.top.get(prefix, ()) if self.weights[term_id] > 0]
+            else:
+                candidates = self.scan(prefix, limit if len(kinds) == len(KINDS) else SCAN_LIMIT)
+            results = []
+            for term_id in candidates:
+                kind = self.kind(term_id)
+                if kind in kinds:
+                    results.append({'text': self.texts[term_id], 'kind': kind, 'uses': self.weights[term_id]})
+                    if len(results) == limit:
+                        break
+            return results
+
+
+def read_all(db, postgres, since):
+    # Pages through the feed; returns the pages and the cursor after the last one
+    pages = []
+    while True:
+        page = change_feed.read_changes(db, postgres, since, change_feed.MAX_PAGE_SIZE, FEED_TABLES)
+        pages.append(page)
+        since = page['cursor']
+        if not page['has_more']:
+            return pages, since
+
+
+class Indexer(threading.Thread):
+    def __init__(self, app, get_db, postgres):
+        super().__init__(name='autocomplete', daemon=True)
+        self.app = app
+        self.get_db = get_db
+        self.postgres = postgres
+        self.stopping = threading.Event()
+        self.wake = threading.Event()
+        self.ready = threading.Event()
+        self.index = None
+        self.cursor = None
+        self.built_at = None
+
+    def build(self, db):
+        index = PrefixIndex()
+        pages, cursor = read_all(db, self.postgres, None)
+        for page in pages:
+            index.apply_changes(page)
+        index.finish_bulk()
+        self.index, self.cursor, self.built_at = index, cursor, time.monotonic()
+        self.ready.set()
+
+    def refresh(self, db):
+        if self.index is None or time.monotonic() - self.built_at > REBUILD_SECONDS:
+            self.build(db)
+            return
+        try:
+            pages, cursor = read_all(db, self.postgres, self.cursor)
+        except change_feed.CursorExpired:
+            self.build(db)
+            return
+        for page in pages:
+            self.index.apply_changes(page)
+        self.cursor = cursor
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                with self.app.app_context():
+                    self.refresh(self.get_db())
+            except Exception as e:
+                print(f"Autocomplete refresh failed: {e}")
+            self.wake.wait(REFRESH_SECONDS)
+            self.wake.clear()
+
+
+indexer = None
+indexer_lock = threading.Lock()
+
+
+def start(app, get_db, postgres):
+    # Started by the first autocomplete request of each worker
+    global indexer
+    with indexer_lock:
+        if indexer is None:
+            indexer = Indexer(app, get_db, postgres)
+            indexer.start()
+    return indexer
+
+
+def notify_change():
+    # Lets this worker's index pick up a write right away instead of at the next refresh
+    if indexer is not None:
+        indexer.wake.set()
+
+
+def stop():
+    global indexer
+    with indexer_lock:
+        if indexer is not None:
+            indexer.stopping.set()
+            indexer.wake.set()
+            indexer = None
+
+
+def suggest(app, get_db, postgres, query, limit=LIMIT, kinds=KINDS):
+    # None while the first build of this worker is still running
+    current = start(app, get_db, postgres)
+    if not current.ready.wait(WARMUP_WAIT_SECONDS):
+        return None
+    return current.index.search(query, limit, kinds)
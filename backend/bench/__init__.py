@@ -0,0 +1,4 @@
+# Benchmark tooling for the Flask backend
+#   python -m bench.datagen   - populate SQLite / Postgres with a synthetic dataset
+#   python -m bench.loadtest  - drive a running server and report latency per endpoint
+# Run from the backend/ directory.
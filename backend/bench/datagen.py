@@ -0,0 +1,223 @@
+# Synthetic dataset generator
+# Usage (from backend/):
+#   python -m bench.datagen --sqlite /tmp/bench.db --shipments 100000 --history 8
+#   python -m bench.datagen --database-url postgresql://localhost/tracksite_bench --shipments 100000
+# Writes a manifest (id range, tracking number format) that bench.loadtest reads.
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+CITIES = [
+    ('Paris', 48.8566, 2.3522),
+    ('Lyon', 45.7640, 4.8357),
+    ('Marseille', 43.2965, 5.3698),
+    ('Toulouse', 43.6047, 1.4442),
+    ('Nice', 43.7102, 7.2620),
+    ('Nantes', 47.2184, -1.5536),
+    ('Strasbourg', 48.5734, 7.7521),
+    ('Montpellier', 43.6108, 3.8767),
+    ('Bordeaux', 44.8378, -0.5792),
+    ('Lille', 50.6292, 3.0573),
+]
+
+# Share of shipments per final status, roughly what a mature deployment looks like
+STATUS_WEIGHTS = {
+    'delivered': 0.55,
+    'in_transit': 0.18,
+    'processing': 0.07,
+    'picked_up': 0.06,
+    'pending_confirmation': 0.05,
+    'delayed': 0.04,
+    'cancelled': 0.03,
+    'rejected': 0.02,
+}
+
+# Statuses an active shipment walks through before reaching its final one
+PROGRESSION = ['processing', 'picked_up', 'in_transit']
+
+SHIPMENT_COLUMNS = (
+    'id', 'tracking_number', 'shipper_name', 'shipper_address', 'shipper_phone', 'shipper_email',
+    'receiver_name', 'receiver_address', 'receiver_phone', 'receiver_email',
+    'origin', 'destination', 'status', 'packages', 'total_weight', 'product', 'quantity',
+    'payment_mode', 'total_freight', 'expected_delivery', 'departure_time',
+    'pickup_date', 'pickup_time', 'comments', 'date_created',
+)
+INVOICE_COLUMNS = ('shipment_id', 'invoice_number', 'tracking_number', 'shipper_name', 'shipper_email', 'amount', 'issue_date', 'due_date')
+HISTORY_COLUMNS = ('shipment_id', 'date_time', 'location', 'status', 'description', 'latitude', 'longitude')
+
+FIRST_NAMES = ['Jean', 'Marie', 'Pierre', 'Sophie', 'Thomas', 'Camille', 'Lucas', 'Emma', 'Hugo', 'Chloé', 'Louis', 'Léa']
+LAST_NAMES = ['Dupont', 'Laurent', 'Martin', 'Bernard', 'Petit', 'Durand', 'Leroy', 'Moreau', 'Simon', 'Michel', 'Garcia', 'Roux']
+STREETS = ['Rue de la Paix', 'Avenue Victor Hugo', 'Boulevard Voltaire', 'Rue du Commerce', 'Place de la République', 'Rue Nationale']
+PRODUCTS = ['Documents', 'Electronics', 'Clothing', 'Books', 'Spare parts', 'Furniture', 'Food']
+
+TRACKING_FORMAT = 'BENCH{:012d}-COLISSELECT'
+
+
+def person(rng):
+    first = rng.choice(FIRST_NAMES)
+    last = rng.choice(LAST_NAMES)
+    email = f'{first.lower()}.{last.lower()}{rng.randint(1, 9999)}@example.com'
+    phone = f'+33 6 {rng.randint(10, 99)} {rng.randint(10, 99)} {rng.randint(10, 99)} {rng.randint(10, 99)}'
+    return f'{first} {last}', email, phone
+
+
+def address(rng, city):
+    return f'{rng.randint(1, 200)} {rng.choice(STREETS)}, {city}'
+
+
+def generate_shipment(rng, shipment_id, now, days):
+    status = rng.choices(list(STATUS_WEIGHTS), weights=list(STATUS_WEIGHTS.values()))[0]
+    origin, destination = rng.sample(CITIES, 2)
+    created = now - timedelta(days=rng.uniform(0, days))
+    transit_days = rng.randint(1, 7)
+    shipper_name, shipper_email, shipper_phone = person(rng)
+    receiver_name, receiver_email, receiver_phone = person(rng)
+    tracking_number = None if status == 'pending_confirmation' else TRACKING_FORMAT.format(shipment_id)
+    row = (
+        shipment_id, tracking_number, shipper_name, address(rng, origin[0]), shipper_phone, shipper_email,
+        receiver_name, address(rng, destination[0]), receiver_phone, receiver_email,
+        origin[0], destination[0], status, rng.randint(1, 5), round(rng.uniform(0.2, 80), 2),
+        rng.choice(PRODUCTS), rng.randint(1, 10), rng.choice(['Cash', 'Card', 'Transfer']),
+        round(rng.uniform(10, 400), 2), (created + timedelta(days=transit_days)).strftime('%Y-%m-%d'),
+        '', created.strftime('%Y-%m-%d'), created.strftime('%H:%M'), '', created.strftime('%Y-%m-%d'),
+    )
+    return row, status, origin, destination, created, transit_days
+
+
+def generate_invoice(row, created, terms_days):
+    # Confirmed shipments are invoiced on their creation date
+    if row[1] is None:
+        return None
+    return (row[0], f'INV-{row[0]:06d}', row[1], row[2], row[5], row[18], created.strftime('%Y-%m-%d'),
+            (created + timedelta(days=terms_days)).strftime('%Y-%m-%d'))
+
+
+def generate_history(rng, shipment_id, status, origin, destination, created, transit_days, events):
+    if status in ('pending_confirmation', 'rejected'):
+        events = 1
+    steps = []
+    for i in range(events):
+        if i == events - 1:
+            step_status = status
+        else:
+            step_status = PROGRESSION[min(i, len(PROGRESSION) - 1)]
+        steps.append(step_status)
+
+    rows = []
+    span = timedelta(days=transit_days)
+    for i, step_status in enumerate(steps):
+        fraction = i / max(1, events - 1)
+        lat = origin[1] + (destination[1] - origin[1]) * fraction
+        lng = origin[2] + (destination[2] - origin[2]) * fraction
+        when = created + span * fraction + timedelta(minutes=rng.randint(0, 59))
+        location = origin[0] if fraction < 0.5 else destination[0]
+        rows.append((shipment_id, when.strftime('%Y-%m-%d %H:%M:%S'), location, step_status,
+                     f'Shipment {step_status.replace("_", " ")}', round(lat, 6), round(lng, 6)))
+    return rows
+
+
+def insert_batch(app, db, table, columns, rows):
+    if not rows:
+        return
+    if app.USE_POSTGRESQL:
+        from psycopg2.extras import execute_values
+        cursor = db.cursor()
+        execute_values(cursor, f'INSERT INTO {table} ({", ".join(columns)}) VALUES %s', rows, page_size=len(rows))
+    else:
+        placeholders = ', '.join('?' * len(columns))
+        db.executemany(f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({placeholders})', rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Populate the database with a synthetic dataset')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--sqlite', help='Path of the SQLite database to populate')
+    target.add_argument('--database-url', help='PostgreSQL URL to populate')
+    parser.add_argument('--shipments', type=int, default=10000)
+    parser.add_argument('--history', type=int, default=6, help='tracking_history rows per shipment')
+    parser.add_argument('--days', type=int, default=180, help='spread creation dates over this many days')
+    parser.add_argument('--batch', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--manifest', default='bench/manifest.json')
+    args = parser.parse_args(argv)
+
+    # app.py reads its configuration at import time
+    if args.sqlite:
+        os.environ['USE_POSTGRESQL'] = 'false'
+        os.environ['DATABASE_PATH'] = args.sqlite
+    else:
+        os.environ['USE_POSTGRESQL'] = 'true'
+        os.environ['DATABASE_URL'] = args.database_url
+    import app
+
+    rng = random.Random(args.seed)
+    now = datetime(2026, 1, 1)
+    started = time.perf_counter()
+    app.init_db()
+
+    with app.app.app_context():
+        db = app.get_db()
+        if app.USE_POSTGRESQL:
+            cursor = db.cursor()
+            cursor.execute('SELECT COALESCE(MAX(id), 0) AS max_id FROM shipments')
+            first_id = cursor.fetchone()['max_id'] + 1
+        else:
+            first_id = db.execute('SELECT COALESCE(MAX(id), 0) AS max_id FROM shipments').fetchone()['max_id'] + 1
+
+        shipments = []
+        invoices = []
+        history = []
+        history_count = 0
+        for shipment_id in range(first_id, first_id + args.shipments):
+            row, status, origin, destination, created, transit_days = generate_shipment(rng, shipment_id, now, args.days)
+            shipments.append(row)
+            invoice = generate_invoice(row, created, app.invoices.TERMS_DAYS)
+            if invoice:
+                invoices.append(invoice)
+            history.extend(generate_history(rng, shipment_id, status, origin, destination, created, transit_days, args.history))
+            if len(shipments) >= args.batch:
+                insert_batch(app, db, 'shipments', SHIPMENT_COLUMNS, shipments)
+                insert_batch(app, db, 'invoices', INVOICE_COLUMNS, invoices)
+                insert_batch(app, db, 'tracking_history', HISTORY_COLUMNS, history)
+                db.commit()
+                history_count += len(history)
+                shipments, invoices, history = [], [], []
+                print(f"  {shipment_id - first_id + 1}/{args.shipments} shipments", file=sys.stderr)
+        insert_batch(app, db, 'shipments', SHIPMENT_COLUMNS, shipments)
+        insert_batch(app, db, 'invoices', INVOICE_COLUMNS, invoices)
+        insert_batch(app, db, 'tracking_history', HISTORY_COLUMNS, history)
+        history_count += len(history)
+
+        if app.USE_POSTGRESQL:
+            # Explicit ids bypass the SERIAL sequence, move it past them
+            cursor = db.cursor()
+            cursor.execute("SELECT setval(pg_get_serial_sequence('shipments', 'id'), (SELECT MAX(id) FROM shipments))")
+            cursor.execute('ANALYZE shipments')
+            cursor.execute('ANALYZE invoices')
+            cursor.execute('ANALYZE tracking_history')
+        else:
+            db.execute('ANALYZE')
+        db.commit()
+
+    elapsed = time.perf_counter() - started
+    manifest = {
+        'first_id': first_id,
+        'last_id': first_id + args.shipments - 1,
+        'tracking_format': TRACKING_FORMAT,
+        'shipments': args.shipments,
+        'history_rows': history_count,
+        'seed': args.seed,
+        'generated_at': datetime.now().isoformat(),
+    }
+    os.makedirs(os.path.dirname(args.manifest) or '.', exist_ok=True)
+    with open(args.manifest, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Inserted {args.shipments} shipments and {history_count} history rows in {elapsed:.1f}s (manifest: {args.manifest})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+# HTTP load driver
+# Usage (from backend/, against a running server and a dataset from bench.datagen):
+#   python -m bench.loadtest --url http://127.0.0.1:8080 --duration 30 --concurrency 16 \
+#       --output bench/results/run.json [--baseline bench/results/previous.json --tolerance 0.15]
+# Reports p50/p95/p99 latency and throughput per scenario. With --baseline, exits 1
+# when a scenario's p95 or throughput regressed by more than the tolerance.
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# Scenario name -> relative weight in the traffic mix
+DEFAULT_MIX = {
+    'track': 50,
+    'list': 10,
+    'create': 5,
+    'history': 15,
+    'progress': 20,
+}
+
+TRACKED_STATUSES = ['in_transit', 'delivered', 'processing', 'delayed']
+
+
+class Client:
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, method, path, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        req.add_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            req.add_header(name, value)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+class Scenarios:
+    def __init__(self, client, manifest, rng):
+        self.client = client
+        self.first_id = manifest['first_id']
+        self.last_id = manifest['last_id']
+        self.tracking_format = manifest['tracking_format']
+        self.rng = rng
+
+    def random_id(self):
+        return self.rng.randint(self.first_id, self.last_id)
+
+    def track(self):
+        # Pending shipments have no tracking number, a 404 is an expected answer here
+        status = self.client.request('GET', '/api/track/' + self.tracking_format.format(self.random_id()))
+        return status in (200, 404)
+
+    def list(self):
+        status = self.client.request('GET', '/api/shipments?status=' + self.rng.choice(TRACKED_STATUSES))
+        return status == 200
+
+    def create(self):
+        body = {
+            'shipper_name': 'Bench Shipper', 'shipper_email': 'bench@example.com', 'shipper_phone': '+33 6 00 00 00 00',
+            'shipper_address': '1 Rue de la Paix, Paris', 'receiver_name': 'Bench Receiver',
+            'receiver_address': '2 Avenue Victor Hugo, Lyon', 'origin': 'Paris', 'destination': 'Lyon',
+            'total_weight': round(self.rng.uniform(0.5, 30), 2),
+        }
+        return self.client.request('POST', '/api/shipments', body, {'X-Admin-Request': 'true'}) == 200
+
+    def history(self):
+        body = {
+            'location': self.rng.choice(['Paris Hub', 'Lyon Hub', 'Marseille Hub']),
+            'status': 'in_transit',
+            'description': 'Bench scan',
+            'latitude': round(self.rng.uniform(43, 50), 5),
+            'longitude': round(self.rng.uniform(-1, 7), 5),
+        }
+        return self.client.request('POST', f'/api/tracking-history/{self.random_id()}', body) == 200
+
+    def progress(self):
+        body = {'progress': round(self.rng.uniform(0, 100), 1), 'current_lat': 46.0, 'current_lng': 2.0}
+        return self.client.request('PUT', f'/api/shipments/{self.random_id()}/progress', body) == 200
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run(args, manifest):
+    mix = dict(DEFAULT_MIX)
+    if args.mix:
+        mix = {name: float(weight) for name, weight in (item.split('=') for item in args.mix.split(','))}
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.warmup + args.duration
+    measure_from = time.perf_counter() + args.warmup
+
+    def worker(worker_id):
+        rng = random.Random(args.seed + worker_id)
+        scenarios = Scenarios(Client(args.url, args.timeout), manifest, rng)
+        local = {name: [] for name in names}
+        local_errors = {name: 0 for name in names}
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            name = rng.choices(names, weights)[0]
+            try:
+                ok = getattr(scenarios, name)()
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - now
+            if now >= measure_from:
+                local[name].append(elapsed)
+                if not ok:
+                    local_errors[name] += 1
+        with lock:
+            for name in names:
+                latencies[name].extend(local[name])
+                errors[name] += local_errors[name]
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(worker, range(args.concurrency)))
+
+    results = {}
+    for name in names:
+        values = sorted(latencies[name])
+        results[name] = {
+            'requests': len(values),
+            'errors': errors[name],
+            'throughput_rps': round(len(values) / args.duration, 2),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 3) if values else None,
+            'p95_ms': round(percentile(values, 0.95) * 1000, 3) if values else None,
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3) if values else None,
+        }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if not previous or not previous.get('p95_ms') or not current.get('p95_ms'):
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {previous['p95_ms']} ms -> {current['p95_ms']} ms")
+        if current['throughput_rps'] < previous['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {previous['throughput_rps']} -> {current['throughput_rps']} req/s")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Drive load against the backend and report latency per endpoint')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--manifest', default='bench/manifest.json')
+    parser.add_argument('--duration', type=float, default=30, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=3, help='unmeasured seconds before measuring')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--mix', help='scenario weights, e.g. track=80,list=20')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--baseline', help='results JSON of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed relative regression')
+    args = parser.parse_args(argv)
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+
+    results = run(args, manifest)
+
+    print(f"{'scenario':<10} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, r in results.items():
+        print(f"{name:<10} {r['requests']:>9} {r['errors']:>7} {r['throughput_rps']:>9} "
+              f"{r['p50_ms'] or '-':>9} {r['p95_ms'] or '-':>9} {r['p99_ms'] or '-':>9}")
+
+    report = {
+        'url': args.url,
+        'started_at': datetime.now().isoformat(),
+        'duration': args.duration,
+        'concurrency': args.concurrency,
+        'manifest': manifest,
+        'endpoints': results,
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('Regressions against baseline:')
+            for line in regressions:
+                print('  ' + line)
+            return 1
+        print('No regression against baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
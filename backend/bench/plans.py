@@ -0,0 +1,359 @@
+# Query-plan regression check
+# Exercises every API route through the Flask test client against a generated dataset,
+# captures each SQL statement the handlers issue and runs it under EXPLAIN
+# (Postgres EXPLAIN (FORMAT JSON), SQLite EXPLAIN QUERY PLAN). Fails when a large table
+# is fully scanned, an expected index is not used, or a plan lost an index compared
+# with the stored snapshot in bench/plans/<dialect>.json.
+# Usage (from backend/):
+#   python -m bench.plans --sqlite /tmp/plans.db            # check
+#   python -m bench.plans --sqlite /tmp/plans.db --update   # re-record the snapshot
+#   python -m bench.plans --database-url postgresql://localhost/tracksite_plans
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+from bench import datagen
+
+SNAPSHOT_DIR = os.path.join(os.path.dirname(__file__), 'plans')
+
+# Tables that grow with traffic; a full scan of one of these is a failure
+LARGE_TABLES = {'shipments', 'tracking_history', 'shipment_progress', 'invoices'}
+
+# Partitions below this size are scanned sequentially by design
+SMALL_PARTITION_BYTES = 64 * 1024
+
+# Statements that read a whole large table by design (unfiltered admin listings)
+ALLOWED_FULL_SCANS = {
+    'SELECT * FROM shipments ORDER BY date_created DESC',
+    'SELECT s.*, c.location AS current_location, c.last_event_at, COALESCE(c.event_count, ?) AS event_count, c.progress FROM shipments s LEFT JOIN shipment_current_state c ON c.shipment_id = s.id ORDER BY s.date_created DESC',
+    'SELECT COUNT(*) AS count, COALESCE(SUM(i.amount), ?) AS amount, COALESCE(SUM(CASE WHEN s.status = ? THEN ? ELSE ? END), ?) AS paid, COALESCE(SUM(CASE WHEN s.status = ? THEN ? ELSE ? END), ?) AS overdue, COALESCE(SUM(CASE WHEN s.status NOT IN (?, ?) THEN ? ELSE ? END), ?) AS pending FROM invoices i JOIN shipments s ON s.id = i.shipment_id',
+}
+
+# Normalized statement -> index it must use
+EXPECTED_INDEXES = {
+    'SELECT date_time, location, status, description, latitude, longitude FROM tracking_history WHERE shipment_id = ? ORDER BY date_time DESC': 'idx_tracking_history_shipment',
+    'SELECT * FROM tracking_history WHERE shipment_id = ? ORDER BY date_time DESC': 'idx_tracking_history_shipment',
+    'SELECT * FROM shipments WHERE status = ? ORDER BY date_created DESC': 'idx_shipments_status_created',
+    'SELECT s.*, c.location AS current_location, c.last_event_at, COALESCE(c.event_count, ?) AS event_count, c.progress FROM shipments s LEFT JOIN shipment_current_state c ON c.shipment_id = s.id WHERE s.status = ? ORDER BY s.date_created DESC': 'idx_shipments_status_created',
+    'SELECT * FROM shipment_progress WHERE shipment_id = ? ORDER BY last_updated DESC LIMIT ?': 'uq_shipment_progress_shipment',
+}
+
+DML = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+# Bookkeeping statements that are not issued by route handlers
+IGNORED = re.compile(r'schema_version|pg_advisory', re.IGNORECASE)
+
+
+def exercise_routes(client, manifest):
+    # Yields (route label, response) while hitting every route that touches the database
+    shipment_id = manifest['first_id'] + 7
+    tracking_number = None
+    stamp = str(int(time.time() * 1000))
+    admin = {'X-Admin-Request': 'true'}
+    new_shipment = {
+        'shipper_name': 'Plan Check', 'shipper_email': 'plans@example.com', 'shipper_phone': '0600000000',
+        'receiver_name': 'Plan Receiver', 'origin': 'Paris', 'destination': 'Lyon', 'total_weight': 2,
+    }
+
+    r = client.get('/api/changes?limit=50')
+    yield 'GET /api/changes', r
+    yield 'GET /api/changes?since=<page cursor>', client.get(f"/api/changes?since={r.get_json().get('cursor')}&limit=50")
+    changes_cursor = client.get('/api/changes?tables=locations').get_json().get('cursor')
+
+    yield 'GET /api/locations', client.get('/api/locations')
+    r = client.post('/api/locations', json={'name': f'Plan City {stamp}', 'country': 'France'})
+    yield 'POST /api/locations', r
+    location_id = r.get_json().get('id')
+    yield 'PUT /api/locations/<id>', client.put(f'/api/locations/{location_id}', json={'name': 'Plan City', 'slug': f'plan-city-{stamp}', 'country': 'France'})
+    yield 'DELETE /api/locations/<id>', client.delete(f'/api/locations/{location_id}')
+
+    yield 'GET /api/zones', client.get('/api/zones')
+    r = client.post('/api/zones', json={'name': f'Plan Zone {stamp}', 'locations': 'Paris'})
+    yield 'POST /api/zones', r
+    zone_id = r.get_json().get('id')
+    yield 'PUT /api/zones/<id>', client.put(f'/api/zones/{zone_id}', json={'name': 'Plan Zone', 'slug': f'plan-zone-{stamp}', 'locations': 'Paris', 'description': ''})
+    yield 'DELETE /api/zones/<id>', client.delete(f'/api/zones/{zone_id}')
+
+    yield 'GET /api/shipping-rates', client.get('/api/shipping-rates')
+    r = client.post('/api/shipping-rates', json={'name': 'Plan Rate', 'rate': 10})
+    yield 'POST /api/shipping-rates', r
+    rate_id = r.get_json().get('id')
+    yield 'PUT /api/shipping-rates/<id>', client.put(f'/api/shipping-rates/{rate_id}', json={'name': 'Plan Rate', 'type': 'flat', 'min_weight': 0, 'max_weight': 0, 'rate': 11, 'insurance': 0, 'description': ''})
+    yield 'DELETE /api/shipping-rates/<id>', client.delete(f'/api/shipping-rates/{rate_id}')
+
+    yield 'GET /api/pickup-rates', client.get('/api/pickup-rates')
+    r = client.post('/api/pickup-rates', json={'zone': 'France North', 'rate': 10})
+    yield 'POST /api/pickup-rates', r
+    rate_id = r.get_json().get('id')
+    yield 'PUT /api/pickup-rates/<id>', client.put(f'/api/pickup-rates/{rate_id}', json={'zone': 'France North', 'min_weight': 0, 'max_weight': 5, 'rate': 11, 'description': ''})
+    yield 'DELETE /api/pickup-rates/<id>', client.delete(f'/api/pickup-rates/{rate_id}')
+
+    yield 'GET /api/users', client.get('/api/users')
+    r = client.post('/api/users', json={'name': 'Plan User', 'email': f'plan-{stamp}@example.com', 'password': 'x'})
+    yield 'POST /api/users', r
+    user_id = r.get_json().get('id')
+    yield 'PUT /api/users/<id>', client.put(f'/api/users/{user_id}', json={'name': 'Plan User', 'email': f'plan-{stamp}@example.com', 'role': 'user', 'branch': '', 'status': 'active'})
+    yield 'PATCH /api/users/<id>', client.patch(f'/api/users/{user_id}', json={'branch': 'Paris'})
+    yield 'POST /api/auth/login', client.post('/api/auth/login', json={'email': f'plan-{stamp}@example.com', 'password': ''})
+    yield 'DELETE /api/users/<id>', client.delete(f'/api/users/{user_id}')
+    yield 'POST /api/auth/register', client.post('/api/auth/register', json={'name': 'Plan Reg', 'email': f'plan-reg-{stamp}@example.com', 'password': 'x'})
+
+    yield 'GET /api/eta', client.get('/api/eta?origin=Paris&destination=Lyon&service=express')
+    yield 'GET /api/shipments', client.get('/api/shipments')
+    yield 'GET /api/shipments?status=', client.get('/api/shipments?status=in_transit')
+    yield 'GET /api/shipments/search', client.get('/api/shipments/search?q=plan rue&limit=10')
+    r = client.post('/api/shipments', json=new_shipment, headers=dict(admin, **{'Idempotency-Key': f'plans-{stamp}'}))
+    yield 'POST /api/shipments (admin)', r
+    tracking_number = r.get_json().get('tracking_number')
+    admin_id = r.get_json().get('id')
+    r = client.post('/api/shipments', json=new_shipment)
+    yield 'POST /api/shipments', r
+    pending_id = r.get_json().get('id')
+    yield 'POST /api/shipments/<id>/confirm', client.post(f'/api/shipments/{pending_id}/confirm', json={'total_freight': 10})
+    r = client.get('/api/invoices?limit=20')
+    yield 'GET /api/invoices', r
+    yield 'GET /api/invoices?before=', client.get(f"/api/invoices?limit=20&before={r.get_json()['next']}")
+    yield 'GET /api/invoices?status=', client.get('/api/invoices?status=overdue&limit=20')
+    yield 'GET /api/invoices?q=', client.get(f"/api/invoices?q=INV-{shipment_id:06d}")
+    yield 'GET /api/invoices/summary', client.get('/api/invoices/summary')
+    yield 'POST /api/shipments/<id>/reject', client.post(f'/api/shipments/{pending_id}/reject', json={'reason': 'plan check'})
+    yield 'PUT /api/shipments/<id>', client.put(f'/api/shipments/{pending_id}', json=dict(new_shipment, status='processing'))
+    r = client.patch(f'/api/shipments/{pending_id}', json={'comments': 'plan check'})
+    yield 'PATCH /api/shipments/<id>', r
+    yield 'PATCH /api/shipments/<id> (If-Match)', client.patch(f'/api/shipments/{pending_id}', json={'status': 'delayed'}, headers={'If-Match': r.headers.get('ETag', '*')})
+
+    yield 'GET /api/track/<tracking_number>', client.get(f'/api/track/{tracking_number}')
+    yield 'GET /api/tracking-history/<shipment_id>', client.get(f'/api/tracking-history/{shipment_id}')
+    r = client.post(f'/api/tracking-history/{shipment_id}', json={'location': 'Lyon Hub', 'status': 'in_transit', 'description': 'plan check'})
+    yield 'POST /api/tracking-history/<shipment_id>', r
+    history_id = r.get_json().get('id')
+    yield 'PUT /api/tracking-history/<id>', client.put(f'/api/tracking-history/{history_id}', json={'date_time': '2026-01-01 10:00:00', 'location': 'Lyon Hub', 'status': 'in_transit', 'description': ''})
+    yield 'PATCH /api/tracking-history/<id>', client.patch(f'/api/tracking-history/{history_id}', json={'status': 'delayed'})
+    yield 'DELETE /api/tracking-history/<id>', client.delete(f'/api/tracking-history/{history_id}')
+
+    # Twice on a new shipment, so the upsert both inserts and takes its ON CONFLICT branch
+    yield 'PUT /api/shipments/<id>/progress', client.put(f'/api/shipments/{admin_id}/progress', json={'progress': 40, 'current_lat': 46.0, 'current_lng': 2.0})
+    yield 'PUT /api/shipments/<id>/progress', client.put(f'/api/shipments/{admin_id}/progress', json={'progress': 45, 'current_lat': 46.1, 'current_lng': 2.1})
+    yield 'GET /api/shipments/<id>/progress', client.get(f'/api/shipments/{admin_id}/progress')
+    pings = [{'lat': 46.0 + i / 1000, 'lng': 2.0 + i / 1000, 'progress': 45 + i / 100, 'timestamp': 1767261600000 + i * 1000} for i in range(50)]
+    yield 'POST /api/shipments/<id>/gps', client.post(f'/api/shipments/{admin_id}/gps', json={'pings': pings[:25]})
+    yield 'POST /api/shipments/<id>/gps', client.post(f'/api/shipments/{admin_id}/gps', json={'pings': pings[25:]})
+    yield 'GET /api/shipments/<id>/route', client.get(f'/api/shipments/{admin_id}/route?zoom=12')
+    yield 'GET /api/shipments/nearby', client.get('/api/shipments/nearby?lat=46.0&lng=2.0&radius=50')
+    yield 'GET /api/shipments/within', client.get('/api/shipments/within?bbox=1.5,45.5,2.5,46.5')
+
+    yield 'DELETE /api/shipments/<id>', client.delete(f'/api/shipments/{pending_id}')
+    yield 'GET /api/changes?since=<cursor>', client.get(f'/api/changes?since={changes_cursor}')
+
+
+def capture_statements(app, metrics, manifest):
+    client = app.app.test_client()
+    client.get('/readyz')  # schema check happens here, outside the capture
+    statements = {}
+    metrics.current.query_log = []
+
+    def collect(label):
+        for sql, _elapsed, params in metrics.current.query_log:
+            if not DML.match(sql) or IGNORED.search(sql):
+                continue
+            key = metrics.normalize_sql(sql)
+            statements.setdefault(key, {'route': label, 'sql': sql, 'params': params})
+        metrics.current.query_log = []
+
+    for label, response in exercise_routes(client, manifest):
+        if response.status_code >= 500:
+            raise RuntimeError(f'{label} failed with {response.status_code}: {response.get_data(as_text=True)[:200]}')
+        collect(label)
+    # Background work whose queries no route issues
+    with app.app.app_context():
+        app.eta.refresh_lanes(app.get_db(), app.USE_POSTGRESQL)
+    collect('eta lane refresh')
+    metrics.current.query_log = None
+    return statements
+
+
+def partition_parents(conn):
+    # Partition tables and their indexes map back to the partitioned parent, so a plan
+    # reads the same however many monthly partitions exist. Near-empty partitions (months
+    # ahead, the default one) are cheapest to scan sequentially and are left out.
+    cursor = conn.cursor()
+    cursor.execute('''SELECT c.relname, p.relname, pg_relation_size(c.oid) < %s FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent''', (SMALL_PARTITION_BYTES,))
+    parents = {}
+    empty = set()
+    for child, parent, is_empty in cursor.fetchall():
+        parents[child] = parent
+        if is_empty:
+            empty.add(child)
+    return parents, empty
+
+
+def explain_postgresql(app, sql, params):
+    conn = app.psycopg2.connect(app.DATABASE_URL)
+    try:
+        parents, empty = partition_parents(conn)
+        cursor = conn.cursor()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0][0]['Plan']
+    finally:
+        conn.rollback()
+        conn.close()
+
+    steps = []
+
+    def add(step):
+        if step not in steps:
+            steps.append(step)
+
+    def walk(node):
+        relation = node.get('Relation Name')
+        index = node.get('Index Name')
+        index = parents.get(index, index)
+        if relation in empty and node['Node Type'] == 'Seq Scan':
+            pass
+        elif relation:
+            step = f"{node['Node Type']} {parents.get(relation, relation)}"
+            if index:
+                step += f" USING INDEX {index}"
+            add(step)
+        elif index:
+            # Bitmap Index Scan: the heap relation is on the parent node
+            add(f"{node['Node Type']} USING INDEX {index}")
+        elif node['Node Type'] in ('Sort', 'Incremental Sort'):
+            add(node['Node Type'])
+        for child in node.get('Plans', []):
+            walk(child)
+
+    walk(plan)
+    return steps
+
+
+def explain_sqlite(app, sql, params):
+    conn = app.sqlite3.connect(app.DATABASE)
+    try:
+        rows = conn.execute('EXPLAIN QUERY PLAN ' + sql, params or ()).fetchall()
+    finally:
+        conn.close()
+    return [row[3] for row in rows]
+
+
+def full_scans(dialect, steps):
+    tables = set()
+    for step in steps:
+        if dialect == 'postgresql':
+            match = re.match(r'Seq Scan (\w+)', step)
+        else:
+            # "SCAN t" reads the table; "SCAN t USING [COVERING] INDEX i" walks an index
+            match = re.match(r'SCAN (\w+)$', step)
+        if match and match.group(1) in LARGE_TABLES:
+            tables.add(match.group(1))
+    return tables
+
+
+def used_indexes(steps):
+    indexes = set()
+    for step in steps:
+        match = re.search(r'USING (?:COVERING )?INDEX (\w+)', step)
+        if match:
+            indexes.add(match.group(1))
+        # SQLite rowid lookups have no index name
+        match = re.search(r'(\w+) USING (?:INTEGER )?PRIMARY KEY', step)
+        if match:
+            indexes.add(f'{match.group(1)}_pkey')
+    return indexes
+
+
+def check(dialect, plans, snapshot):
+    failures = []
+    for key, entry in plans.items():
+        steps = entry['plan']
+        scans = full_scans(dialect, steps)
+        if scans and key not in ALLOWED_FULL_SCANS:
+            failures.append(f"full scan of {', '.join(sorted(scans))} in {entry['route']}: {key}")
+        expected = EXPECTED_INDEXES.get(key)
+        if expected and expected not in used_indexes(steps):
+            failures.append(f"{entry['route']} does not use {expected}: {key}")
+        previous = snapshot.get(key)
+        # A whole-table read may go either way between an index walk and scan-and-sort
+        if previous and key not in ALLOWED_FULL_SCANS:
+            lost = used_indexes(previous['plan']) - used_indexes(steps)
+            if lost:
+                failures.append(f"{entry['route']} no longer uses {', '.join(sorted(lost))}: {key}")
+            new_scans = scans - full_scans(dialect, previous['plan'])
+            if new_scans:
+                failures.append(f"{entry['route']} now scans {', '.join(sorted(new_scans))}: {key}")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the query plans of every route against a generated dataset')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--sqlite', help='SQLite database to generate / use')
+    target.add_argument('--database-url', help='PostgreSQL database to generate / use (dedicated, it gets written to)')
+    parser.add_argument('--shipments', type=int, default=20000)
+    parser.add_argument('--history', type=int, default=6)
+    parser.add_argument('--no-generate', action='store_true', help='reuse an existing dataset and manifest')
+    parser.add_argument('--manifest', default='bench/manifest.json')
+    parser.add_argument('--update', action='store_true', help='record the current plans as the snapshot')
+    args = parser.parse_args(argv)
+
+    if not args.no_generate:
+        target_args = ['--sqlite', args.sqlite] if args.sqlite else ['--database-url', args.database_url]
+        datagen.main(target_args + ['--shipments', str(args.shipments), '--history', str(args.history), '--manifest', args.manifest])
+    elif args.sqlite:
+        os.environ['USE_POSTGRESQL'] = 'false'
+        os.environ['DATABASE_PATH'] = args.sqlite
+    else:
+        os.environ['USE_POSTGRESQL'] = 'true'
+        os.environ['DATABASE_URL'] = args.database_url
+
+    import app
+    import metrics
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+
+    dialect = 'postgresql' if app.USE_POSTGRESQL else 'sqlite'
+    explain = explain_postgresql if app.USE_POSTGRESQL else explain_sqlite
+    statements = capture_statements(app, metrics, manifest)
+    plans = {}
+    for key, entry in sorted(statements.items()):
+        plans[key] = {'route': entry['route'], 'plan': explain(app, entry['sql'], entry['params'])}
+
+    snapshot_path = os.path.join(SNAPSHOT_DIR, f'{dialect}.json')
+    snapshot = {}
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path) as f:
+            snapshot = json.load(f)
+
+    for key, entry in plans.items():
+        print(f"{entry['route']}\n  {key}\n    " + '\n    '.join(entry['plan']))
+
+    failures = check(dialect, plans, snapshot)
+    if args.update:
+        if failures:
+            print('Not recording a snapshot with failing plans:')
+        else:
+            os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+            with open(snapshot_path, 'w') as f:
+                json.dump(plans, f, indent=2, sort_keys=True)
+                f.write('\n')
+            print(f"Recorded {len(plans)} plans in {snapshot_path}")
+            return 0
+
+    unrecorded = sorted(set(plans) - set(snapshot))
+    if unrecorded and not args.update:
+        print(f"{len(unrecorded)} statement(s) not in the snapshot, run with --update to record them")
+    if failures:
+        print(f"\n{len(failures)} plan failure(s):")
+        for failure in failures:
+            print('  ' + failure)
+        return 1
+    print(f"\n{len(plans)} statements checked, no plan regression")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,268 @@
+# Threaded (gunicorn gthread) vs ASGI (uvicorn asgi:application) on the public read path
+# Usage (from backend/, against a Postgres dataset from bench.datagen):
+#   python -m bench.serving --database-url postgresql://localhost/tracksite_bench \
+#       --latency-ms 20 --concurrency 50,500,2000 --duration 15 [--output bench/results/serving.json]
+# Both servers run one process and reach the database through a local proxy that holds
+# every packet for half the round trip each way, standing in for a remote database.
+# Clients keep one connection each and loop on GET /api/track/<tracking_number> and
+# GET /api/shipments/<id>/progress for random shipments of the manifest.
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from bench.loadtest import percentile
+
+DEFAULT_MIX = {'track': 70, 'progress': 30}
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def upstream_address(url):
+    # (host, port) or a unix socket path, from a postgresql:// URL
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    host = query.get('host') or parts.hostname or 'localhost'
+    port = int(query.get('port') or parts.port or 5432)
+    if host.startswith('/'):
+        return os.path.join(host, f'.s.PGSQL.{port}')
+    return host, port
+
+
+def proxied_url(url, port):
+    parts = urlsplit(url)
+    query = [(name, value) for name, value in parse_qsl(parts.query) if name not in ('host', 'port')]
+    credentials = parts.netloc.rpartition('@')[0]
+    netloc = f'{credentials}@127.0.0.1:{port}' if credentials else f'127.0.0.1:{port}'
+    return parts._replace(netloc=netloc, query=urlencode(query)).geturl()
+
+
+async def relay(reader, writer, delay):
+    # Each chunk is written `delay` after it was read; chunks keep their order
+    queue = asyncio.Queue()
+
+    async def deliver():
+        while True:
+            due, data = await queue.get()
+            if data is None:
+                break
+            await asyncio.sleep(max(0.0, due - time.monotonic()))
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    delivery = asyncio.ensure_future(deliver())
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            queue.put_nowait((time.monotonic() + delay, data))
+    except ConnectionError:
+        pass
+    queue.put_nowait((0, None))
+    await delivery
+
+
+def run_proxy(port, upstream, latency_ms):
+    async def handle(client_reader, client_writer):
+        if isinstance(upstream, str):
+            server_reader, server_writer = await asyncio.open_unix_connection(upstream)
+        else:
+            server_reader, server_writer = await asyncio.open_connection(*upstream)
+        delay = latency_ms / 2000
+        await asyncio.gather(relay(client_reader, server_writer, delay), relay(server_reader, client_writer, delay),
+                             return_exceptions=True)
+
+    async def serve():
+        server = await asyncio.start_server(handle, '127.0.0.1', port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def start_server(mode, port, database_url, connections):
+    env = dict(os.environ, USE_POSTGRESQL='true', DATABASE_URL=database_url, PORT=str(port), WEB_CONCURRENCY='1',
+               GUNICORN_THREADS=str(connections), DB_POOL_MAX=str(connections), ASYNC_POOL_MAX=str(connections),
+               GUNICORN_MAX_REQUESTS='0', MAINTENANCE_INTERVAL='0')
+    if mode == 'threaded':
+        command = ['gunicorn', '--config', 'gunicorn.conf.py', '--access-logfile', '/dev/null', 'app:app']
+    else:
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(port), '--workers', '1',
+                   '--no-access-log', '--log-level', 'warning', '--backlog', '4096']
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_ready(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url + '/readyz', timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f'{url} did not become ready')
+
+
+class Connection:
+    def __init__(self, port):
+        self.port = port
+        self.reader = self.writer = None
+
+    async def get(self, path):
+        # -> status; reconnects when the server closed a kept-alive connection
+        for attempt in (1, 2):
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+            try:
+                self.writer.write(f'GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n'.encode())
+                await self.writer.drain()
+                status_line = await self.reader.readline()
+                if not status_line:
+                    raise ConnectionResetError
+                length = 0
+                while True:
+                    line = await self.reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    if name.lower() == 'content-length':
+                        length = int(value)
+                await self.reader.readexactly(length)
+                return int(status_line.split()[1])
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.writer.close()
+                self.writer = None
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def drive(port, manifest, concurrency, warmup, duration, mix, seed, timeout):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    started = time.perf_counter()
+    measure_from = started + warmup
+    deadline = measure_from + duration
+
+    async def client(client_id):
+        rng = random.Random(seed + client_id)
+        connection = Connection(port)
+        try:
+            while True:
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+                name = rng.choices(names, weights)[0]
+                shipment_id = rng.randint(manifest['first_id'], manifest['last_id'])
+                if name == 'track':
+                    path, expected = '/api/track/' + manifest['tracking_format'].format(shipment_id), (200, 404)
+                else:
+                    path, expected = f'/api/shipments/{shipment_id}/progress', (200,)
+                try:
+                    ok = await asyncio.wait_for(connection.get(path), timeout) in expected
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                    connection.close()
+                    connection = Connection(port)
+                    ok = False
+                elapsed = time.perf_counter() - now
+                if now >= measure_from:
+                    latencies[name].append(elapsed)
+                    if not ok:
+                        errors[name] += 1
+        finally:
+            connection.close()
+
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    results = {}
+    for name in names:
+        values = sorted(latencies[name])
+        results[name] = {
+            'requests': len(values),
+            'errors': errors[name],
+            'throughput_rps': round(len(values) / duration, 2),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 3) if values else None,
+            'p95_ms': round(percentile(values, 0.95) * 1000, 3) if values else None,
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3) if values else None,
+        }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare threaded and ASGI serving of the read path under database latency')
+    parser.add_argument('--database-url', required=True, help='PostgreSQL database populated by bench.datagen')
+    parser.add_argument('--manifest', default='bench/manifest.json')
+    parser.add_argument('--latency-ms', type=float, default=20, help='simulated database round trip')
+    parser.add_argument('--concurrency', default='50,500,2000', help='comma separated client counts')
+    parser.add_argument('--connections', type=int, default=16, help='database connections per server (threads in threaded mode)')
+    parser.add_argument('--modes', default='threaded,asgi')
+    parser.add_argument('--duration', type=float, default=15, help='measured seconds per run')
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--timeout', type=float, default=30, help='per request')
+    parser.add_argument('--mix', help='scenario weights, e.g. track=70,progress=30')
+    parser.add_argument('--port', type=int, default=8091)
+    parser.add_argument('--proxy-port', type=int, default=6543)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write results JSON here')
+    args = parser.parse_args(argv)
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    mix = dict(DEFAULT_MIX)
+    if args.mix:
+        mix = {name: float(weight) for name, weight in (item.split('=') for item in args.mix.split(','))}
+
+    proxy = multiprocessing.Process(target=run_proxy, args=(args.proxy_port, upstream_address(args.database_url), args.latency_ms), daemon=True)
+    proxy.start()
+    database_url = proxied_url(args.database_url, args.proxy_port)
+    runs = []
+    try:
+        for mode in args.modes.split(','):
+            server = start_server(mode, args.port, database_url, args.connections)
+            try:
+                wait_ready(f'http://127.0.0.1:{args.port}')
+                for concurrency in (int(value) for value in args.concurrency.split(',')):
+                    results = asyncio.run(drive(args.port, manifest, concurrency, args.warmup, args.duration, mix, args.seed, args.timeout))
+                    runs.append({'mode': mode, 'concurrency': concurrency, 'endpoints': results})
+                    for name, r in results.items():
+                        print(f"{mode:<9} {concurrency:>6} {name:<9} {r['requests']:>8} {r['errors']:>7} {r['throughput_rps']:>9} "
+                              f"{r['p50_ms'] or '-':>9} {r['p95_ms'] or '-':>9} {r['p99_ms'] or '-':>9}", flush=True)
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait(timeout=60)
+    finally:
+        proxy.terminate()
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump({
+                'started_at': datetime.now().isoformat(),
+                'latency_ms': args.latency_ms,
+                'connections': args.connections,
+                'duration': args.duration,
+                'manifest': manifest,
+                'runs': runs,
+            }, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,327 @@
+# In-process caches kept coherent across workers by an invalidation bus.
+#
+# On Postgres, triggers on the cached tables send NOTIFY '<entity>:<id>' from inside the
+# writing transaction (delivered on commit, never for a rollback) and every worker runs
+# a LISTEN thread that evicts the matching entries. On SQLite a polling thread reads the
+# rows whose change-feed version moved since its last look.
+#
+# Caching is only switched on while the bus is connected: a worker that cannot hear
+# invalidations serves everything from the database instead of serving stale data.
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+
+import metrics
+from common import create_trigger, execute
+
+CACHE_ENABLED = os.environ.get('CACHE_ENABLED', 'true').lower() == 'true'
+CACHE_TTL_SECONDS = float(os.environ.get('CACHE_TTL_SECONDS', 300))
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', 5000))
+CHANNEL = 'tracksite_invalidate'
+POLL_SECONDS = float(os.environ.get('INVALIDATION_POLL_SECONDS', 0.5))
+RECONNECT_SECONDS = 5
+
+# table -> (entity, column holding the entity id); history rows belong to their shipment
+WATCHED_TABLES = {
+    'locations': ('locations', 'id'),
+    'zones': ('zones', 'id'),
+    'shipping_rates': ('shipping_rates', 'id'),
+    'pickup_rates': ('pickup_rates', 'id'),
+    'shipments': ('shipments', 'id'),
+    'tracking_history': ('shipments', 'shipment_id'),
+}
+# Also read by the SQLite poller; installed after the watched tables, the Postgres
+# trigger of each comes with its own migration
+POLLED_TABLES = {
+    **WATCHED_TABLES,
+    'shipment_current_state': ('shipments', 'shipment_id'),
+}
+
+# Entity-wide invalidation marker; a None id tags whole-collection entries
+ALL = '*'
+
+invalidations = metrics.Counter('tracksite_cache_invalidations_total', 'Invalidation events applied', ('entity',))
+
+
+class Cache:
+    # LRU with a TTL safety net. Entries are tagged (entity, id) or (entity, None) for
+    # whole collections; invalidating (entity, id) drops both kinds.
+    def __init__(self, name, size=CACHE_SIZE, ttl=CACHE_TTL_SECONDS):
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (value, tags, expires)
+        self.tagged = {}  # tag -> set of keys
+        self.lock = threading.Lock()
+        # Each invalidation gets a sequence number; a load that started before the last
+        # invalidation of one of its tags must not store what it read
+        self.sequence = 0
+        self.tag_sequence = {}
+        self.floor = 0
+        # Same for a load from a replica (see read_lag) and invalidations in the window it may lag
+        self.tag_times = {}
+        self.floor_time = 0.0
+        caches.append(self)
+
+    def get_or_load(self, key, tags, loader):
+        # `tags` may be a function of the loaded value. None is never stored, so a miss
+        # (e.g. an unknown tracking number) is looked up again next time.
+        if not bus_connected.is_set():
+            return loader()
+        hit, value, now, started = self.lookup(key)
+        if hit:
+            return value
+        return self.offer(key, loader(), tags, now, started)
+
+    async def get_or_load_async(self, key, tags, loader):
+        # Same, with a coroutine function as the loader (see asgi.py)
+        if not bus_connected.is_set():
+            return await loader()
+        hit, value, now, started = self.lookup(key)
+        if hit:
+            return value
+        return self.offer(key, await loader(), tags, now, started)
+
+    def lookup(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] > now:
+                self.entries.move_to_end(key)
+                metrics.cache_hit(self.name)
+                return True, entry[0], now, None
+            started = self.sequence
+        metrics.cache_miss(self.name)
+        return False, None, now, started
+
+    def offer(self, key, value, tags, now, started):
+        # Stores a value loaded after lookup() missed, unless it may be stale
+        if value is None:
+            return value
+        if callable(tags):
+            tags = tags(value)
+        horizon = now - read_lag()
+        with self.lock:
+            stamps = [stamp for tag in tags for stamp in self.stamps(tag)]
+            if started >= self.floor and all(self.tag_sequence.get(stamp, 0) <= started for stamp in stamps) \
+                    and self.floor_time <= horizon and all(self.tag_times.get(stamp, 0.0) <= horizon for stamp in stamps):
+                self.store(key, value, tags, now + self.ttl)
+        return value
+
+    @staticmethod
+    def stamps(tag):
+        entity, entity_id = tag
+        return ((entity, entity_id), (entity, ALL))
+
+    def store(self, key, value, tags, expires):
+        self.discard(key)
+        self.entries[key] = (value, tags, expires)
+        for tag in tags:
+            self.tagged.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.size:
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[1]:
+            keys = self.tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tagged[tag]
+
+    def invalidate(self, entity, entity_id=None):
+        with self.lock:
+            self.sequence += 1
+            now = time.monotonic()
+            if entity_id is None:
+                self.tag_sequence[(entity, ALL)] = self.sequence
+                self.tag_times[(entity, ALL)] = now
+                doomed = [key for tag, keys in self.tagged.items() if tag[0] == entity for key in keys]
+            else:
+                self.tag_sequence[(entity, entity_id)] = self.sequence
+                self.tag_sequence[(entity, None)] = self.sequence
+                self.tag_times[(entity, entity_id)] = self.tag_times[(entity, None)] = now
+                doomed = list(self.tagged.get((entity, entity_id), ())) + list(self.tagged.get((entity, None), ()))
+            for key in doomed:
+                self.discard(key)
+            if len(self.tag_sequence) > 10 * self.size:
+                # Forget old sequences; loads that started before now are refused instead
+                self.tag_sequence.clear()
+                self.tag_times.clear()
+                self.floor = self.sequence
+                self.floor_time = now
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tagged.clear()
+            self.tag_sequence.clear()
+            self.tag_times.clear()
+            self.sequence += 1
+            self.floor = self.sequence
+            self.floor_time = time.monotonic()
+
+
+caches = []
+bus_connected = threading.Event()
+
+
+def no_lag():
+    return 0.0
+
+
+# Seconds the data a load reads may be behind the primary; replaced when replicas are configured
+read_lag = no_lag
+
+
+def invalidate(entity, entity_id=None):
+    invalidations.inc((entity,))
+    for cache in caches:
+        cache.invalidate(entity, entity_id)
+
+
+def clear_all():
+    for cache in caches:
+        cache.clear()
+
+
+def apply_payload(payload):
+    entity, _, entity_id = payload.partition(':')
+    invalidate(entity, int(entity_id) if entity_id.isdigit() else None)
+
+
+def install_triggers(db, postgres):
+    # Postgres only: the SQLite poller reads the change-feed versions instead
+    if not postgres:
+        return
+    execute(db, postgres, f'''CREATE OR REPLACE FUNCTION notify_invalidation() RETURNS trigger AS $$
+    DECLARE
+        old_id TEXT;
+        new_id TEXT;
+    BEGIN
+        -- TG_ARGV: entity name, column holding the entity id. Identical payloads sent
+        -- within one transaction are delivered once, on commit.
+        IF TG_OP <> 'INSERT' THEN
+            old_id := to_jsonb(OLD) ->> TG_ARGV[1];
+            PERFORM pg_notify('{CHANNEL}', TG_ARGV[0] || ':' || old_id);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            new_id := to_jsonb(NEW) ->> TG_ARGV[1];
+            IF new_id IS DISTINCT FROM old_id THEN
+                PERFORM pg_notify('{CHANNEL}', TG_ARGV[0] || ':' || new_id);
+            END IF;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql''')
+    for table, (entity, column) in WATCHED_TABLES.items():
+        create_trigger(db, postgres, f'trg_{table}_invalidate', table, f'''AFTER INSERT OR UPDATE OR DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION notify_invalidation('{entity}', '{column}')''')
+
+
+class Listener(threading.Thread):
+    # Postgres: a dedicated autocommit connection LISTENing on the channel
+    def __init__(self, database_url):
+        super().__init__(name='cache-invalidation', daemon=True)
+        self.database_url = database_url
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.is_set():
+            connection = None
+            try:
+                connection = psycopg2.connect(self.database_url)
+                connection.autocommit = True
+                connection.cursor().execute(f'LISTEN {CHANNEL}')
+                # Anything cached before LISTEN took effect may have missed its event
+                clear_all()
+                bus_connected.set()
+                while not self.stopping.is_set():
+                    if select.select([connection], [], [], 1.0) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        apply_payload(connection.notifies.pop(0).payload)
+            except Exception as e:
+                print(f"Cache invalidation listener lost its connection: {e}")
+            finally:
+                bus_connected.clear()
+                clear_all()
+                if connection is not None:
+                    connection.close()
+            self.stopping.wait(RECONNECT_SECONDS)
+
+
+class Poller(threading.Thread):
+    # SQLite: every POLL_SECONDS, invalidate the rows whose version moved
+    def __init__(self, app, get_db):
+        super().__init__(name='cache-invalidation', daemon=True)
+        self.app = app
+        self.get_db = get_db
+        self.stopping = threading.Event()
+        self.seen = None
+
+    def poll(self, db):
+        upper = db.execute('SELECT counter FROM change_feed WHERE id = 1').fetchone()['counter']
+        if self.seen is None:
+            self.seen = upper
+            clear_all()
+            bus_connected.set()
+            return
+        if upper == self.seen:
+            return
+        for table, (entity, column) in POLLED_TABLES.items():
+            for row in db.execute(f'SELECT DISTINCT {column} AS entity_id FROM {table} WHERE version > ? AND version <= ?',
+                                  (self.seen, upper)).fetchall():
+                invalidate(entity, row['entity_id'])
+        for row in db.execute('SELECT table_name, row_id FROM change_tombstones WHERE version > ? AND version <= ?',
+                              (self.seen, upper)).fetchall():
+            if row['table_name'] not in WATCHED_TABLES:
+                continue
+            entity, column = WATCHED_TABLES[row['table_name']]
+            # A deleted history row no longer tells which shipment it belonged to
+            invalidate(entity, row['row_id'] if column == 'id' else None)
+        self.seen = upper
+
+    def run(self):
+        while not self.stopping.wait(POLL_SECONDS):
+            try:
+                with self.app.app_context():
+                    self.poll(self.get_db())
+            except Exception as e:
+                print(f"Cache invalidation poll failed: {e}")
+                bus_connected.clear()
+                clear_all()
+                self.seen = None
+
+
+bus = None
+bus_lock = threading.Lock()
+
+
+def start(app, get_db, postgres, database_url=None):
+    # Called from each worker once its database is ready; a no-op after the first call
+    global bus
+    if not CACHE_ENABLED:
+        return None
+    with bus_lock:
+        if bus is None:
+            bus = Listener(database_url) if postgres else Poller(app, get_db)
+            bus.start()
+    return bus
+
+
+def stop():
+    global bus
+    with bus_lock:
+        if bus is not None:
+            bus.stopping.set()
+            bus = None
+    bus_connected.clear()
@@ -0,0 +1,250 @@
+# Incremental change feed behind GET /api/changes. Every tracked table carries a
+# `version` and an `updated_at` column maintained by triggers, deletes leave a row in
+# change_tombstones, and clients pass back the cursor of their previous call to receive
+# only what changed since.
+#
+# Versions are chosen so that a cursor never skips a row committed after it was issued:
+# - SQLite has a single writer, so a counter bumped inside each write transaction is
+#   already in commit order.
+# - Postgres stamps rows with the id of the writing transaction, and the feed only
+#   serves versions below the oldest transaction still running (snapshot xmin), all of
+#   which have committed or rolled back.
+import os
+from datetime import datetime, timedelta
+
+import repositories
+from common import add_column, create_trigger, execute
+from current_state import ARCHIVED
+
+TRACKED_TABLES = ('shipments', 'tracking_history', 'users', 'locations', 'zones', 'shipping_rates', 'pickup_rates')
+# Columns never served by the feed
+HIDDEN_COLUMNS = {'users': ('password',)}
+# Position of change_tombstones in the feed order, after every tracked table
+TOMBSTONES = len(TRACKED_TABLES)
+PAGE_SIZE = int(os.environ.get('CHANGE_FEED_PAGE_SIZE', 500))
+MAX_PAGE_SIZE = 5000
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get('CHANGE_FEED_TOMBSTONE_RETENTION_DAYS', 30))
+# Rows strictly after the cursor in (version, source, id) order, for a source before,
+# at or after the cursor's; see after()
+CONDITIONS = ('version > ?', '(version, id) > (?, ?)', 'version >= ?')
+
+HORIZON = repositories.Query('change_feed_horizon', 'SELECT horizon FROM change_feed WHERE id = 1')
+COUNTER = repositories.Query('change_feed_counter', 'SELECT counter AS version FROM change_feed WHERE id = 1')
+SNAPSHOT_XMIN = repositories.Query('change_feed_snapshot_xmin', 'SELECT txid_snapshot_xmin(txid_current_snapshot()) - 1 AS version')
+NEWEST_PRUNABLE = repositories.Query('change_tombstones_newest_prunable', 'SELECT MAX(version) AS version FROM change_tombstones WHERE deleted_at < ?')
+PRUNE = repositories.Query('change_tombstones_prune', 'DELETE FROM change_tombstones WHERE version <= ?')
+RAISE_HORIZON = repositories.Query('change_feed_raise_horizon', 'UPDATE change_feed SET horizon = ? WHERE id = 1 AND horizon < ?')
+TABLE_PAGES = {(table, condition): repositories.Query(f'change_feed_{table}_{number}',
+                                                      f'SELECT * FROM {table} WHERE {condition} AND version <= ? ORDER BY version, id LIMIT ?')
+               for table in TRACKED_TABLES for number, condition in enumerate(CONDITIONS)}
+
+
+def tombstone_page(number, condition, filtered):
+    # `filtered` tables in the table_name filter, 0 for none
+    if filtered:
+        condition += f" AND table_name IN ({', '.join('?' * filtered)})"
+    return repositories.Query(f'change_feed_tombstones_{number}_{filtered}', f'''SELECT id, table_name, row_id, version FROM change_tombstones
+        WHERE {condition} AND version <= ? ORDER BY version, id LIMIT ?''')
+
+
+TOMBSTONE_PAGES = {(condition, filtered): tombstone_page(number, condition, filtered)
+                   for number, condition in enumerate(CONDITIONS) for filtered in range(len(TRACKED_TABLES))}
+
+
+class CursorExpired(Exception):
+    # Tombstones the cursor had not seen yet were pruned: the client must resync
+    pass
+
+
+def install(db, postgres):
+    # Existing rows get version 0, so the migration only touches the catalog
+    execute(db, postgres, '''CREATE TABLE IF NOT EXISTS change_feed (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        counter BIGINT NOT NULL,
+        horizon BIGINT NOT NULL
+    )''')
+    execute(db, postgres, 'INSERT INTO change_feed (id, counter, horizon) VALUES (1, 0, 0) ON CONFLICT (id) DO NOTHING')
+    if postgres:
+        execute(db, postgres, '''CREATE TABLE IF NOT EXISTS change_tombstones (
+            id SERIAL PRIMARY KEY,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            version BIGINT NOT NULL,
+            deleted_at TEXT NOT NULL,
+            UNIQUE (table_name, row_id)
+        )''')
+        execute(db, postgres, '''CREATE OR REPLACE FUNCTION track_row_change() RETURNS trigger AS $$
+        BEGIN
+            -- TG_ARGV[0] is the table name: on partitions TG_TABLE_NAME is the partition's
+            IF TG_OP = 'DELETE' THEN
+                INSERT INTO change_tombstones (table_name, row_id, version, deleted_at)
+                VALUES (TG_ARGV[0], OLD.id, txid_current(), to_char(LOCALTIMESTAMP, 'YYYY-MM-DD HH24:MI:SS'))
+                ON CONFLICT (table_name, row_id) DO UPDATE SET version = EXCLUDED.version, deleted_at = EXCLUDED.deleted_at;
+                RETURN OLD;
+            END IF;
+            NEW.version := txid_current();
+            NEW.updated_at := to_char(LOCALTIMESTAMP, 'YYYY-MM-DD HH24:MI:SS');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql''')
+    else:
+        execute(db, postgres, '''CREATE TABLE IF NOT EXISTS change_tombstones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            deleted_at TEXT NOT NULL,
+            UNIQUE (table_name, row_id)
+        )''')
+    execute(db, postgres, 'CREATE INDEX IF NOT EXISTS idx_change_tombstones_version ON change_tombstones (version, id)')
+
+    for table in TRACKED_TABLES:
+        add_column(db, postgres, table, 'version', 'BIGINT NOT NULL DEFAULT 0')
+        add_column(db, postgres, table, 'updated_at', 'TEXT')
+        execute(db, postgres, f'CREATE INDEX IF NOT EXISTS idx_{table}_version ON {table} (version, id)')
+        if postgres:
+            create_trigger(db, postgres, f'trg_{table}_version', table, f'''BEFORE INSERT OR UPDATE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION track_row_change('{table}')''')
+            create_trigger(db, postgres, f'trg_{table}_tombstone', table, f'''AFTER DELETE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION track_row_change('{table}')''')
+            continue
+        # SQLite triggers cannot assign NEW, so they stamp the row right after the write.
+        # recursive_triggers is off, the stamping UPDATE does not fire the trigger again.
+        stamp = f'''UPDATE change_feed SET counter = counter + 1 WHERE id = 1;
+            UPDATE {table} SET version = (SELECT counter FROM change_feed WHERE id = 1),
+                updated_at = strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime') WHERE id = NEW.id;'''
+        execute(db, postgres, f'CREATE TRIGGER IF NOT EXISTS trg_{table}_version_insert AFTER INSERT ON {table} BEGIN {stamp} END')
+        execute(db, postgres, f'CREATE TRIGGER IF NOT EXISTS trg_{table}_version_update AFTER UPDATE ON {table} BEGIN {stamp} END')
+        execute(db, postgres, f'CREATE TRIGGER IF NOT EXISTS trg_{table}_tombstone AFTER DELETE ON {table} BEGIN {sqlite_tombstone(table)} END')
+
+
+def sqlite_tombstone(table):
+    return f'''UPDATE change_feed SET counter = counter + 1 WHERE id = 1;
+        INSERT INTO change_tombstones (table_name, row_id, version, deleted_at)
+        VALUES ('{table}', OLD.id, (SELECT counter FROM change_feed WHERE id = 1), strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime'))
+        ON CONFLICT (table_name, row_id) DO UPDATE SET version = excluded.version, deleted_at = excluded.deleted_at;'''
+
+
+def history_tombstone_function(db, postgres, skipped):
+    # Trigger WHEN conditions cannot hold subqueries on Postgres
+    execute(db, postgres, f'''CREATE OR REPLACE FUNCTION track_history_tombstone() RETURNS trigger AS $$
+        BEGIN
+            IF NOT ({skipped}) THEN
+                INSERT INTO change_tombstones (table_name, row_id, version, deleted_at)
+                VALUES ('tracking_history', OLD.id, txid_current(), to_char(LOCALTIMESTAMP, 'YYYY-MM-DD HH24:MI:SS'))
+                ON CONFLICT (table_name, row_id) DO UPDATE SET version = EXCLUDED.version, deleted_at = EXCLUDED.deleted_at;
+            END IF;
+            RETURN OLD;
+        END
+        $$ LANGUAGE plpgsql''')
+
+
+def skip_archived_tombstones(db, postgres):
+    # Events moved to tracking_history_archive are still served by /api/track: archiving
+    # them must not tell feed clients they were deleted (same test as current_state.py)
+    if postgres:
+        history_tombstone_function(db, postgres, ARCHIVED)
+        execute(db, postgres, 'DROP TRIGGER IF EXISTS trg_tracking_history_tombstone ON tracking_history')
+        execute(db, postgres, '''CREATE TRIGGER trg_tracking_history_tombstone AFTER DELETE ON tracking_history
+            FOR EACH ROW EXECUTE FUNCTION track_history_tombstone()''')
+        return
+    execute(db, postgres, 'DROP TRIGGER IF EXISTS trg_tracking_history_tombstone')
+    execute(db, postgres, f'''CREATE TRIGGER trg_tracking_history_tombstone AFTER DELETE ON tracking_history
+        WHEN NOT {ARCHIVED} BEGIN {sqlite_tombstone('tracking_history')} END''')
+
+
+def skip_moved_tombstones(db, postgres):
+    # Postgres runs an UPDATE that moves an event to another monthly partition (a new
+    # date_time) as a delete and an insert, firing the delete trigger for an event that
+    # still exists. Row triggers run at the end of the statement, after the insert.
+    if postgres:
+        history_tombstone_function(db, postgres, f'{ARCHIVED} OR EXISTS (SELECT 1 FROM tracking_history h WHERE h.id = OLD.id)')
+
+
+def parse_cursor(value):
+    # "<version>" once a page drained everything up to that version, or
+    # "<version>.<source>.<id>" in the middle of a version shared by many rows
+    if not value:
+        return (-1, TOMBSTONES, 0)
+    parts = value.split('.')
+    if len(parts) == 1:
+        return (int(parts[0]), TOMBSTONES, 0)
+    if len(parts) != 3:
+        raise ValueError(value)
+    return tuple(int(part) for part in parts)
+
+
+def format_cursor(position):
+    version, source, row_id = position
+    if source == TOMBSTONES and row_id == 0:
+        return str(version)
+    return f'{version}.{source}.{row_id}'
+
+
+def stable_version(db, postgres):
+    # Highest version every row of which is committed
+    return repositories.fetch_one(db, SNAPSHOT_XMIN if postgres else COUNTER)['version']
+
+
+def after(source, position):
+    # Rows strictly after the cursor in (version, source, id) order
+    version, cursor_source, row_id = position
+    if source < cursor_source:
+        return CONDITIONS[0], (version,)
+    if source == cursor_source:
+        return CONDITIONS[1], (version, row_id)
+    return CONDITIONS[2], (version,)
+
+
+def read_changes(db, postgres, since=None, limit=PAGE_SIZE, tables=TRACKED_TABLES):
+    position = parse_cursor(since)
+    horizon = repositories.fetch_one(db, HORIZON)['horizon']
+    if since and position[0] < horizon:
+        raise CursorExpired(since)
+    upper = stable_version(db, postgres)
+
+    # Each source returns at most limit + 1 rows in version order; merged, the first
+    # `limit` are the page and anything beyond means there is more to fetch
+    entries = []
+    for source, table in enumerate(TRACKED_TABLES):
+        if table not in tables:
+            continue
+        condition, params = after(source, position)
+        for row in repositories.fetch_all(db, TABLE_PAGES[(table, condition)], params + (upper, limit + 1)):
+            value = repositories.as_dict(row)
+            for column in HIDDEN_COLUMNS.get(table, ()):
+                del value[column]
+            entries.append((row['version'], source, row['id'], table, value))
+    condition, params = after(TOMBSTONES, position)
+    # Only filtered when asked: with the filter SQLite may prefer the (table_name, row_id) index
+    filtered = () if set(tables) == set(TRACKED_TABLES) else tuple(table for table in TRACKED_TABLES if table in tables)
+    query = TOMBSTONE_PAGES[(condition, len(filtered))]
+    for row in repositories.fetch_all(db, query, params + filtered + (upper, limit + 1)):
+        entries.append((row['version'], TOMBSTONES, row['id'], row['table_name'], row['row_id']))
+    db.commit()
+
+    entries.sort(key=lambda entry: entry[:3])
+    has_more = len(entries) > limit
+    page = entries[:limit]
+    changes = {table: [] for table in tables}
+    deleted = {table: [] for table in tables}
+    for version, source, row_id, table, value in page:
+        if source == TOMBSTONES:
+            deleted[table].append(value)
+        else:
+            changes[table].append(value)
+    cursor = format_cursor(page[-1][:3]) if has_more else str(max(upper, position[0]))
+    return {'cursor': cursor, 'has_more': has_more, 'changes': changes, 'deleted': deleted}
+
+
+def prune_tombstones(db, postgres, retention_days=TOMBSTONE_RETENTION_DAYS):
+    # Cursors older than the newest pruned tombstone can no longer be served (410)
+    cutoff = (datetime.now() - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+    newest = repositories.fetch_one(db, NEWEST_PRUNABLE, (cutoff,))['version']
+    if newest is None:
+        db.commit()
+        return {'deleted': 0, 'cutoff': cutoff}
+    deleted = repositories.write(db, PRUNE, (newest,))
+    repositories.write(db, RAISE_HORIZON, (newest, newest))
+    db.commit()
+    return {'deleted': deleted, 'cutoff': cutoff, 'horizon': newest}
@@ -0,0 +1,54 @@
+# Helpers shared by the feature modules: execute() runs a statement written once with ?
+# placeholders on either dialect, add_column() and create_trigger() are schema steps a
+# migration can repeat, LRU is a small thread-safe least-recently-used map.
+import threading
+from collections import OrderedDict
+
+
+def execute(db, postgres, sql, params=None):
+    # Statements are written with ? placeholders and translated for psycopg2
+    if postgres:
+        cursor = db.cursor()
+        cursor.execute(sql.replace('?', '%s'), params)
+        return cursor
+    return db.execute(sql, params or ())
+
+
+def add_column(db, postgres, table, column, definition):
+    # No-op when the column exists, so a migration interrupted after it can run again
+    if postgres:
+        execute(db, postgres, f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}')
+        return
+    if column not in {row['name'] for row in execute(db, postgres, f'PRAGMA table_info({table})').fetchall()}:
+        execute(db, postgres, f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def create_trigger(db, postgres, name, table, definition):
+    # definition: everything after the trigger name. Postgres has no CREATE TRIGGER IF
+    # NOT EXISTS: the trigger is dropped and recreated, in the migration's transaction
+    if postgres:
+        execute(db, postgres, f'DROP TRIGGER IF EXISTS {name} ON {table}')
+        execute(db, postgres, f'CREATE TRIGGER {name} {definition}')
+        return
+    execute(db, postgres, f'CREATE TRIGGER IF NOT EXISTS {name} {definition}')
+
+
+class LRU:
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
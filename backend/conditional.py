@@ -0,0 +1,162 @@
+# Conditional GET for the reference data listings and /api/track/<tracking_number>.
+# Triggers keep a version stamp per resource in resource_versions, bumped in the
+# writing transaction: one row per reference table (resource_id 0) and one per
+# shipment for its tracking payload (shipment, history, progress). The ETag and
+# Last-Modified of a response come from that row alone, so a client whose copy is
+# current gets a 304 without the payload being loaded or serialized.
+#
+# Cache-Control lets browsers and a CDN reuse a response for a short while and then
+# revalidate it, which costs a primary-key lookup.
+import os
+from datetime import datetime, timezone
+
+from flask import Response, make_response, request
+
+import repositories
+from common import create_trigger, execute
+
+REFERENCE_RESOURCES = ('locations', 'zones', 'shipping_rates', 'pickup_rates')
+# table -> column holding the shipment id, for the 'track' resource
+TRACK_SOURCES = {'shipments': 'id', 'tracking_history': 'shipment_id', 'shipment_progress': 'shipment_id'}
+REFERENCE_CACHE_CONTROL = os.environ.get('REFERENCE_CACHE_CONTROL', 'public, max-age=60, stale-while-revalidate=3600')
+TRACK_CACHE_CONTROL = os.environ.get('TRACK_CACHE_CONTROL', 'public, max-age=15, stale-while-revalidate=60')
+
+NOW_MS_POSTGRES = "(EXTRACT(EPOCH FROM clock_timestamp()) * 1000)::BIGINT"
+NOW_MS_SQLITE = "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)"
+
+
+BUMP = '''INSERT INTO resource_versions (resource, resource_id, version, modified_ms)
+        SELECT {resource}, {resource_id}, 1, {now_ms} {guard}
+        ON CONFLICT (resource, resource_id) DO UPDATE SET version = resource_versions.version + 1, modified_ms = excluded.modified_ms;'''
+
+
+def bump_reference(resource, now_ms):
+    # `resource` is an SQL expression
+    return BUMP.format(resource=resource, resource_id=0, now_ms=now_ms, guard='')
+
+
+def bump_track(shipment, now_ms):
+    # A shipment being deleted gets no new row, like shipment_current_state
+    return BUMP.format(resource="'track'", resource_id=shipment, now_ms=now_ms,
+                       guard=f'WHERE EXISTS (SELECT 1 FROM shipments WHERE id = {shipment})')
+
+
+def install(db, postgres):
+    execute(db, postgres, '''CREATE TABLE IF NOT EXISTS resource_versions (
+        resource TEXT NOT NULL,
+        resource_id INTEGER NOT NULL,
+        version BIGINT NOT NULL,
+        modified_ms BIGINT NOT NULL,
+        PRIMARY KEY (resource, resource_id)
+    )''')
+    now_ms = NOW_MS_POSTGRES if postgres else NOW_MS_SQLITE
+    if postgres:
+        execute(db, postgres, f'''CREATE OR REPLACE FUNCTION bump_resource_version() RETURNS trigger AS $$
+        DECLARE
+            target INTEGER;
+        BEGIN
+            -- TG_ARGV[0]: resource. Reference tables bump once per statement; track
+            -- triggers run per row, TG_ARGV[1] naming the column with the shipment id.
+            IF TG_LEVEL = 'STATEMENT' THEN
+                {bump_reference('TG_ARGV[0]', now_ms)}
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'DELETE' AND TG_TABLE_NAME = 'shipments' THEN
+                DELETE FROM resource_versions WHERE resource = 'track' AND resource_id = OLD.id;
+                RETURN NULL;
+            END IF;
+            IF TG_OP <> 'INSERT' THEN
+                target := (to_jsonb(OLD) ->> TG_ARGV[1])::INTEGER;
+                {bump_track('target', now_ms)}
+            END IF;
+            IF TG_OP <> 'DELETE' AND (TG_OP = 'INSERT' OR (to_jsonb(NEW) ->> TG_ARGV[1])::INTEGER IS DISTINCT FROM target) THEN
+                target := (to_jsonb(NEW) ->> TG_ARGV[1])::INTEGER;
+                {bump_track('target', now_ms)}
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql''')
+        for table in REFERENCE_RESOURCES:
+            create_trigger(db, postgres, f'trg_{table}_resource_version', table, f'''AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+                FOR EACH STATEMENT EXECUTE FUNCTION bump_resource_version('{table}')''')
+        for table, column in TRACK_SOURCES.items():
+            create_trigger(db, postgres, f'trg_{table}_track_version', table, f'''AFTER INSERT OR UPDATE OR DELETE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION bump_resource_version('track', '{column}')''')
+    else:
+        for table in REFERENCE_RESOURCES:
+            for operation in ('INSERT', 'UPDATE', 'DELETE'):
+                execute(db, postgres, f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_resource_version_{operation.lower()}
+                    AFTER {operation} ON {table} BEGIN {bump_reference(f"'{table}'", now_ms)} END''')
+        for table, column in TRACK_SOURCES.items():
+            execute(db, postgres, f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_track_version_insert
+                AFTER INSERT ON {table} BEGIN {bump_track(f'NEW.{column}', now_ms)} END''')
+            execute(db, postgres, f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_track_version_update
+                AFTER UPDATE ON {table} BEGIN {bump_track(f'OLD.{column}', now_ms)} {bump_track(f'NEW.{column}', now_ms)} END''')
+            if table != 'shipments':
+                execute(db, postgres, f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_track_version_delete
+                    AFTER DELETE ON {table} BEGIN {bump_track(f'OLD.{column}', now_ms)} END''')
+        execute(db, postgres, '''CREATE TRIGGER IF NOT EXISTS trg_shipments_track_version_delete AFTER DELETE ON shipments BEGIN
+            DELETE FROM resource_versions WHERE resource = 'track' AND resource_id = OLD.id;
+        END''')
+    for resource in REFERENCE_RESOURCES:
+        execute(db, postgres, f'''INSERT INTO resource_versions (resource, resource_id, version, modified_ms)
+            VALUES (?, 0, 1, {now_ms}) ON CONFLICT (resource, resource_id) DO NOTHING''', (resource,))
+    execute(db, postgres, f'''INSERT INTO resource_versions (resource, resource_id, version, modified_ms)
+        SELECT 'track', id, 1, {now_ms} FROM shipments WHERE TRUE ON CONFLICT (resource, resource_id) DO NOTHING''')
+
+
+REFERENCE_STAMP = repositories.Query('resource_versions_reference', '''SELECT version, modified_ms FROM resource_versions
+    WHERE resource = ? AND resource_id = 0''')
+TRACK_STAMP = repositories.Query('resource_versions_track', '''SELECT v.version, v.modified_ms FROM shipments s
+    JOIN resource_versions v ON v.resource = 'track' AND v.resource_id = s.id
+    WHERE s.tracking_number = ?''')
+
+
+def reference_stamp(db, postgres, resource):
+    return repositories.fetch_one(db, REFERENCE_STAMP, (resource,))
+
+
+def track_stamp(db, postgres, tracking_number):
+    # None for an unknown tracking number
+    return repositories.fetch_one(db, TRACK_STAMP, (tracking_number,))
+
+
+def etag(resource, stamp):
+    # Strong: the stamp changes with every write to the resource. The modification time
+    # keeps tags of a rebuilt database from matching old ones.
+    return f'{resource}-{stamp["version"]}-{stamp["modified_ms"]}'
+
+
+def last_modified(stamp):
+    return datetime.fromtimestamp(stamp['modified_ms'] // 1000, tz=timezone.utc)
+
+
+def is_current(tag, modified):
+    return is_fresh(tag, modified, request.if_none_match, request.if_modified_since)
+
+
+def is_fresh(tag, modified, if_none_match, since):
+    # If-None-Match wins over If-Modified-Since when both are sent
+    if if_none_match:
+        return if_none_match.contains(tag)
+    return since is not None and modified <= since
+
+
+def respond(resource, stamp, build, cache_control):
+    # `build` makes the full response; it is not called for a 304. Without a stamp the
+    # response is unconditional.
+    if stamp is None:
+        return make_response(build())
+    tag, modified = etag(resource, stamp), last_modified(stamp)
+    if is_current(tag, modified):
+        response = Response(status=304)
+    else:
+        response = make_response(build())
+        if response.status_code != 200:
+            return response
+    response.set_etag(tag)
+    response.last_modified = modified
+    response.headers['Cache-Control'] = cache_control
+    # Access-Control-Allow-Origin echoes the Origin header
+    response.vary.add('Origin')
+    return response
@@ -0,0 +1,175 @@
+# Materialized current state of every shipment: its latest tracking event, how many
+# events it has and its last reported progress, one row per shipment. Triggers on
+# tracking_history and shipment_progress update it inside the writing transaction, so
+# every write path (API routes, SLA sweep, archiving, direct SQL) keeps it exact and
+# listing and tracking read one row by primary key instead of sorting history.
+#
+# The latest event is the one with the greatest (date_time, id), as in the history
+# queries. Archiving moves events out of tracking_history without changing the state.
+import history_archive
+from common import create_trigger, execute
+
+EVENT_COLUMNS = ('status', 'location', 'description', 'latitude', 'longitude')
+PROGRESS_COLUMNS = ('progress', 'current_lat', 'current_lng')
+# Columns whose edits can change which event is the latest or what it says
+EVENT_UPDATE_COLUMNS = ('shipment_id', 'date_time') + EVENT_COLUMNS
+
+# Added to each row of the shipments listing
+LISTED_COLUMNS = 'c.location AS current_location, c.last_event_at, COALESCE(c.event_count, 0) AS event_count, c.progress'
+
+
+def ensure_row(shipment):
+    # `shipment` is an SQL expression (NEW.shipment_id, OLD.shipment_id); a shipment
+    # being deleted gets no new row
+    return f'''INSERT INTO shipment_current_state (shipment_id) SELECT {shipment}
+        WHERE EXISTS (SELECT 1 FROM shipments WHERE id = {shipment})
+        ON CONFLICT (shipment_id) DO NOTHING;'''
+
+
+def recompute(shipment):
+    columns = ', '.join(EVENT_COLUMNS)
+    return ensure_row(shipment) + f'''
+        UPDATE shipment_current_state SET
+            ({columns}, last_event_id, last_event_at) = (SELECT {columns}, id, date_time FROM tracking_history
+                WHERE shipment_id = {shipment} ORDER BY date_time DESC, id DESC LIMIT 1),
+            event_count = (SELECT COUNT(*) FROM tracking_history WHERE shipment_id = {shipment})
+                + COALESCE((SELECT event_count FROM tracking_history_archive WHERE shipment_id = {shipment}), 0)
+        WHERE shipment_id = {shipment};'''
+
+
+def record_event():
+    # Inserts are the hot path: bump the count, and take the event over if it is the latest
+    columns = ', '.join(EVENT_COLUMNS)
+    values = ', '.join(f'NEW.{column}' for column in EVENT_COLUMNS)
+    assignments = ', '.join(f'{column} = NEW.{column}' for column in EVENT_COLUMNS)
+    return f'''INSERT INTO shipment_current_state (shipment_id, {columns}, last_event_id, last_event_at, event_count)
+        VALUES (NEW.shipment_id, {values}, NEW.id, NEW.date_time, 1)
+        ON CONFLICT (shipment_id) DO UPDATE SET event_count = shipment_current_state.event_count + 1;
+        UPDATE shipment_current_state SET {assignments}, last_event_id = NEW.id, last_event_at = NEW.date_time
+        WHERE shipment_id = NEW.shipment_id AND (last_event_at IS NULL OR last_event_at <= NEW.date_time);'''
+
+
+def record_progress(values):
+    columns = ', '.join(PROGRESS_COLUMNS)
+    row = ', '.join(f'{values}.{column}' for column in PROGRESS_COLUMNS) if values else ', '.join('NULL' for _ in PROGRESS_COLUMNS)
+    updated = f'{values}.last_updated' if values else 'NULL'
+    shipment = f'{values or "OLD"}.shipment_id'
+    return ensure_row(shipment) + f'''
+        UPDATE shipment_current_state SET ({columns}, progress_updated) = ({row}, {updated})
+        WHERE shipment_id = {shipment};'''
+
+
+# A deleted event already folded into the archive row is being archived, not removed
+ARCHIVED = 'EXISTS (SELECT 1 FROM tracking_history_archive a WHERE a.shipment_id = OLD.shipment_id AND a.last_event >= OLD.date_time)'
+
+
+def install(db, postgres):
+    execute(db, postgres, f'''CREATE TABLE IF NOT EXISTS shipment_current_state (
+        shipment_id INTEGER PRIMARY KEY REFERENCES shipments (id) ON DELETE CASCADE,
+        status TEXT,
+        location TEXT,
+        description TEXT,
+        latitude REAL,
+        longitude REAL,
+        last_event_id INTEGER,
+        last_event_at TEXT,
+        event_count INTEGER NOT NULL DEFAULT 0,
+        progress REAL,
+        current_lat REAL,
+        current_lng REAL,
+        progress_updated TEXT,
+        version BIGINT NOT NULL DEFAULT 0
+    )''')
+    event_columns = ', '.join(EVENT_UPDATE_COLUMNS)
+    if postgres:
+        execute(db, postgres, f'''CREATE OR REPLACE FUNCTION track_current_event() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                {record_event()}
+            ELSIF TG_OP = 'UPDATE' THEN
+                IF OLD.shipment_id <> NEW.shipment_id THEN
+                    {recompute('OLD.shipment_id')}
+                END IF;
+                {recompute('NEW.shipment_id')}
+            ELSIF NOT {ARCHIVED} THEN
+                {recompute('OLD.shipment_id')}
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql''')
+        execute(db, postgres, f'''CREATE OR REPLACE FUNCTION track_current_progress() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                {record_progress(None)}
+            ELSE
+                {record_progress('NEW')}
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql''')
+        create_trigger(db, postgres, 'trg_tracking_history_current_state', 'tracking_history', f'''
+            AFTER INSERT OR UPDATE OF {event_columns} OR DELETE ON tracking_history
+            FOR EACH ROW EXECUTE FUNCTION track_current_event()''')
+        create_trigger(db, postgres, 'trg_shipment_progress_current_state', 'shipment_progress', '''AFTER INSERT OR UPDATE OR DELETE ON shipment_progress
+            FOR EACH ROW EXECUTE FUNCTION track_current_progress()''')
+        # Progress is not in a watched table: its changes reach the caches through here
+        create_trigger(db, postgres, 'trg_shipment_current_state_invalidate', 'shipment_current_state', '''AFTER INSERT OR UPDATE OR DELETE ON shipment_current_state
+            FOR EACH ROW EXECUTE FUNCTION notify_invalidation('shipments', 'shipment_id')''')
+    else:
+        execute(db, postgres, f'CREATE TRIGGER IF NOT EXISTS trg_tracking_history_current_state_insert AFTER INSERT ON tracking_history BEGIN {record_event()} END')
+        # The change feed's version stamp is an UPDATE too: only real edits recompute
+        execute(db, postgres, f'''CREATE TRIGGER IF NOT EXISTS trg_tracking_history_current_state_update
+            AFTER UPDATE OF {event_columns} ON tracking_history BEGIN {recompute('NEW.shipment_id')} END''')
+        execute(db, postgres, f'''CREATE TRIGGER IF NOT EXISTS trg_tracking_history_current_state_move
+            AFTER UPDATE OF shipment_id ON tracking_history WHEN OLD.shipment_id <> NEW.shipment_id
+            BEGIN {recompute('OLD.shipment_id')} END''')
+        execute(db, postgres, f'''CREATE TRIGGER IF NOT EXISTS trg_tracking_history_current_state_delete
+            AFTER DELETE ON tracking_history WHEN NOT {ARCHIVED} BEGIN {recompute('OLD.shipment_id')} END''')
+        # SQLite caches learn about progress from the change-feed counter, like the
+        # tables the invalidation poller watches
+        stamp = '''UPDATE change_feed SET counter = counter + 1 WHERE id = 1;
+            UPDATE shipment_current_state SET version = (SELECT counter FROM change_feed WHERE id = 1) WHERE shipment_id = {0}.shipment_id;'''
+        execute(db, postgres, f"CREATE TRIGGER IF NOT EXISTS trg_shipment_progress_current_state_insert AFTER INSERT ON shipment_progress BEGIN {record_progress('NEW')} {stamp.format('NEW')} END")
+        execute(db, postgres, f"CREATE TRIGGER IF NOT EXISTS trg_shipment_progress_current_state_update AFTER UPDATE ON shipment_progress BEGIN {record_progress('NEW')} {stamp.format('NEW')} END")
+        execute(db, postgres, f"CREATE TRIGGER IF NOT EXISTS trg_shipment_progress_current_state_delete AFTER DELETE ON shipment_progress BEGIN {record_progress(None)} {stamp.format('OLD')} END")
+        execute(db, postgres, 'CREATE INDEX IF NOT EXISTS idx_shipment_current_state_version ON shipment_current_state (version)')
+    rebuild(db, postgres)
+
+
+def rebuild(db, postgres):
+    # Recomputes every row from history, the archive and progress, in the caller's
+    # transaction; returns the row count
+    columns = ', '.join(EVENT_COLUMNS)
+    latest = ', '.join(f'l.{column}' for column in EVENT_COLUMNS)
+    progress = ', '.join(f'p.{column}' for column in PROGRESS_COLUMNS)
+    execute(db, postgres, 'DELETE FROM shipment_current_state')
+    execute(db, postgres, f'''INSERT INTO shipment_current_state
+            (shipment_id, {columns}, last_event_id, last_event_at, event_count, {', '.join(PROGRESS_COLUMNS)}, progress_updated)
+        SELECT s.id, {latest}, l.id, l.date_time,
+            (SELECT COUNT(*) FROM tracking_history h WHERE h.shipment_id = s.id) + COALESCE(a.event_count, 0),
+            {progress}, p.last_updated
+        FROM shipments s
+        LEFT JOIN tracking_history l ON l.id = (SELECT h.id FROM tracking_history h WHERE h.shipment_id = s.id
+            ORDER BY h.date_time DESC, h.id DESC LIMIT 1)
+        LEFT JOIN tracking_history_archive a ON a.shipment_id = s.id
+        LEFT JOIN shipment_progress p ON p.shipment_id = s.id''')
+    # Shipments whose whole history is archived: take the last packed event
+    for row in execute(db, postgres, '''SELECT c.shipment_id, a.events FROM shipment_current_state c
+            JOIN tracking_history_archive a ON a.shipment_id = c.shipment_id WHERE c.last_event_id IS NULL''').fetchall():
+        event = history_archive.unpack_events(row['shipment_id'], row['events'])[-1]
+        execute(db, postgres, f'''UPDATE shipment_current_state SET ({columns}, last_event_id, last_event_at) = (?, ?, ?, ?, ?, ?, ?)
+            WHERE shipment_id = ?''', tuple(event[column] for column in EVENT_COLUMNS) + (event['id'], event['date_time'], row['shipment_id']))
+    return execute(db, postgres, 'SELECT COUNT(*) AS shipments FROM shipment_current_state').fetchone()['shipments']
+
+
+# The state as served to clients; other columns are bookkeeping or index support
+SERVED_COLUMNS = ('shipment_id',) + EVENT_COLUMNS + ('last_event_id', 'last_event_at', 'event_count') + PROGRESS_COLUMNS + ('progress_updated',)
+
+
+FETCH_SQL = f"SELECT {', '.join(SERVED_COLUMNS)} FROM shipment_current_state WHERE shipment_id = ?"
+
+
+def fetch(db, postgres, shipment_id):
+    # None for a shipment without events or progress
+    row = execute(db, postgres, FETCH_SQL, (shipment_id,)).fetchone()
+    return dict(row) if row is not None else None
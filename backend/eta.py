@@ -0,0 +1,281 @@
+# Distances and delivery estimates between locations. Every worker keeps an all-pairs
+# great-circle distance matrix of the locations that have coordinates, rebuilt when the
+# table changes, so an ETA between two known places is a couple of dict lookups and one
+# array read. Delivered shipments' tracking history supplies observed transit times per
+# origin/destination lane; lanes without enough history fall back to a distance model.
+# Lanes are recomputed by a background thread of each worker on its own connection, and
+# requests read the latest snapshot.
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import cache
+from common import add_column, execute
+
+EARTH_RADIUS_KM = 6371.0
+# service -> (average speed in km/h, handling hours before the parcel moves)
+SERVICES = {
+    'economy': (30.0, 48.0),
+    'standard': (50.0, 24.0),
+    'express': (80.0, 12.0),
+}
+DEFAULT_SERVICE = 'standard'
+# Extra hours per km of distance, capped, as the shipment form has always added
+BUFFER_HOURS_PER_KM = 0.1
+MAX_BUFFER_HOURS = 48.0
+# A lane needs this many delivered shipments before its history is trusted
+MIN_LANE_SAMPLES = int(os.environ.get('ETA_MIN_LANE_SAMPLES', 3))
+LANE_WINDOW_DAYS = int(os.environ.get('ETA_LANE_WINDOW_DAYS', 180))
+# 0 disables the refresher: every lane then uses the distance model
+LANE_REFRESH_SECONDS = int(os.environ.get('ETA_LANE_REFRESH_SECONDS', 3600))
+# Rows of the matrix computed per step, bounding the temporaries to BLOCK_ROWS x n
+BLOCK_ROWS = 256
+
+# Coordinates of the default locations, for databases seeded before locations had them
+DEFAULT_COORDINATES = {
+    'paris': (48.8566, 2.3522),
+    'lyon': (45.7640, 4.8357),
+    'marseille': (43.2965, 5.3698),
+    'toulouse': (43.6047, 1.4442),
+    'nice': (43.7102, 7.2620),
+    'nantes': (47.2184, -1.5536),
+    'strasbourg': (48.5734, 7.7521),
+    'montpellier': (43.6108, 3.8767),
+    'bordeaux': (44.8378, -0.5792),
+    'lille': (50.6292, 3.0573),
+}
+
+# Same formats as src/utils/coordinates.ts: 12°46'50.4"N 77°29'50.2"E or 12.780667, 77.497278
+DMS_PATTERN = re.compile(r'(-?\d+)°\s*(\d+)[′\']\s*([\d.]+)[″"]?\s*([NS])\s+(-?\d+)°\s*(\d+)[′\']\s*([\d.]+)[″"]?\s*([EW])', re.IGNORECASE)
+DECIMAL_PATTERN = re.compile(r'^\s*(-?\d+\.?\d*),\s*(-?\d+\.?\d*)\s*$')
+
+
+def add_coordinates(db, postgres):
+    add_column(db, postgres, 'locations', 'latitude', 'REAL')
+    add_column(db, postgres, 'locations', 'longitude', 'REAL')
+    for slug, (latitude, longitude) in DEFAULT_COORDINATES.items():
+        execute(db, postgres, 'UPDATE locations SET latitude = ?, longitude = ? WHERE slug = ? AND latitude IS NULL',
+                (latitude, longitude, slug))
+
+
+def parse_coordinates(text):
+    match = DMS_PATTERN.search(text)
+    if match:
+        lat_deg, lat_min, lat_sec, lat_dir, lon_deg, lon_min, lon_sec, lon_dir = match.groups()
+        latitude = int(lat_deg) + int(lat_min) / 60 + float(lat_sec) / 3600
+        longitude = int(lon_deg) + int(lon_min) / 60 + float(lon_sec) / 3600
+        if lat_dir.upper() == 'S':
+            latitude = -latitude
+        if lon_dir.upper() == 'W':
+            longitude = -longitude
+        return latitude, longitude
+    match = DECIMAL_PATTERN.match(text)
+    if match:
+        return float(match.group(1)), float(match.group(2))
+    return None
+
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    # Broadcasts: scalars, or arrays of compatible shapes, in degrees
+    latitude1, longitude1, latitude2, longitude2 = (np.radians(value) for value in (latitude1, longitude1, latitude2, longitude2))
+    a = (np.sin((latitude2 - latitude1) / 2) ** 2
+         + np.cos(latitude1) * np.cos(latitude2) * np.sin((longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+class DistanceMatrix:
+    def __init__(self, rows, stamp):
+        self.stamp = stamp
+        self.locations = [dict(row) for row in rows]
+        self.latitudes = np.array([row['latitude'] for row in self.locations], dtype=np.float64)
+        self.longitudes = np.array([row['longitude'] for row in self.locations], dtype=np.float64)
+        # Names and slugs, case-insensitive, to matrix index
+        self.index = {}
+        for position, row in enumerate(self.locations):
+            self.index.setdefault(row['slug'].lower(), position)
+            self.index.setdefault(row['name'].strip().lower(), position)
+        count = len(self.locations)
+        self.km = np.empty((count, count), dtype=np.float32)
+        for start in range(0, count, BLOCK_ROWS):
+            stop = min(start + BLOCK_ROWS, count)
+            self.km[start:stop] = haversine_km(self.latitudes[start:stop, None], self.longitudes[start:stop, None],
+                                               self.latitudes[None, :], self.longitudes[None, :])
+
+    def find(self, place):
+        # A location name or slug, "Name, anything" or coordinates; returns
+        # (matrix index or None, latitude, longitude) or None
+        text = place.strip()
+        key = text.lower()
+        position = self.index.get(key)
+        if position is None and ',' in key:
+            position = self.index.get(key.split(',', 1)[0].strip())
+        if position is not None:
+            return position, float(self.latitudes[position]), float(self.longitudes[position])
+        coordinates = parse_coordinates(text)
+        if coordinates is None:
+            return None
+        return None, coordinates[0], coordinates[1]
+
+    def distance(self, origin, destination):
+        if origin[0] is not None and destination[0] is not None:
+            return float(self.km[origin[0], destination[0]])
+        return float(haversine_km(origin[1], origin[2], destination[1], destination[2]))
+
+
+matrix_cache = cache.Cache('distance_matrix', size=1)
+latest_matrix = None
+# Replaced whole by the refresher, never mutated: readers need no lock
+lanes = {}
+
+
+def load_matrix(db, postgres):
+    # Without the invalidation bus this runs on every call: the stamp check keeps it to
+    # one small aggregate query unless the table really changed
+    global latest_matrix
+    row = execute(db, postgres, 'SELECT COUNT(*) AS locations, MAX(version) AS version FROM locations').fetchone()
+    stamp = (row['locations'], row['version'])
+    if latest_matrix is not None and latest_matrix.stamp == stamp:
+        return latest_matrix
+    rows = execute(db, postgres, '''SELECT id, name, slug, country, latitude, longitude FROM locations
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL ORDER BY id''').fetchall()
+    latest_matrix = DistanceMatrix(rows, stamp)
+    return latest_matrix
+
+
+def get_matrix(db, postgres):
+    return matrix_cache.get_or_load('matrix', [('locations', None)], lambda: load_matrix(db, postgres))
+
+
+def lane_key(origin, destination):
+    return origin.strip().lower(), destination.strip().lower()
+
+
+def parse_time(value):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def load_lanes(db, postgres):
+    # Observed hours from first to last event of recently delivered shipments, hot and
+    # archived history alike, reduced to a median per lane
+    since = (datetime.now() - timedelta(days=LANE_WINDOW_DAYS)).strftime('%Y-%m-%d')
+    # The per-shipment MIN/MAX are single probes of idx_tracking_history_shipment; archived
+    # shipments have no hot history left and use their archive row instead
+    rows = execute(db, postgres, '''SELECT s.origin, s.destination,
+            COALESCE((SELECT MIN(h.date_time) FROM tracking_history h WHERE h.shipment_id = s.id), a.first_event) AS started,
+            COALESCE((SELECT MAX(h.date_time) FROM tracking_history h WHERE h.shipment_id = s.id), a.last_event) AS finished
+        FROM shipments s LEFT JOIN tracking_history_archive a ON a.shipment_id = s.id
+        WHERE s.status = 'delivered' AND s.date_created >= ?''', (since,)).fetchall()
+    samples = {}
+    for row in rows:
+        started, finished = parse_time(row['started']), parse_time(row['finished'])
+        if started is None or finished is None or finished <= started:
+            continue
+        samples.setdefault(lane_key(row['origin'], row['destination']), []).append((finished - started).total_seconds() / 3600)
+    return {key: (float(np.median(hours)), len(hours)) for key, hours in samples.items() if len(hours) >= MIN_LANE_SAMPLES}
+
+
+def refresh_lanes(db, postgres):
+    global lanes
+    loaded = load_lanes(db, postgres)
+    db.commit()
+    lanes = loaded
+    return loaded
+
+
+class LaneRefresher(threading.Thread):
+    def __init__(self, app, get_db, postgres, interval):
+        super().__init__(name='eta-lanes', daemon=True)
+        self.app = app
+        self.get_db = get_db
+        self.postgres = postgres
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        # First load right away: until then every lane uses the distance model
+        delay = 0
+        while not self.stopping.wait(delay):
+            delay = self.interval
+            try:
+                with self.app.app_context():
+                    refresh_lanes(self.get_db(), self.postgres)
+            except Exception as e:
+                print(f"ETA lane refresh failed: {e}")
+
+
+refresher = None
+refresher_lock = threading.Lock()
+
+
+def start(app, get_db, postgres, interval=LANE_REFRESH_SECONDS):
+    # Called from each worker once its database is ready; a no-op after the first call
+    global refresher
+    if interval <= 0:
+        return None
+    with refresher_lock:
+        if refresher is None:
+            refresher = LaneRefresher(app, get_db, postgres, interval)
+            refresher.start()
+    return refresher
+
+
+def stop():
+    global refresher
+    with refresher_lock:
+        if refresher is not None:
+            refresher.stopping.set()
+            refresher = None
+
+
+def model_hours(distance_km, service):
+    speed, handling = SERVICES[service]
+    return handling + distance_km / speed + min(distance_km * BUFFER_HOURS_PER_KM, MAX_BUFFER_HOURS)
+
+
+def estimate(db, postgres, origin, destination, service=DEFAULT_SERVICE, start=None):
+    # Raises ValueError for an unknown service or a place that is neither a known
+    # location nor coordinates
+    if service not in SERVICES:
+        raise ValueError(f"Unknown service '{service}', expected one of: {', '.join(SERVICES)}")
+    matrix = get_matrix(db, postgres)
+    origin_place = matrix.find(origin)
+    if origin_place is None:
+        raise ValueError(f"Unknown origin '{origin}'")
+    destination_place = matrix.find(destination)
+    if destination_place is None:
+        raise ValueError(f"Unknown destination '{destination}'")
+    distance = matrix.distance(origin_place, destination_place)
+    hours = model_hours(distance, service)
+    basis, samples = 'distance', 0
+    lane = lanes.get(lane_key(origin, destination))
+    if lane is not None:
+        # History is for whatever mix of services the lane carried: scale it by how
+        # this service compares with standard on that distance
+        observed, samples = lane
+        hours = observed * hours / model_hours(distance, DEFAULT_SERVICE)
+        basis = 'history'
+    arrival = (start or datetime.now()) + timedelta(hours=hours)
+    return {
+        'origin': matrix.locations[origin_place[0]] if origin_place[0] is not None else {'latitude': origin_place[1], 'longitude': origin_place[2]},
+        'destination': matrix.locations[destination_place[0]] if destination_place[0] is not None else {'latitude': destination_place[1], 'longitude': destination_place[2]},
+        'service': service,
+        'distance_km': round(distance, 1),
+        'hours': round(hours, 1),
+        'basis': basis,
+        'samples': samples,
+        'expected_delivery': arrival.strftime('%Y-%m-%d'),
+    }
+
+
+def expected_delivery(db, postgres, origin, destination, service=None):
+    # For filling in shipments: '' when the places cannot be resolved
+    try:
+        return estimate(db, postgres, origin or '', destination or '', service if service in SERVICES else DEFAULT_SERVICE)['expected_delivery']
+    except ValueError:
+        return ''
@@ -0,0 +1,202 @@
+# GPS pings behind POST /api/shipments/<id>/gps and GET /api/shipments/<id>/route.
+# Pings are not stored one row each: a shipment's pings are appended to packed blocks
+# of up to BLOCK_POINTS points, 16 bytes a point (int32 milliseconds since the block's
+# base time, float32 latitude, longitude and progress), so a long trip is a handful of
+# rows. Routes are simplified with Douglas-Peucker to about a pixel at the requested map
+# zoom, which turns thousands of pings into a few hundred points.
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+import cache
+import repositories
+from common import execute
+
+POINT = np.dtype([('offset', '<i4'), ('lat', '<f4'), ('lng', '<f4'), ('progress', '<f4')])
+BLOCK_POINTS = int(os.environ.get('GPS_BLOCK_POINTS', 1024))
+# Offsets are int32 milliseconds: a block spans at most about 24 days
+MAX_OFFSET_MS = 2 ** 31 - 1
+MAX_BATCH = 5000
+# Simplification tolerance in screen pixels of a 256-pixel Web Mercator tile
+TOLERANCE_PIXELS = float(os.environ.get('GPS_TOLERANCE_PIXELS', 1.0))
+DEFAULT_ZOOM = 10
+MAX_ZOOM = 22
+
+route_cache = cache.Cache('route', size=500)
+
+LAST_BLOCK_SQL = 'SELECT id, base_time, point_count, points FROM gps_blocks WHERE shipment_id = ? ORDER BY id DESC LIMIT 1'
+LAST_BLOCK = repositories.Query('gps_blocks_last', LAST_BLOCK_SQL)
+# Postgres: concurrent batches of a shipment fill its newest block one after the other
+LAST_BLOCK_LOCKED = repositories.Query('gps_blocks_last_locked', LAST_BLOCK_SQL + ' FOR UPDATE')
+BLOCK_UPDATE = repositories.Query('gps_blocks_update', 'UPDATE gps_blocks SET points = ?, point_count = ?, first_at = ?, last_at = ? WHERE id = ?')
+BLOCK_INSERT = repositories.Query('gps_blocks_insert', '''INSERT INTO gps_blocks (shipment_id, base_time, first_at, last_at, point_count, points)
+    VALUES (?, ?, ?, ?, ?, ?)''')
+SHIPMENT_EXISTS = repositories.Query('gps_shipment_exists', 'SELECT 1 FROM shipments WHERE id = ?')
+BLOCKS = repositories.Query('gps_blocks_of_shipment', 'SELECT base_time, points FROM gps_blocks WHERE shipment_id = ? ORDER BY id')
+ROUTE_STAMP = repositories.Query('gps_route_stamp', '''SELECT COUNT(b.id) AS blocks, COALESCE(SUM(b.point_count), 0) AS points, MAX(b.last_at) AS last_at
+    FROM shipments s LEFT JOIN gps_blocks b ON b.shipment_id = s.id WHERE s.id = ? GROUP BY s.id''')
+
+
+def create_table(db, postgres):
+    blob = 'BYTEA' if postgres else 'BLOB'
+    identity = 'SERIAL PRIMARY KEY' if postgres else 'INTEGER PRIMARY KEY AUTOINCREMENT'
+    execute(db, postgres, f'''CREATE TABLE IF NOT EXISTS gps_blocks (
+        id {identity},
+        shipment_id INTEGER NOT NULL REFERENCES shipments (id) ON DELETE CASCADE,
+        base_time BIGINT NOT NULL,
+        first_at BIGINT NOT NULL,
+        last_at BIGINT NOT NULL,
+        point_count INTEGER NOT NULL,
+        points {blob} NOT NULL
+    )''')
+    execute(db, postgres, 'CREATE INDEX IF NOT EXISTS idx_gps_blocks_shipment ON gps_blocks (shipment_id, id)')
+
+
+def parse_pings(pings):
+    # -> POINT array plus absolute times, sorted by time; raises ValueError
+    if not isinstance(pings, list) or not pings:
+        raise ValueError('pings must be a non-empty list')
+    if len(pings) > MAX_BATCH:
+        raise ValueError(f'At most {MAX_BATCH} pings per batch')
+    now = int(time.time() * 1000)
+    times = np.empty(len(pings), dtype=np.int64)
+    points = np.zeros(len(pings), dtype=POINT)
+    for position, ping in enumerate(pings):
+        if not isinstance(ping, dict):
+            raise ValueError('Each ping must be an object')
+        try:
+            lat, lng = float(ping['lat']), float(ping['lng'])
+            progress = float(ping['progress']) if ping.get('progress') is not None else np.nan
+            times[position] = int(ping.get('timestamp') or now)
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f'Ping {position} needs numeric lat, lng and optional progress and timestamp (ms)')
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            raise ValueError(f'Ping {position} is outside valid coordinates')
+        points[position] = (0, lat, lng, progress)
+    order = np.argsort(times, kind='stable')
+    return points[order], times[order]
+
+
+def append_points(db, postgres, shipment_id, points, times):
+    # Fills the shipment's newest block, then opens new ones; returns the blocks written
+    last = repositories.fetch_one(db, LAST_BLOCK_LOCKED if postgres else LAST_BLOCK, (shipment_id,))
+    written = 0
+    start = 0
+    if last is not None and last['point_count'] < BLOCK_POINTS:
+        room = min(BLOCK_POINTS - last['point_count'], len(points))
+        fits = np.abs(times[:room] - last['base_time']) <= MAX_OFFSET_MS
+        # Only the leading run that fits the block's time range goes into it
+        count = room if fits.all() else int(np.argmin(fits))
+        if count:
+            chunk = points[:count].copy()
+            chunk['offset'] = times[:count] - last['base_time']
+            stored = np.frombuffer(bytes(last['points']), dtype=POINT)
+            merged = np.concatenate([stored, chunk])
+            absolute = merged['offset'].astype(np.int64) + last['base_time']
+            repositories.write(db, BLOCK_UPDATE, (merged.tobytes(), len(merged), int(absolute.min()), int(absolute.max()), last['id']))
+            written += 1
+            start = count
+    while start < len(points):
+        base = int(times[start])
+        stop = start + int(np.searchsorted(times[start:start + BLOCK_POINTS], base + MAX_OFFSET_MS, side='right'))
+        chunk = points[start:stop].copy()
+        chunk['offset'] = times[start:stop] - base
+        repositories.write(db, BLOCK_INSERT, (shipment_id, base, base, int(times[stop - 1]), len(chunk), chunk.tobytes()))
+        written += 1
+        start = stop
+    return written
+
+
+def ingest(db, postgres, shipment_id, pings):
+    # Stores a batch and moves the shipment's progress to its newest ping; returns a
+    # summary, or None for an unknown shipment. Raises ValueError for invalid pings.
+    points, times = parse_pings(pings)
+    if repositories.fetch_one(db, SHIPMENT_EXISTS, (shipment_id,)) is None:
+        db.rollback()
+        return None
+    blocks = append_points(db, postgres, shipment_id, points, times)
+    newest = points[-1]
+    if not np.isnan(newest['progress']):
+        repositories.save_progress(db, shipment_id, round(float(newest['progress']), 4), round(float(newest['lat']), 6),
+                                   round(float(newest['lng']), 6), datetime.fromtimestamp(times[-1] / 1000).isoformat())
+    db.commit()
+    return {'shipment_id': shipment_id, 'accepted': len(points), 'blocks': blocks,
+            'first_at': int(times[0]), 'last_at': int(times[-1])}
+
+
+def load_points(db, postgres, shipment_id):
+    # All pings of a shipment in time order: (latitudes, longitudes, times in ms)
+    rows = repositories.fetch_all(db, BLOCKS, (shipment_id,))
+    db.commit()
+    if not rows:
+        return np.empty(0), np.empty(0), np.empty(0, dtype=np.int64)
+    blocks = [np.frombuffer(bytes(row['points']), dtype=POINT) for row in rows]
+    times = np.concatenate([block['offset'].astype(np.int64) + row['base_time'] for block, row in zip(blocks, rows)])
+    points = np.concatenate(blocks)
+    order = np.argsort(times, kind='stable')
+    return points['lat'][order].astype(np.float64), points['lng'][order].astype(np.float64), times[order]
+
+
+def simplify(latitudes, longitudes, tolerance):
+    # Douglas-Peucker on a local equirectangular projection, with the tolerance in
+    # degrees of longitude like map pixels; returns the indices kept. Iterative, each
+    # segment's distances in one vectorized pass.
+    count = len(latitudes)
+    if count <= 2:
+        return np.arange(count)
+    scale = np.cos(np.radians(np.mean(latitudes)))
+    x = longitudes * scale
+    y = latitudes
+    tolerance = tolerance * scale
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(px * dy - py * dx) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return np.flatnonzero(keep)
+
+
+def tolerance_for_zoom(zoom):
+    # Degrees covered by TOLERANCE_PIXELS at this zoom (256 pixels span 360 degrees at zoom 0)
+    return TOLERANCE_PIXELS * 360.0 / (256 * 2 ** zoom)
+
+
+def build_route(db, postgres, shipment_id, zoom):
+    latitudes, longitudes, times = load_points(db, postgres, shipment_id)
+    kept = simplify(latitudes, longitudes, tolerance_for_zoom(zoom))
+    return {
+        'shipment_id': shipment_id,
+        'zoom': zoom,
+        'points': len(latitudes),
+        'returned': len(kept),
+        'path': [[round(float(latitudes[i]), 6), round(float(longitudes[i]), 6)] for i in kept],
+        'timestamps': [int(times[i]) for i in kept],
+    }
+
+
+def route(db, postgres, shipment_id, zoom=DEFAULT_ZOOM):
+    # None for an unknown shipment. The stamp changes with every batch, so a cached route
+    # is never older than its pings.
+    stamp = repositories.fetch_one(db, ROUTE_STAMP, (shipment_id,))
+    if stamp is None:
+        db.commit()
+        return None
+    key = (shipment_id, zoom, stamp['blocks'], stamp['points'], stamp['last_at'])
+    return route_cache.get_or_load(key, [('shipments', shipment_id)], lambda: build_route(db, postgres, shipment_id, zoom))
@@ -0,0 +1,65 @@
+# Gunicorn configuration for production serving
+# Usage: gunicorn --config backend/gunicorn.conf.py --chdir backend app:app
+import multiprocessing
+import os
+
+# Railway / Render inject PORT, default matches the dev server in app.py
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# Threads per worker are capped by the per-worker DB pool: a request thread
+# holds at most one pooled connection, so more threads than connections only queue.
+db_pool_max = int(os.environ.get('DB_POOL_MAX', 8))
+db_max_connections = int(os.environ.get('DB_MAX_CONNECTIONS', 20))
+
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', db_pool_max))
+
+# Workers from CPU count, bounded so that workers * pool size stays under the
+# server's connection limit (Neon / Postgres free tiers allow very few).
+cpu_workers = multiprocessing.cpu_count() * 2 + 1
+pool_workers = max(1, db_max_connections // max(1, db_pool_max))
+# SQLite: one worker, so its writer thread is the only writer of the database
+sqlite_mode = os.environ.get('USE_POSTGRESQL', 'true').lower() != 'true'
+workers = int(os.environ.get('WEB_CONCURRENCY', 1 if sqlite_mode else min(cpu_workers, pool_workers)))
+
+# Import the app once in the master, workers fork from it
+preload_app = True
+
+# Recycle workers periodically, with jitter so they don't all restart together
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+# Graceful shutdown: on SIGTERM workers stop accepting and finish in-flight requests
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+
+def when_ready(server):
+    # The master never touches the database: schema checks run lazily on each
+    # worker's first request (see ensure_db_ready in app.py), so the port opens at once.
+    server.log.info("Listening, forking %s workers x %s threads", workers, threads)
+
+
+def post_fork(server, worker):
+    import app as application
+    application.init_pool()
+
+
+def worker_exit(server, worker):
+    import app as application
+    application.maintenance.stop()
+    application.eta.stop()
+    application.cache.stop()
+    application.autocomplete.stop()
+    application.sqlite_writer.stop()
+    application.close_pool()
+
+
+def on_exit(server):
+    import app as application
+    application.close_pool()
@@ -0,0 +1,194 @@
+# Tracking history lifecycle. On Postgres the hot tracking_history table is range
+# partitioned by month; once a shipment is closed (delivered, cancelled, rejected) and
+# its last event is older than HISTORY_ARCHIVE_AFTER_DAYS, its events are folded into a
+# single compact row of tracking_history_archive and removed from the hot table.
+import json
+import os
+from datetime import datetime, timedelta
+
+from common import execute
+
+CLOSED_STATUSES = ('delivered', 'cancelled', 'rejected')
+ARCHIVE_AFTER_DAYS = int(os.environ.get('HISTORY_ARCHIVE_AFTER_DAYS', 90))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('HISTORY_ARCHIVE_BATCH_SIZE', 500))
+PARTITION_MONTHS_AHEAD = int(os.environ.get('HISTORY_PARTITION_MONTHS_AHEAD', 3))
+
+# Column order of the packed events, kept as arrays to avoid repeating keys per event
+EVENT_FIELDS = ('id', 'date_time', 'location', 'status', 'description', 'latitude', 'longitude')
+
+
+def create_archive_table(db, postgres):
+    execute(db, postgres, '''CREATE TABLE IF NOT EXISTS tracking_history_archive (
+        shipment_id INTEGER PRIMARY KEY,
+        final_status TEXT NOT NULL,
+        event_count INTEGER NOT NULL,
+        first_event TEXT NOT NULL,
+        last_event TEXT NOT NULL,
+        events TEXT NOT NULL,
+        archived_at TEXT NOT NULL,
+        FOREIGN KEY (shipment_id) REFERENCES shipments (id) ON DELETE CASCADE
+    )''')
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def next_month(day):
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def partition_name(month):
+    return f"tracking_history_y{month.strftime('%Y')}m{month.strftime('%m')}"
+
+
+def ensure_partitions(db, months=(), ahead=PARTITION_MONTHS_AHEAD):
+    # Creates the partitions for the given months plus the current one and `ahead` months
+    # after it. Rows outside every partition land in tracking_history_default.
+    wanted = {month_start(m) for m in months}
+    month = month_start(datetime.now())
+    for _ in range(ahead + 1):
+        wanted.add(month)
+        month = next_month(month)
+    cursor = db.cursor()
+    for month in sorted(wanted):
+        cursor.execute(f'''CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF tracking_history
+            FOR VALUES FROM ('{month.strftime('%Y-%m')}') TO ('{next_month(month).strftime('%Y-%m')}')''')
+
+
+def partition_tracking_history(db, postgres):
+    # Converts the plain Postgres table into one partitioned by month on date_time.
+    # date_time is stored as 'YYYY-MM-DD HH:MM:SS', so byte order ("C" collation) is time order.
+    if not postgres:
+        return
+    cursor = db.cursor()
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('tracking_history')")
+    if cursor.fetchone()['relkind'] == 'p':
+        return
+
+    cursor.execute('ALTER TABLE tracking_history RENAME TO tracking_history_unpartitioned')
+    cursor.execute('ALTER TABLE tracking_history_unpartitioned RENAME CONSTRAINT tracking_history_pkey TO tracking_history_unpartitioned_pkey')
+    cursor.execute('DROP INDEX IF EXISTS idx_tracking_history_shipment')
+    # Keep the id sequence: it would otherwise be dropped along with the old table
+    cursor.execute('ALTER SEQUENCE tracking_history_id_seq OWNED BY NONE')
+    cursor.execute('''CREATE TABLE tracking_history (
+        id INTEGER NOT NULL DEFAULT nextval('tracking_history_id_seq'),
+        shipment_id INTEGER NOT NULL,
+        date_time TEXT COLLATE "C" NOT NULL,
+        location TEXT NOT NULL,
+        status TEXT NOT NULL,
+        description TEXT,
+        latitude REAL,
+        longitude REAL,
+        PRIMARY KEY (id, date_time),
+        FOREIGN KEY (shipment_id) REFERENCES shipments (id) ON DELETE CASCADE
+    ) PARTITION BY RANGE (date_time)''')
+    cursor.execute('ALTER SEQUENCE tracking_history_id_seq OWNED BY tracking_history.id')
+    cursor.execute('CREATE TABLE tracking_history_default PARTITION OF tracking_history DEFAULT')
+
+    cursor.execute("SELECT DISTINCT substr(date_time, 1, 7) AS month FROM tracking_history_unpartitioned WHERE date_time ~ '^[0-9]{4}-[0-9]{2}'")
+    months = [datetime.strptime(row['month'], '%Y-%m') for row in cursor.fetchall()]
+    ensure_partitions(db, months)
+
+    cursor.execute('''INSERT INTO tracking_history (id, shipment_id, date_time, location, status, description, latitude, longitude)
+        SELECT id, shipment_id, date_time, location, status, description, latitude, longitude FROM tracking_history_unpartitioned''')
+    cursor.execute('DROP TABLE tracking_history_unpartitioned')
+    cursor.execute('CREATE INDEX idx_tracking_history_shipment ON tracking_history (shipment_id, date_time)')
+
+
+def drop_empty_partitions(db, keep_months=2):
+    # Monthly partitions emptied by archival are dropped once they are in the past
+    cursor = db.cursor()
+    cursor.execute('''SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass('tracking_history') AND c.relname ~ '^tracking_history_y[0-9]{4}m[0-9]{2}$'
+        ORDER BY c.relname''')
+    oldest_kept = month_start(datetime.now())
+    for _ in range(keep_months):
+        oldest_kept = month_start(oldest_kept - timedelta(days=1))
+    dropped = []
+    for row in cursor.fetchall():
+        name = row['relname']
+        if name >= partition_name(oldest_kept):
+            continue
+        cursor.execute(f'SELECT 1 FROM {name} LIMIT 1')
+        if cursor.fetchone() is None:
+            cursor.execute(f'DROP TABLE {name}')
+            dropped.append(name)
+    return dropped
+
+
+def unpack_events(shipment_id, packed):
+    events = []
+    for values in json.loads(packed):
+        event = dict(zip(EVENT_FIELDS, values))
+        event['shipment_id'] = shipment_id
+        events.append(event)
+    return events
+
+
+ARCHIVED_EVENTS_SQL = 'SELECT events FROM tracking_history_archive WHERE shipment_id = ?'
+
+
+def archived_events(db, postgres, shipment_id):
+    row = execute(db, postgres, ARCHIVED_EVENTS_SQL, (shipment_id,)).fetchone()
+    if not row:
+        return []
+    return unpack_events(shipment_id, row['events'])
+
+
+def merge_history(hot_rows, archived, fields=None):
+    # Newest first, like the hot-table queries (ORDER BY date_time DESC)
+    rows = [dict(row) for row in hot_rows]
+    for event in archived:
+        rows.append({field: event.get(field) for field in fields} if fields else event)
+    rows.sort(key=lambda row: row['date_time'], reverse=True)
+    return rows
+
+
+def archive_closed_shipments(db, postgres, older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    # Walks closed shipments by id in batches; each batch is one short transaction that
+    # writes the archive rows and deletes the hot rows, so locks are held only briefly.
+    cutoff = (datetime.now() - timedelta(days=older_than_days)).strftime('%Y-%m-%d %H:%M:%S')
+    closed = ', '.join('?' * len(CLOSED_STATUSES))
+    last_id = 0
+    shipments_archived = 0
+    events_archived = 0
+    while True:
+        candidates = execute(db, postgres, f'''SELECT s.id, s.status FROM shipments s
+            WHERE s.status IN ({closed}) AND s.id > ?
+              AND EXISTS (SELECT 1 FROM tracking_history h WHERE h.shipment_id = s.id)
+              AND NOT EXISTS (SELECT 1 FROM tracking_history h WHERE h.shipment_id = s.id AND h.date_time >= ?)
+            ORDER BY s.id LIMIT ?''', CLOSED_STATUSES + (last_id, cutoff, batch_size)).fetchall()
+        if not candidates:
+            break
+        last_id = candidates[-1]['id']
+        statuses = {row['id']: row['status'] for row in candidates}
+        ids = tuple(statuses)
+        in_ids = ', '.join('?' * len(ids))
+
+        events = {}
+        for row in execute(db, postgres, f'''SELECT id, shipment_id, date_time, location, status, description, latitude, longitude
+                FROM tracking_history WHERE shipment_id IN ({in_ids}) ORDER BY shipment_id, date_time''', ids).fetchall():
+            events.setdefault(row['shipment_id'], []).append([row[field] for field in EVENT_FIELDS])
+        for row in execute(db, postgres, f'SELECT shipment_id, events FROM tracking_history_archive WHERE shipment_id IN ({in_ids})', ids).fetchall():
+            # Events recorded after an earlier archival are merged into the existing row
+            merged = json.loads(row['events']) + events.get(row['shipment_id'], [])
+            merged.sort(key=lambda values: values[1])
+            events[row['shipment_id']] = merged
+
+        archived_at = datetime.now().isoformat()
+        for shipment_id, packed in events.items():
+            execute(db, postgres, '''INSERT INTO tracking_history_archive
+                (shipment_id, final_status, event_count, first_event, last_event, events, archived_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (shipment_id) DO UPDATE SET final_status = excluded.final_status, event_count = excluded.event_count,
+                    first_event = excluded.first_event, last_event = excluded.last_event, events = excluded.events, archived_at = excluded.archived_at''',
+                (shipment_id, statuses[shipment_id], len(packed), packed[0][1], packed[-1][1],
+                 json.dumps(packed, separators=(',', ':')), archived_at))
+        deleted = execute(db, postgres, f'DELETE FROM tracking_history WHERE shipment_id IN ({in_ids})', ids)
+        events_archived += deleted.rowcount
+        db.commit()
+        shipments_archived += len(events)
+
+    return {'shipments': shipments_archived, 'events': events_archived, 'cutoff': cutoff}
@@ -0,0 +1,259 @@
+# Idempotency-Key support for POST routes that create things. The first request with a
+# key claims it in idempotency_keys, runs normally and stores its response; retries with
+# the same key get that response back without running the handler again. A duplicate
+# arriving while the first is still running waits for it to finish.
+#
+# While a request owns a key its connection defers commits (db.deferred): the handler's
+# writes and the stored response are committed together once the response is known, so
+# a worker dying in between leaves either both or neither. A 5xx rolls the writes back
+# and releases the key for the client's retry.
+#
+# Completed responses are also kept in a per-worker LRU so most retries never reach the
+# database. Rows expire after IDEMPOTENCY_TTL_HOURS and are deleted by the maintenance
+# scheduler.
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import Response, g, request
+
+import metrics
+import repositories
+from common import LRU, execute
+
+HEADER = 'Idempotency-Key'
+TTL_HOURS = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24))
+CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+# How long a duplicate waits for the first request before giving up with 409
+WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 10))
+# A claim without a response after this long belongs to a crashed worker and is taken over
+CLAIM_TIMEOUT_SECONDS = int(os.environ.get('IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS', 60))
+MAX_KEY_LENGTH = 255
+POLL_SECONDS = 0.05
+EXPIRE_BATCH_SIZE = 1000
+
+
+# scoped key -> stored response dict
+completed = LRU(CACHE_SIZE)
+# scoped key -> Event set when this worker's owner stores the response
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+LOAD = repositories.Query('idempotency_keys_load', '''SELECT fingerprint, status_code, content_type, body, created_at, expires_at
+    FROM idempotency_keys WHERE key = ?''')
+DELETE_EXPIRED_KEY = repositories.Query('idempotency_keys_delete_expired_key', 'DELETE FROM idempotency_keys WHERE key = ? AND expires_at < ?')
+CLAIM = repositories.Query('idempotency_keys_claim', '''INSERT INTO idempotency_keys (key, fingerprint, created_at, expires_at) VALUES (?, ?, ?, ?)
+    ON CONFLICT (key) DO NOTHING''')
+TAKE_OVER = repositories.Query('idempotency_keys_take_over', '''UPDATE idempotency_keys SET created_at = ?
+    WHERE key = ? AND fingerprint = ? AND status_code IS NULL AND created_at < ?''')
+STORE = repositories.Query('idempotency_keys_store', 'UPDATE idempotency_keys SET status_code = ?, content_type = ?, body = ? WHERE key = ?')
+DISCARD = repositories.Query('idempotency_keys_discard', 'DELETE FROM idempotency_keys WHERE key = ? AND status_code IS NULL')
+EXPIRE = repositories.Query('idempotency_keys_expire', '''DELETE FROM idempotency_keys
+    WHERE key IN (SELECT key FROM idempotency_keys WHERE expires_at < ? LIMIT ?)''')
+
+
+def create_table(db, postgres):
+    # status_code is NULL while the first request is still running
+    execute(db, postgres, '''CREATE TABLE IF NOT EXISTS idempotency_keys (
+        key TEXT PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        status_code INTEGER,
+        content_type TEXT,
+        body TEXT,
+        created_at TEXT NOT NULL,
+        expires_at TEXT NOT NULL
+    )''')
+    execute(db, postgres, 'CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at)')
+
+
+def now_text(delta=timedelta()):
+    return (datetime.now() + delta).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def fingerprint():
+    # Reusing a key for a different request is a client bug, not a retry
+    digest = hashlib.sha256()
+    digest.update(f'{request.method} {request.path}\n'.encode())
+    digest.update(request.get_data(cache=True))
+    return digest.hexdigest()
+
+
+def replay(entry):
+    response = Response(entry['body'], status=entry['status_code'], content_type=entry['content_type'])
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def mismatch():
+    return Response('{"error": "Idempotency-Key was already used for a different request"}\n',
+                    status=422, content_type='application/json')
+
+
+def load(db, postgres, key):
+    row = repositories.fetch_one(db, LOAD, (key,))
+    db.commit()
+    return repositories.as_dict(row) if row else None
+
+
+def claim(db, postgres, key, request_digest):
+    # Returns True when this request now owns the key. Expired rows and claims abandoned
+    # by a crashed worker are taken over; anything else means someone else has it.
+    now = now_text()
+    repositories.write(db, DELETE_EXPIRED_KEY, (key, now))
+    claimed = repositories.write(db, CLAIM, (key, request_digest, now, now_text(timedelta(hours=TTL_HOURS))))
+    if claimed != 1:
+        claimed = repositories.write(db, TAKE_OVER, (now, key, request_digest, now_text(timedelta(seconds=-CLAIM_TIMEOUT_SECONDS))))
+    db.commit()
+    return claimed == 1
+
+
+def wait_for(db, postgres, key, request_digest):
+    # Polls until the owner stored its response; duplicates within this worker are
+    # woken by the owner's Event instead of sleeping the full poll interval
+    deadline = time.monotonic() + WAIT_SECONDS
+    while time.monotonic() < deadline:
+        event = in_flight.get(key)
+        if event is not None:
+            event.wait(POLL_SECONDS)
+        else:
+            time.sleep(POLL_SECONDS)
+        entry = completed.get(key) or load(db, postgres, key)
+        if entry is None:
+            # The owner failed and released the key: this request may run it now
+            if claim(db, postgres, key, request_digest):
+                return None
+            continue
+        if entry['fingerprint'] != request_digest:
+            return mismatch()
+        if entry['status_code'] is not None:
+            return replay(entry)
+    return Response('{"error": "A request with this Idempotency-Key is still in progress"}\n', status=409, content_type='application/json')
+
+
+def own(db, key):
+    g.idempotency_key = key
+    db.deferred = True
+
+
+def discard(db, postgres, key):
+    # Rolls back what the owner wrote and frees the key
+    db.deferred = False
+    db.rollback()
+    repositories.write(db, DISCARD, (key,))
+    db.commit()
+
+
+def release(key):
+    with in_flight_lock:
+        event = in_flight.pop(key, None)
+    if event is not None:
+        event.set()
+
+
+def begin(get_db, postgres):
+    raw_key = request.headers.get(HEADER)
+    if not raw_key:
+        return None
+    if len(raw_key) > MAX_KEY_LENGTH:
+        return Response(f'{{"error": "{HEADER} is longer than {MAX_KEY_LENGTH} characters"}}\n', status=400, content_type='application/json')
+    # Keys are scoped to the route so clients may reuse one key across different calls
+    key = f'{request.method} {request.path} {raw_key}'
+    request_digest = fingerprint()
+
+    entry = completed.get(key)
+    if entry is not None:
+        metrics.cache_hit('idempotency')
+        return replay(entry) if entry['fingerprint'] == request_digest else mismatch()
+    metrics.cache_miss('idempotency')
+
+    db = get_db()
+    with in_flight_lock:
+        owned_here = key in in_flight
+        if not owned_here:
+            in_flight[key] = threading.Event()
+    if not owned_here and claim(db, postgres, key, request_digest):
+        own(db, key)
+        return None
+    if not owned_here:
+        # Another worker owns it; drop the Event we registered speculatively
+        with in_flight_lock:
+            in_flight.pop(key).set()
+    stored = load(db, postgres, key)
+    if stored is not None and stored['status_code'] is not None:
+        if stored['fingerprint'] == request_digest:
+            completed.put(key, stored)
+        return replay(stored) if stored['fingerprint'] == request_digest else mismatch()
+    response = wait_for(db, postgres, key, request_digest)
+    if response is None:
+        own(db, key)
+    return response
+
+
+def finish(get_db, postgres, response):
+    key = g.pop('idempotency_key', None)
+    if key is None:
+        return response
+    db = get_db()
+    try:
+        if response.status_code >= 500:
+            # Nothing durable to replay: undo the handler's writes, none of which were
+            # committed, and let the client's retry run the request again
+            discard(db, postgres, key)
+            return response
+        try:
+            repositories.write(db, STORE, (response.status_code, response.content_type, response.get_data(as_text=True), key))
+            db.deferred = False
+            db.commit()
+        except Exception:
+            discard(db, postgres, key)
+            raise
+        stored = load(db, postgres, key)
+        if stored is not None:
+            completed.put(key, stored)
+    finally:
+        release(key)
+    return response
+
+
+def abandon(get_db, postgres, exception):
+    # Only reached when after_request itself did not run to completion
+    key = g.pop('idempotency_key', None)
+    if key is None:
+        return
+    try:
+        discard(get_db(), postgres, key)
+    finally:
+        release(key)
+
+
+def expire(db, postgres, batch_size=EXPIRE_BATCH_SIZE):
+    # Batched so the delete never holds the table for long
+    deleted = 0
+    now = now_text()
+    while True:
+        count = repositories.write(db, EXPIRE, (now, batch_size))
+        db.commit()
+        deleted += count
+        if count < batch_size:
+            break
+    return {'deleted': deleted}
+
+
+def init_app(app, get_db, postgres, endpoints):
+    # Must be registered after the hook that creates the schema
+    def before():
+        if request.method == 'POST' and request.endpoint in endpoints:
+            return begin(get_db, postgres)
+
+    def after(response):
+        return finish(get_db, postgres, response)
+
+    def teardown(exception):
+        if exception is not None:
+            abandon(get_db, postgres, exception)
+
+    app.before_request(before)
+    app.after_request(after)
+    app.teardown_request(teardown)
@@ -0,0 +1,354 @@
+# Invoice ledger and monthly shipper statements.
+#
+# An invoice is written in the transaction that sets a shipment's freight: when an admin
+# confirms it, or creates it directly. It keeps the amount, tracking number, billed
+# shipper and issue and due dates of that moment; confirming again re-issues the same
+# invoice number. Its status still follows the shipment (delivered: paid, delayed:
+# overdue, otherwise pending). The admin screen pages through the ledger newest first
+# and reads the totals from one aggregate instead of rebuilding them from every
+# shipment.
+#
+# `flask statements [YYYY-MM]` renders one CSV and one PDF statement per shipper for a
+# month under STATEMENTS_DIR/<period>/. Invoices are read in shipper order and each
+# shipper's rows go to a process pool that writes the files. A file is written under a
+# temporary name and then renamed into place. The statements table keeps a fingerprint
+# of each shipper's invoices: a re-run renders only shippers whose invoices changed and
+# removes statements of shippers that no longer have any, so it converges on the same
+# files however often it runs.
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date, datetime, timedelta
+from itertools import groupby
+
+import repositories
+from common import execute
+
+TERMS_DAYS = int(os.environ.get('INVOICE_TERMS_DAYS', 30))
+PAGE_SIZE = int(os.environ.get('INVOICE_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = 200
+STATEMENTS_DIR = os.environ.get('STATEMENTS_DIR', '/tmp/tracksite-statements')
+STATEMENT_WORKERS = int(os.environ.get('STATEMENT_WORKERS', os.cpu_count() or 2))
+STATEMENT_FORMATS = ('csv', 'pdf')
+# Bumped when the rendering changes, so a re-run replaces every file
+STATEMENT_LAYOUT = 1
+FETCH_SIZE = 2000
+
+STATUS = "CASE s.status WHEN 'delivered' THEN 'paid' WHEN 'delayed' THEN 'overdue' ELSE 'pending' END"
+STATUS_FILTERS = {
+    'paid': "s.status = 'delivered'",
+    'overdue': "s.status = 'delayed'",
+    'pending': "s.status NOT IN ('delivered', 'delayed')",
+}
+PERIOD = re.compile(r'^(\d{4})-(0[1-9]|1[0-2])$')
+
+
+def invoice_number(shipment_id):
+    return f'INV-{shipment_id:06d}'
+
+
+def install(db, postgres):
+    # The searched numbers are compared bytewise on Postgres and case-insensitively on
+    # SQLite, the collations under which their indexes serve a prefix LIKE
+    searchable = 'TEXT COLLATE "C"' if postgres else 'TEXT COLLATE NOCASE'
+    execute(db, postgres, f'''CREATE TABLE IF NOT EXISTS invoices (
+        id {'SERIAL PRIMARY KEY' if postgres else 'INTEGER PRIMARY KEY AUTOINCREMENT'},
+        shipment_id INTEGER NOT NULL UNIQUE REFERENCES shipments (id) ON DELETE CASCADE,
+        invoice_number {searchable} NOT NULL UNIQUE,
+        tracking_number {searchable},
+        shipper_name TEXT NOT NULL,
+        shipper_email TEXT NOT NULL,
+        amount REAL NOT NULL,
+        issue_date TEXT NOT NULL,
+        due_date TEXT NOT NULL
+    )''')
+    execute(db, postgres, 'CREATE INDEX IF NOT EXISTS idx_invoices_issue_date ON invoices (issue_date)')
+    execute(db, postgres, 'CREATE INDEX IF NOT EXISTS idx_invoices_tracking_number ON invoices (tracking_number)')
+    execute(db, postgres, '''CREATE TABLE IF NOT EXISTS statements (
+        period TEXT NOT NULL,
+        shipper_email TEXT NOT NULL,
+        format TEXT NOT NULL,
+        path TEXT NOT NULL,
+        invoice_count INTEGER NOT NULL,
+        total REAL NOT NULL,
+        fingerprint TEXT NOT NULL,
+        generated_at TEXT NOT NULL,
+        PRIMARY KEY (period, shipper_email, format)
+    )''')
+    # Shipments confirmed before the ledger existed, issued on their creation date
+    if postgres:
+        number, due = "'INV-' || LPAD(id::TEXT, 6, '0')", f'(date_created::DATE + {TERMS_DAYS})::TEXT'
+    else:
+        number, due = "'INV-' || printf('%06d', id)", f"date(date_created, '+{TERMS_DAYS} days')"
+    execute(db, postgres, f'''INSERT INTO invoices (shipment_id, invoice_number, tracking_number, shipper_name, shipper_email, amount, issue_date, due_date)
+        SELECT id, {number}, tracking_number, shipper_name, shipper_email, COALESCE(total_freight, 0), date_created, {due}
+        FROM shipments WHERE tracking_number IS NOT NULL ON CONFLICT (shipment_id) DO NOTHING''')
+
+
+ISSUE = repositories.Query('invoices_issue', '''INSERT INTO invoices (shipment_id, invoice_number, tracking_number, shipper_name, shipper_email, amount, issue_date, due_date)
+    SELECT id, ?, tracking_number, shipper_name, shipper_email, COALESCE(total_freight, 0), ?, ? FROM shipments WHERE id = ?
+    ON CONFLICT (shipment_id) DO UPDATE SET tracking_number = excluded.tracking_number, shipper_name = excluded.shipper_name, shipper_email = excluded.shipper_email,
+        amount = excluded.amount, issue_date = excluded.issue_date, due_date = excluded.due_date''')
+
+
+def issue(db, shipment_id, today=None):
+    # In the caller's transaction, after the shipment's total_freight is set
+    today = today or date.today()
+    repositories.write(db, ISSUE, (invoice_number(shipment_id), today.isoformat(),
+                                   (today + timedelta(days=TERMS_DAYS)).isoformat(), shipment_id))
+
+
+INVOICE_COLUMNS = ('id', 'shipment_id', 'invoice_number', 'amount', 'status', 'issue_date', 'due_date')
+SHIPMENT_COLUMNS = ('tracking_number', 'shipper_name', 'shipper_email', 'shipper_address', 'origin',
+                    'receiver_name', 'receiver_address', 'destination', 'product', 'total_weight', 'quantity')
+LISTED = ('i.id, i.shipment_id, i.invoice_number, i.amount, ' + STATUS + ' AS status, i.issue_date, i.due_date, '
+          'i.tracking_number, i.shipper_name, i.shipper_email, s.shipper_address, s.origin, '
+          's.receiver_name, s.receiver_address, s.destination, s.product, s.total_weight, s.quantity')
+
+
+def page_query(status, search, before):
+    conditions = []
+    if status:
+        conditions.append(STATUS_FILTERS[status])
+    if search:
+        conditions.append('(i.invoice_number LIKE ? OR i.tracking_number LIKE ?)')
+    if before:
+        conditions.append('i.id < ?')
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ''
+    name = f"invoices_page_{status or 'all'}{'_search' if search else ''}{'_before' if before else ''}"
+    return repositories.Query(name, f'SELECT {LISTED} FROM invoices i JOIN shipments s ON s.id = i.shipment_id {where}ORDER BY i.id DESC LIMIT ?')
+
+
+# One statement per filter combination, so each can be prepared
+PAGES = {(status, search, before): page_query(status, search, before)
+         for status in (None,) + tuple(STATUS_FILTERS) for search in (False, True) for before in (False, True)}
+
+
+def page(db, status=None, search='', before=None, limit=PAGE_SIZE):
+    # Newest first; `next` is the `before` of the following page, None on the last one.
+    # `search` is a prefix of the invoice or tracking number.
+    search = re.sub(r'[%_]', '', search).upper()
+    params = ()
+    if search:
+        params += (search + '%', search + '%')
+    if before:
+        params += (before,)
+    rows = repositories.fetch_all(db, PAGES[(status, bool(search), bool(before))], params + (limit,))
+    invoices = []
+    for row in rows:
+        invoice = {column: row[column] for column in INVOICE_COLUMNS}
+        invoice['shipment'] = {column: row[column] for column in SHIPMENT_COLUMNS}
+        invoices.append(invoice)
+    return {'invoices': invoices, 'next': rows[-1]['id'] if len(rows) == limit else None}
+
+
+SUMMARY = repositories.Query('invoices_summary', f'''SELECT COUNT(*) AS count, COALESCE(SUM(i.amount), 0) AS amount,
+    {', '.join(f"COALESCE(SUM(CASE WHEN {condition} THEN 1 ELSE 0 END), 0) AS {status}" for status, condition in STATUS_FILTERS.items())}
+    FROM invoices i JOIN shipments s ON s.id = i.shipment_id''')
+
+
+def summary(db):
+    return repositories.as_dict(repositories.fetch_one(db, SUMMARY))
+
+
+def previous_period(today=None):
+    first = (today or date.today()).replace(day=1)
+    return (first - timedelta(days=1)).strftime('%Y-%m')
+
+
+def period_bounds(period):
+    # 'YYYY-MM' -> first day of the month, first day of the next one
+    match = PERIOD.match(period or '')
+    if not match:
+        raise ValueError(f'Invalid period {period!r}, expected YYYY-MM')
+    year, month = int(match.group(1)), int(match.group(2))
+    following = date(year + month // 12, month % 12 + 1, 1)
+    return date(year, month, 1).isoformat(), following.isoformat()
+
+
+STATEMENT_COLUMNS = ('shipper_email', 'shipper_name', 'invoice_number', 'issue_date', 'due_date',
+                     'tracking_number', 'origin', 'destination', 'amount', 'status')
+
+
+def period_invoices(db, postgres, period):
+    # Streamed in shipper order; a named cursor keeps Postgres from sending the month at once
+    start, end = period_bounds(period)
+    sql = f'''SELECT i.shipper_email, i.shipper_name, i.invoice_number, i.issue_date, i.due_date,
+            i.tracking_number, s.origin, s.destination, i.amount, {STATUS} AS status
+        FROM invoices i JOIN shipments s ON s.id = i.shipment_id
+        WHERE i.issue_date >= ? AND i.issue_date < ?
+        ORDER BY i.shipper_email, i.issue_date, i.id'''
+    if postgres:
+        cursor = db.cursor(name='statement_invoices')
+        cursor.itersize = FETCH_SIZE
+        cursor.execute(sql.replace('?', '%s'), (start, end))
+    else:
+        cursor = db.execute(sql, (start, end))
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield tuple(row[column] for column in STATEMENT_COLUMNS)
+
+
+def fingerprint(rows):
+    return hashlib.sha256(json.dumps([STATEMENT_LAYOUT, rows], default=str).encode()).hexdigest()
+
+
+def statement_path(period, shipper_email, extension):
+    # Readable and unique per address
+    safe = re.sub(r'[^A-Za-z0-9@._-]', '_', shipper_email)[:80]
+    digest = hashlib.sha1(shipper_email.encode()).hexdigest()[:8]
+    return os.path.join(STATEMENTS_DIR, period, f'{safe}-{digest}.{extension}')
+
+
+def generate_statements(db, postgres, period, workers=STATEMENT_WORKERS, force=False):
+    # -> counts of rendered, unchanged and removed shipper statements
+    period_bounds(period)
+    os.makedirs(os.path.join(STATEMENTS_DIR, period), exist_ok=True)
+    known = {}
+    for row in execute(db, postgres, 'SELECT shipper_email, format, path, fingerprint FROM statements WHERE period = ?', (period,)).fetchall():
+        known[(row['shipper_email'], row['format'])] = (row['path'], row['fingerprint'])
+    seen = set()
+    counts = {'rendered': 0, 'unchanged': 0, 'removed': 0}
+    # Written once rendering is over: on SQLite the first write takes the worker's writer
+    # until the commit, it must not be held while statements render
+    rendered = []
+
+    def record(result):
+        rendered.append((result, datetime.now().isoformat(timespec='seconds')))
+
+    # Spawned, not forked: the workers only render and must not inherit database connections
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        pending = set()
+        for shipper_email, group in groupby(period_invoices(db, postgres, period), key=lambda row: row[0]):
+            rows = [row[1:] for row in group]
+            seen.add(shipper_email)
+            digest = fingerprint(rows)
+            paths = {extension: statement_path(period, shipper_email, extension) for extension in STATEMENT_FORMATS}
+            if not force and all(known.get((shipper_email, extension)) == (path, digest) and os.path.exists(path)
+                                 for extension, path in paths.items()):
+                counts['unchanged'] += 1
+                continue
+            pending.add(pool.submit(render_statement, period, shipper_email, rows, paths, digest))
+            # Bounded so a large month is never held in memory at once
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record(future.result())
+        for future in pending:
+            record(future.result())
+
+    for (shipper_email, paths, count, total, digest), now in rendered:
+        for extension, path in paths.items():
+            execute(db, postgres, '''INSERT INTO statements (period, shipper_email, format, path, invoice_count, total, fingerprint, generated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (period, shipper_email, format) DO UPDATE SET path = excluded.path, invoice_count = excluded.invoice_count,
+                    total = excluded.total, fingerprint = excluded.fingerprint, generated_at = excluded.generated_at''',
+                    (period, shipper_email, extension, path, count, total, digest, now))
+        counts['rendered'] += 1
+
+    for (shipper_email, extension), (path, _digest) in known.items():
+        if shipper_email in seen:
+            continue
+        if os.path.exists(path):
+            os.remove(path)
+        execute(db, postgres, 'DELETE FROM statements WHERE period = ? AND shipper_email = ? AND format = ?', (period, shipper_email, extension))
+        if extension == STATEMENT_FORMATS[0]:
+            counts['removed'] += 1
+    db.commit()
+    return counts
+
+
+def render_statement(period, shipper_email, rows, paths, digest):
+    # In a pool process. rows: (shipper_name, invoice_number, issue_date, due_date,
+    # tracking_number, origin, destination, amount, status)
+    total = round(sum(row[7] or 0 for row in rows), 2)
+    for extension, path in paths.items():
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as f:
+            if extension == 'csv':
+                write_csv(f, rows, total)
+            else:
+                write_pdf(f, period, shipper_email, rows, total)
+        os.replace(temporary, path)
+    return shipper_email, paths, len(rows), total, digest
+
+
+def write_csv(f, rows, total):
+    with open(f.fileno(), 'w', encoding='utf-8', newline='', closefd=False) as text:
+        writer = csv.writer(text)
+        writer.writerow(('invoice_number', 'issue_date', 'due_date', 'tracking_number', 'origin', 'destination', 'amount', 'status'))
+        for row in rows:
+            writer.writerow(row[1:7] + (f'{row[7] or 0:.2f}', row[8]))
+        writer.writerow(('total', '', '', '', '', '', f'{total:.2f}', ''))
+
+
+def write_pdf(f, period, shipper_email, rows, total):
+    pdf = PdfWriter(f)
+    pdf.line(f'Statement {period}', 16)
+    pdf.line(f'{rows[0][0]} <{shipper_email}>', 11)
+    pdf.line('')
+    for row in rows:
+        pdf.line(f'{row[1]}   {row[2]}   due {row[3]}   {row[4] or "-"}   {row[5]} -> {row[6]}   EUR {row[7] or 0:.2f}   {row[8]}', 8)
+    pdf.line('')
+    pdf.line(f'{len(rows)} invoices, total EUR {total:.2f}', 11)
+    pdf.close()
+
+
+class PdfWriter:
+    # Minimal text-only PDF (A4, Helvetica), written to the file a page at a time
+    TOP, BOTTOM, LEFT = 800, 50, 50
+
+    def __init__(self, f):
+        self.f = f
+        self.offsets = {}
+        self.pages = []
+        self.commands = []
+        self.y = self.TOP
+        self.next_object = 4  # 1: catalog, 2: page tree, 3: font
+        f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        self.write_object(3, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>')
+
+    def write_object(self, number, body):
+        self.offsets[number] = self.f.tell()
+        self.f.write(b'%d 0 obj\n' % number + body + b'\nendobj\n')
+
+    def allocate(self):
+        self.next_object += 1
+        return self.next_object - 1
+
+    def line(self, text, size=10):
+        if self.y - size < self.BOTTOM:
+            self.flush_page()
+        self.y -= size + 4
+        escaped = text.encode('cp1252', 'replace').replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+        self.commands.append(b'BT /F1 %d Tf %d %d Td (' % (size, self.LEFT, self.y) + escaped + b') Tj ET')
+
+    def flush_page(self):
+        content = b'\n'.join(self.commands)
+        stream, page = self.allocate(), self.allocate()
+        self.write_object(stream, b'<< /Length %d >>\nstream\n' % len(content) + content + b'\nendstream')
+        self.write_object(page, b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+                                b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % stream)
+        self.pages.append(page)
+        self.commands = []
+        self.y = self.TOP
+
+    def close(self):
+        if self.commands or not self.pages:
+            self.flush_page()
+        kids = b' '.join(b'%d 0 R' % page for page in self.pages)
+        self.write_object(2, b'<< /Type /Pages /Kids [' + kids + b'] /Count %d >>' % len(self.pages))
+        self.write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+        xref = self.f.tell()
+        count = self.next_object
+        self.f.write(b'xref\n0 %d\n0000000000 65535 f \n' % count)
+        for number in range(1, count):
+            self.f.write(b'%010d 00000 n \n' % self.offsets[number])
+        self.f.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%EOF\n' % (count, xref))
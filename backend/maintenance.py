@@ -0,0 +1,344 @@
+# Periodic database maintenance, run by a background thread in every worker: orphan
+# cleanup, planner statistics, vacuum, tracking history archival, the delivery SLA sweep
+# and table/index size reporting. Each run is claimed in maintenance_runs with a compare-and-set UPDATE, so
+# however many workers (or instances) share the database, a task runs once per period.
+import collections
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import change_feed
+import history_archive
+import idempotency
+import metrics
+import sla
+from common import execute
+
+# Seconds between scheduler ticks in each worker; 0 disables the scheduler
+MAINTENANCE_INTERVAL = int(os.environ.get('MAINTENANCE_INTERVAL', 60))
+ORPHAN_BATCH_SIZE = int(os.environ.get('MAINTENANCE_ORPHAN_BATCH_SIZE', 500))
+# A worker is quiet when it served fewer than QUIET_MAX_REQUESTS in the last QUIET_SECONDS
+QUIET_SECONDS = int(os.environ.get('MAINTENANCE_QUIET_SECONDS', 60))
+QUIET_MAX_REQUESTS = int(os.environ.get('MAINTENANCE_QUIET_MAX_REQUESTS', 30))
+# Postgres gives up on a lock after this long instead of queueing application queries behind it
+LOCK_TIMEOUT_MS = int(os.environ.get('MAINTENANCE_LOCK_TIMEOUT_MS', 2000))
+# SQLite is only VACUUMed when this share of its pages is free
+SQLITE_VACUUM_FREE_RATIO = float(os.environ.get('MAINTENANCE_SQLITE_VACUUM_FREE_RATIO', 0.2))
+
+# Tables that reference shipments(id) with ON DELETE CASCADE
+SHIPMENT_CHILD_TABLES = ('tracking_history', 'shipment_progress', 'tracking_history_archive', 'shipment_current_state', 'gps_blocks')
+MAINTAINED_TABLES = (
+    'shipments', 'tracking_history', 'shipment_progress', 'tracking_history_archive',
+    'users', 'locations', 'zones', 'shipping_rates', 'pickup_rates', 'change_tombstones',
+    'idempotency_keys', 'shipment_search', 'shipment_current_state', 'gps_blocks',
+)
+
+runs = metrics.Counter('tracksite_maintenance_runs_total', 'Maintenance task runs by result', ('task', 'result'))
+task_duration = metrics.Histogram('tracksite_maintenance_task_seconds', 'Duration of maintenance task runs', ('task',))
+orphans_deleted = metrics.Counter('tracksite_maintenance_orphans_deleted_total', 'Orphaned rows deleted', ('table',))
+
+# Latest results as recorded in maintenance_runs, refreshed on every tick
+last_results = {}
+last_runs = {}
+
+metrics.Gauge('tracksite_db_relation_bytes', 'Size of tables and their indexes at the last report_sizes run',
+              lambda: {(row['table'], kind): row[kind + '_bytes']
+                       for row in last_results.get('report_sizes', {}).get('tables', [])
+                       for kind in ('table', 'index')} or None,
+              ('table', 'kind'))
+metrics.Gauge('tracksite_maintenance_last_run_timestamp', 'Unix time of the last run of each maintenance task',
+              lambda: {(task,): when.timestamp() for task, when in last_runs.items()} or None,
+              ('task',))
+
+recent_requests = collections.deque(maxlen=QUIET_MAX_REQUESTS)
+
+
+def note_request():
+    recent_requests.append(time.monotonic())
+
+
+def is_quiet():
+    # The deque only holds the last QUIET_MAX_REQUESTS timestamps: if it is not full,
+    # or its oldest entry is outside the window, fewer requests than that arrived
+    if len(recent_requests) < QUIET_MAX_REQUESTS:
+        return True
+    return recent_requests[0] < time.monotonic() - QUIET_SECONDS
+
+
+def init_app(app):
+    app.before_request(note_request)
+
+
+def create_runs_table(db, postgres):
+    execute(db, postgres, '''CREATE TABLE IF NOT EXISTS maintenance_runs (
+        task TEXT PRIMARY KEY,
+        last_run TEXT NOT NULL,
+        last_result TEXT
+    )''')
+
+
+def set_lock_timeout(db, postgres, milliseconds):
+    execute(db, postgres, f'SET lock_timeout = {int(milliseconds)}')
+
+
+def reset_lock_timeout(db, postgres):
+    # Committed, otherwise the pool's rollback on release would undo the RESET
+    db.rollback()
+    execute(db, postgres, 'RESET lock_timeout')
+    db.commit()
+
+
+def gc_orphans(db, postgres, batch_size=ORPHAN_BATCH_SIZE):
+    # Postgres enforces the foreign keys, only SQLite databases that ran without
+    # PRAGMA foreign_keys accumulate orphans. Shipment ids are walked in keyset order,
+    # one short write transaction per batch.
+    if postgres:
+        return {'skipped': 'foreign keys are enforced'}
+    deleted = {}
+    for table in SHIPMENT_CHILD_TABLES:
+        deleted[table] = 0
+        last_id = 0
+        while True:
+            ids = [row['shipment_id'] for row in execute(db, postgres, f'''SELECT DISTINCT t.shipment_id FROM {table} t
+                WHERE t.shipment_id > ? AND NOT EXISTS (SELECT 1 FROM shipments s WHERE s.id = t.shipment_id)
+                ORDER BY t.shipment_id LIMIT ?''', (last_id, batch_size)).fetchall()]
+            if not ids:
+                break
+            last_id = ids[-1]
+            cursor = execute(db, postgres, f"DELETE FROM {table} WHERE shipment_id IN ({', '.join('?' * len(ids))})", tuple(ids))
+            db.commit()
+            deleted[table] += cursor.rowcount
+            orphans_deleted.inc((table,), cursor.rowcount)
+    return {'deleted': deleted}
+
+
+def analyze(db, postgres):
+    # Table by table on Postgres so each one only holds its lock for its own sample
+    if postgres:
+        set_lock_timeout(db, postgres, LOCK_TIMEOUT_MS)
+        try:
+            for table in MAINTAINED_TABLES:
+                execute(db, postgres, f'ANALYZE {table}')
+                db.commit()
+        finally:
+            reset_lock_timeout(db, postgres)
+        return {'tables': len(MAINTAINED_TABLES)}
+    # Bounded sampling per index keeps ANALYZE short on large SQLite files
+    execute(db, postgres, 'PRAGMA analysis_limit = 1000')
+    execute(db, postgres, 'ANALYZE')
+    db.commit()
+    return {'tables': len(MAINTAINED_TABLES)}
+
+
+def optimize(db, postgres):
+    # SQLite's own heuristic: re-analyzes only the tables whose statistics drifted
+    if postgres:
+        return {'skipped': 'SQLite only'}
+    execute(db, postgres, 'PRAGMA optimize')
+    db.commit()
+    return {}
+
+
+def vacuum(db, postgres):
+    if postgres:
+        # Plain VACUUM does not block reads or writes; it cannot run inside a transaction
+        db.commit()
+        db.autocommit = True
+        try:
+            set_lock_timeout(db, postgres, LOCK_TIMEOUT_MS)
+            for table in MAINTAINED_TABLES:
+                execute(db, postgres, f'VACUUM {table}')
+        finally:
+            execute(db, postgres, 'RESET lock_timeout')
+            db.autocommit = False
+        return {'tables': len(MAINTAINED_TABLES)}
+    # SQLite's VACUUM rewrites the whole file under an exclusive lock, so it only runs
+    # when enough of the file is free pages to be worth it
+    page_count = execute(db, postgres, 'PRAGMA page_count').fetchone()[0]
+    free_pages = execute(db, postgres, 'PRAGMA freelist_count').fetchone()[0]
+    ratio = free_pages / page_count if page_count else 0
+    if ratio < SQLITE_VACUUM_FREE_RATIO:
+        return {'skipped': f'{ratio:.0%} free pages', 'pages': page_count}
+    db.commit()
+    execute(db, postgres, 'VACUUM')
+    return {'pages_before': page_count, 'pages_freed': free_pages}
+
+
+def archive_history(db, postgres):
+    result = history_archive.archive_closed_shipments(db, postgres)
+    if postgres:
+        history_archive.ensure_partitions(db)
+        result['dropped_partitions'] = history_archive.drop_empty_partitions(db)
+        db.commit()
+    return result
+
+
+def prune_tombstones(db, postgres):
+    return change_feed.prune_tombstones(db, postgres)
+
+
+def expire_idempotency_keys(db, postgres):
+    return idempotency.expire(db, postgres)
+
+
+def flag_overdue(db, postgres):
+    return sla.flag_overdue(db, postgres)
+
+
+def report_sizes(db, postgres):
+    if postgres:
+        # Partitioned tables have no storage of their own: sum over their partition tree
+        rows = execute(db, postgres, '''SELECT c.relname AS name,
+                CASE WHEN c.relkind = 'p' THEN (SELECT SUM(pg_relation_size(t.relid)) FROM pg_partition_tree(c.oid) t)
+                     ELSE pg_relation_size(c.oid) END AS table_bytes,
+                CASE WHEN c.relkind = 'p' THEN (SELECT SUM(pg_indexes_size(t.relid)) FROM pg_partition_tree(c.oid) t)
+                     ELSE pg_indexes_size(c.oid) END AS index_bytes
+            FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = current_schema() AND c.relkind IN ('r', 'p') AND NOT c.relispartition
+            ORDER BY c.relname''').fetchall()
+        tables = [{'table': row['name'], 'table_bytes': int(row['table_bytes'] or 0), 'index_bytes': int(row['index_bytes'] or 0)}
+                  for row in rows]
+        db.commit()
+        return {'tables': tables}
+    owners = {row['name']: (row['tbl_name'], row['type']) for row in execute(db, postgres,
+              "SELECT name, tbl_name, type FROM sqlite_master WHERE type IN ('table', 'index')").fetchall()}
+    sizes = {}
+    try:
+        # dbstat is an optional compile-time module; it reads every page of the file
+        for row in execute(db, postgres, 'SELECT name, SUM(pgsize) AS bytes FROM dbstat GROUP BY name').fetchall():
+            table, kind = owners.get(row['name'], (row['name'], 'table'))
+            entry = sizes.setdefault(table, {'table': table, 'table_bytes': 0, 'index_bytes': 0})
+            entry['index_bytes' if kind == 'index' else 'table_bytes'] += row['bytes']
+    except Exception as e:
+        page_size = execute(db, postgres, 'PRAGMA page_size').fetchone()[0]
+        page_count = execute(db, postgres, 'PRAGMA page_count').fetchone()[0]
+        return {'tables': [], 'database_bytes': page_size * page_count, 'note': str(e)}
+    return {'tables': sorted(sizes.values(), key=lambda entry: entry['table'])}
+
+
+# Task name -> (function, period, only during quiet periods)
+TASKS = {
+    'gc_orphans': (gc_orphans, timedelta(minutes=15), False),
+    'report_sizes': (report_sizes, timedelta(hours=1), False),
+    'optimize': (optimize, timedelta(hours=1), True),
+    'analyze': (analyze, timedelta(hours=6), True),
+    'vacuum': (vacuum, timedelta(days=1), True),
+    'archive_history': (archive_history, timedelta(days=1), True),
+    'prune_tombstones': (prune_tombstones, timedelta(days=1), False),
+    'expire_idempotency_keys': (expire_idempotency_keys, timedelta(hours=1), False),
+    'flag_overdue': (flag_overdue, timedelta(minutes=5), False),
+}
+
+
+def run_task(db, postgres, name):
+    function = TASKS[name][0]
+    started = time.perf_counter()
+    try:
+        result = function(db, postgres)
+    except Exception:
+        db.rollback()
+        runs.inc((name, 'error'))
+        raise
+    finally:
+        task_duration.observe(time.perf_counter() - started, (name,))
+    runs.inc((name, 'skipped' if 'skipped' in result else 'ok'))
+    result['seconds'] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def load_runs(db, postgres):
+    rows = execute(db, postgres, 'SELECT task, last_run, last_result FROM maintenance_runs').fetchall()
+    db.commit()
+    state = {}
+    for row in rows:
+        state[row['task']] = row['last_run']
+        if row['last_run']:
+            last_runs[row['task']] = datetime.fromisoformat(row['last_run'])
+        if row['last_result']:
+            last_results[row['task']] = json.loads(row['last_result'])
+    return state
+
+
+def claim(db, postgres, name, seen_last_run, now):
+    # Compare-and-set on the value read at the start of the tick: exactly one worker wins
+    if seen_last_run is None:
+        cursor = execute(db, postgres, 'INSERT INTO maintenance_runs (task, last_run) VALUES (?, ?) ON CONFLICT (task) DO NOTHING',
+                         (name, now.isoformat()))
+    else:
+        cursor = execute(db, postgres, 'UPDATE maintenance_runs SET last_run = ? WHERE task = ? AND last_run = ?',
+                         (now.isoformat(), name, seen_last_run))
+    db.commit()
+    return cursor.rowcount == 1
+
+
+def tick(db, postgres):
+    state = load_runs(db, postgres)
+    quiet = is_quiet()
+    now = datetime.now()
+    for name, (function, period, needs_quiet) in TASKS.items():
+        seen = state.get(name)
+        last_run = datetime.fromisoformat(seen) if seen else None
+        if last_run and now - last_run < period:
+            continue
+        # A busy site is never quiet: heavy tasks still run once they are a full period late
+        if needs_quiet and not quiet and last_run and now - last_run < 2 * period:
+            continue
+        if not claim(db, postgres, name, seen, now):
+            continue
+        try:
+            result = run_task(db, postgres, name)
+        except Exception as e:
+            result = {'error': str(e)}
+            print(f"MAINTENANCE {name} failed: {e}")
+        execute(db, postgres, 'UPDATE maintenance_runs SET last_result = ? WHERE task = ?', (json.dumps(result), name))
+        db.commit()
+        last_runs[name] = now
+        last_results[name] = result
+
+
+class Scheduler(threading.Thread):
+    def __init__(self, app, get_db, postgres, interval):
+        super().__init__(name='maintenance', daemon=True)
+        self.app = app
+        self.get_db = get_db
+        self.postgres = postgres
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        # Random first delay so workers started together do not all tick at once
+        delay = random.uniform(0, self.interval)
+        while not self.stopping.wait(delay):
+            delay = self.interval
+            try:
+                with self.app.app_context():
+                    tick(self.get_db(), self.postgres)
+            except Exception as e:
+                print(f"MAINTENANCE tick failed: {e}")
+
+
+scheduler = None
+scheduler_lock = threading.Lock()
+
+
+def start(app, get_db, postgres, interval=MAINTENANCE_INTERVAL):
+    # Called from each worker once its database is ready; a no-op after the first call
+    global scheduler
+    if interval <= 0:
+        return None
+    with scheduler_lock:
+        if scheduler is None:
+            scheduler = Scheduler(app, get_db, postgres, interval)
+            scheduler.start()
+    return scheduler
+
+
+def stop():
+    global scheduler
+    with scheduler_lock:
+        if scheduler is not None:
+            scheduler.stopping.set()
+            scheduler = None
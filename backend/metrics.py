@@ -0,0 +1,229 @@
+# Lightweight in-process metrics: request latency, DB time per request, slow queries,
+# pool waits and cache hit ratios, exposed in Prometheus text format by /metrics.
+# Each gunicorn worker keeps its own registry; Prometheus aggregates per target.
+import os
+import re
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+
+from flask import request
+from psycopg2.extras import RealDictCursor
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+registry = []
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for labels, value in sorted(self.values.items()):
+            yield f'{self.name}{format_labels(self.labelnames, labels)} {value}'
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                # [per-bucket counts (+Inf last), sum, count]
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = format_labels(self.labelnames + ('le',), labels + (str(bound),))
+                yield f'{self.name}_bucket{le} {cumulative}'
+            yield f'{self.name}_sum{format_labels(self.labelnames, labels)} {total}'
+            yield f'{self.name}_count{format_labels(self.labelnames, labels)} {count}'
+
+
+class Gauge:
+    # Value is read from a callback at scrape time, e.g. pool occupancy. With labelnames
+    # the callback returns a {label values tuple: value} dict instead of a single value.
+    def __init__(self, name, help, callback, labelnames=()):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.labelnames = labelnames
+        registry.append(self)
+
+    def render(self):
+        value = self.callback()
+        if value is None:
+            return
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} gauge'
+        if not self.labelnames:
+            yield f'{self.name} {value}'
+            return
+        for labels, labelled_value in sorted(value.items()):
+            yield f'{self.name}{format_labels(self.labelnames, labels)} {labelled_value}'
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+http_requests = Counter('tracksite_http_requests_total', 'HTTP requests by route and status', ('endpoint', 'method', 'status'))
+http_latency = Histogram('tracksite_http_request_duration_seconds', 'Request latency by route', ('endpoint', 'method'))
+request_db_time = Histogram('tracksite_request_db_seconds', 'Time spent in the database per request', ('endpoint',))
+request_db_queries = Histogram('tracksite_request_db_queries', 'Queries executed per request', ('endpoint',), COUNT_BUCKETS)
+query_latency = Histogram('tracksite_db_query_duration_seconds', 'Latency of individual SQL statements')
+slow_queries = Counter('tracksite_db_slow_queries_total', f'Statements slower than SLOW_QUERY_MS ({SLOW_QUERY_MS:g} ms)')
+pool_wait = Histogram('tracksite_db_pool_wait_seconds', 'Time spent acquiring a pooled connection')
+cache_requests = Counter('tracksite_cache_requests_total', 'Cache lookups by cache and result', ('cache', 'result'))
+
+# Per-thread request state; gthread workers serve one request per thread at a time
+current = threading.local()
+
+
+def start_request():
+    current.started = time.perf_counter()
+    current.db_time = 0.0
+    current.db_queries = 0
+
+
+def finish_request(response):
+    started = getattr(current, 'started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    current.started = None
+    endpoint = request.endpoint or 'unmatched'
+    http_latency.observe(elapsed, (endpoint, request.method))
+    http_requests.inc((endpoint, request.method, response.status_code))
+    request_db_time.observe(current.db_time, (endpoint,))
+    request_db_queries.observe(current.db_queries, (endpoint,))
+    return response
+
+
+def init_app(app):
+    # Registered before any other hook so the timer covers them too
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+
+_literal = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%s|\?")
+_spaces = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    # Strip parameters and literals so the same statement groups under one shape
+    return _literal.sub('?', _spaces.sub(' ', sql).strip())
+
+
+def record_query(sql, elapsed, params=None):
+    query_latency.observe(elapsed)
+    if getattr(current, 'started', None) is not None:
+        current.db_time += elapsed
+        current.db_queries += 1
+    query_log = getattr(current, 'query_log', None)
+    if query_log is not None:
+        # Only set while a request is being profiled or its plans captured
+        query_log.append((sql, elapsed, params))
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_queries.inc()
+        print(f"SLOW QUERY ({elapsed * 1000:.1f} ms): {normalize_sql(sql)}")
+
+
+def record_pool_wait(elapsed):
+    pool_wait.observe(elapsed)
+
+
+def cache_hit(cache):
+    cache_requests.inc((cache, 'hit'))
+
+
+def cache_miss(cache):
+    cache_requests.inc((cache, 'miss'))
+
+
+class InstrumentedCursor(RealDictCursor):
+    # psycopg2 cursor that times every statement
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(query if isinstance(query, str) else str(query), time.perf_counter() - started, vars)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_query(query if isinstance(query, str) else str(query), time.perf_counter() - started)
+
+
+class InstrumentedSQLiteCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - started, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+
+class InstrumentedSQLiteConnection(sqlite3.Connection):
+    # Passed as sqlite3.connect(factory=...); db.execute() goes through the timed cursor
+    def cursor(self, factory=InstrumentedSQLiteCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
@@ -0,0 +1,101 @@
+# PATCH support: UPDATE only the columns present in the request body, guarded by the
+# row `version` maintained by the change feed triggers. The expected version comes from
+# an If-Match header (the ETag of an earlier response) or a `version` body field; when
+# it no longer matches, the write is refused instead of overwriting a concurrent one.
+import os
+
+import metrics
+from common import LRU, execute
+
+# Columns a PATCH may set, per table
+PATCHABLE_COLUMNS = {
+    'shipments': (
+        'shipper_name', 'shipper_address', 'shipper_phone', 'shipper_email',
+        'receiver_name', 'receiver_address', 'receiver_phone', 'receiver_email',
+        'origin', 'destination', 'status', 'packages', 'total_weight', 'product', 'quantity',
+        'payment_mode', 'total_freight', 'expected_delivery', 'departure_time',
+        'pickup_date', 'pickup_time', 'comments',
+    ),
+    'users': ('name', 'email', 'password', 'role', 'branch', 'status'),
+    'tracking_history': ('date_time', 'location', 'status', 'description', 'latitude', 'longitude'),
+}
+
+# Values the schema accepts for constrained columns (the CHECK constraints in app.py),
+# checked before the UPDATE so a bad value is a plain 400
+SHIPMENT_STATUSES = ('pending_confirmation', 'processing', 'picked_up', 'in_transit', 'delivered', 'delayed', 'rejected', 'cancelled')
+ALLOWED_VALUES = {
+    ('shipments', 'status'): SHIPMENT_STATUSES,
+}
+
+# (table, columns, checked, postgres) -> UPDATE statement. A handful of column sets cover
+# real traffic, but clients pick the columns: bounded, least recently used evicted
+STATEMENT_CACHE_SIZE = int(os.environ.get('PATCH_STATEMENT_CACHE_SIZE', 256))
+statement_cache = LRU(STATEMENT_CACHE_SIZE)
+
+
+def update_statement(table, columns, checked, postgres):
+    key = (table, columns, checked, postgres)
+    sql = statement_cache.get(key)
+    if sql is not None:
+        metrics.cache_hit('update_sql')
+        return sql
+    metrics.cache_miss('update_sql')
+    assignments = ', '.join(f'{column} = ?' for column in columns)
+    sql = f'UPDATE {table} SET {assignments} WHERE id = ?'
+    if checked:
+        sql += ' AND version = ?'
+    if postgres:
+        sql = sql.replace('?', '%s')
+    statement_cache.put(key, sql)
+    return sql
+
+
+def etag(version):
+    return f'"{version}"'
+
+
+def expected_version(if_match, data):
+    # Returns None when the client did not ask for a check ("If-Match: *" or nothing);
+    # raises ValueError for anything but an integer or a numeric string
+    if if_match and if_match.strip() != '*':
+        return int(if_match.strip().removeprefix('W/').strip('"'))
+    version = data.get('version')
+    if version is None:
+        return None
+    if isinstance(version, bool) or not isinstance(version, (int, str)):
+        raise ValueError(f'Invalid version {version!r}')
+    return int(version)
+
+
+def patch_columns(table, data):
+    # Splits the body into the columns to write and the unknown keys to reject
+    allowed = PATCHABLE_COLUMNS[table]
+    unknown = sorted(key for key in data if key not in allowed and key != 'version')
+    columns = tuple(column for column in allowed if column in data)
+    return columns, unknown
+
+
+def invalid_value(table, columns, data):
+    # -> an error message for the first value the schema would refuse, or None
+    for column in columns:
+        allowed = ALLOWED_VALUES.get((table, column))
+        if allowed is not None and data[column] not in allowed:
+            return f"Invalid {column} {data[column]!r}, expected one of: {', '.join(allowed)}"
+    return None
+
+
+def apply_patch(db, postgres, table, row_id, columns, data, version=None):
+    # Returns ('updated', row), ('missing', None) or ('conflict', current version).
+    # Does not commit, so callers can add related writes to the same transaction.
+    params = tuple(data[column] for column in columns) + (row_id,)
+    if version is not None:
+        params += (version,)
+    cursor = execute(db, postgres, update_statement(table, columns, version is not None, postgres), params)
+    if cursor.rowcount == 1:
+        # Read back after the write: on SQLite the version is stamped by an AFTER trigger
+        row = execute(db, postgres, f'SELECT * FROM {table} WHERE id = ?', (row_id,)).fetchone()
+        return 'updated', dict(row)
+    current = execute(db, postgres, f'SELECT version FROM {table} WHERE id = ?', (row_id,)).fetchone()
+    if current is None:
+        return 'missing', None
+    return 'conflict', current['version']
@@ -0,0 +1,174 @@
+# On-demand request profiling: a sampling thread snapshots the handler thread's stack
+# while the view runs and writes a flame graph (collapsed stacks or speedscope JSON)
+# plus the SQL executed during the request. Enabled per request by a signed
+# X-Profile header, or for a random fraction of traffic with PROFILE_SAMPLE_RATE.
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import request
+
+import metrics
+
+PROFILE_SECRET = os.environ.get('PROFILE_SECRET', '')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/tracksite-profiles')
+PROFILE_FORMAT = os.environ.get('PROFILE_FORMAT', 'speedscope')  # or 'collapsed'
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', 1)) / 1000
+
+current = threading.local()
+
+
+def sign(path, expires):
+    message = f'{expires}:{path}'.encode()
+    return hmac.new(PROFILE_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+
+def make_token(path, ttl=3600):
+    # Header value for X-Profile, valid for one path until it expires
+    expires = int(time.time()) + ttl
+    return f'{expires}:{sign(path, expires)}'
+
+
+def token_is_valid(token, path):
+    if not PROFILE_SECRET:
+        return False
+    expires, _, signature = token.partition(':')
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, sign(path, expires))
+
+
+def frame_label(code):
+    return code.co_name, os.path.basename(code.co_filename), code.co_firstlineno
+
+
+class Sampler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.stacks
+
+
+def should_profile():
+    token = request.headers.get('X-Profile')
+    if token is not None:
+        return token_is_valid(token, request.path)
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def start_profile():
+    current.sampler = None
+    if not should_profile():
+        return
+    metrics.current.query_log = []
+    current.started = time.perf_counter()
+    current.sampler = Sampler(threading.get_ident(), PROFILE_INTERVAL)
+    current.sampler.start()
+
+
+def finish_profile(response):
+    sampler = getattr(current, 'sampler', None)
+    if sampler is None:
+        return response
+    current.sampler = None
+    stacks = sampler.stop()
+    duration = time.perf_counter() - current.started
+    queries = metrics.current.query_log
+    metrics.current.query_log = None
+    try:
+        path = write_profile(stacks, duration, queries, response.status_code)
+        response.headers['X-Profile-File'] = os.path.basename(path)
+    except OSError as e:
+        print(f"Error writing profile: {e}")
+    return response
+
+
+def write_profile(stacks, duration, queries, status):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint or 'unmatched'}-{os.getpid()}-{threading.get_ident() % 100000}"
+    base = os.path.join(PROFILE_DIR, name)
+
+    if PROFILE_FORMAT == 'collapsed':
+        path = base + '.folded'
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(';'.join(f'{fn} ({filename}:{line})' for fn, filename, line in stack) + f' {count}\n')
+    else:
+        path = base + '.speedscope.json'
+        with open(path, 'w') as f:
+            json.dump(to_speedscope(stacks, duration, name), f)
+
+    with open(base + '.sql.json', 'w') as f:
+        json.dump({
+            'method': request.method,
+            'path': request.full_path,
+            'endpoint': request.endpoint,
+            'status': status,
+            'duration_ms': round(duration * 1000, 3),
+            'samples': sum(stacks.values()),
+            'queries': [{'sql': sql, 'duration_ms': round(elapsed * 1000, 3)} for sql, elapsed, params in queries or []],
+        }, f, indent=2)
+    return path
+
+
+def to_speedscope(stacks, duration, name):
+    frames = []
+    index = {}
+    samples = []
+    weights = []
+    for stack, count in stacks.items():
+        sample = []
+        for label in stack:
+            if label not in index:
+                index[label] = len(frames)
+                frames.append({'name': label[0], 'file': label[1], 'line': label[2]})
+            sample.append(index[label])
+        samples.append(sample)
+        weights.append(count * PROFILE_INTERVAL)
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': duration,
+            'samples': samples,
+            'weights': weights,
+        }],
+        'name': name,
+        'exporter': 'tracksite profiling',
+    }
+
+
+def init_app(app):
+    # Hooks are only installed when profiling is configured, so by default it costs nothing
+    if not PROFILE_SECRET and not PROFILE_SAMPLE_RATE:
+        return
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
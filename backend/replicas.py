@@ -0,0 +1,183 @@
+# Postgres read replicas (DATABASE_REPLICA_URLS, comma separated). Each worker keeps a
+# pool per replica and sends the GET requests of read-only endpoints to the healthy
+# replicas in turn; writes, transactions and everything else stay on the primary.
+#
+# A checker thread probes every replica each CHECK_SECONDS: one that does not answer or
+# replays more than MAX_LAG_SECONDS behind the primary gets no reads until it recovers.
+# Between two checks the lag may grow, so a replica read can be up to STALE_SECONDS
+# old, which the caches allow for (see cache.read_lag).
+#
+# Read-your-writes: every successful write response carries its time in the
+# X-Recent-Write header and cookie. A client sending either back is pinned to the
+# primary until that write is PIN_SECONDS old.
+import itertools
+import os
+import threading
+import time
+
+import psycopg2
+from flask import g, has_app_context
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+import metrics
+
+REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+POOL_MAX = int(os.environ.get('DB_REPLICA_POOL_MAX', os.environ.get('DB_POOL_MAX', 8)))
+CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', 2))
+CONNECT_TIMEOUT = int(os.environ.get('REPLICA_CONNECT_TIMEOUT', 2))
+MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 5))
+STALE_SECONDS = MAX_LAG_SECONDS + CHECK_SECONDS
+# Shorter than STALE_SECONDS, a pinned client may briefly read from before its write
+PIN_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', STALE_SECONDS))
+PIN_HEADER = 'X-Recent-Write'
+PIN_COOKIE = 'tracksite_recent_write'
+
+# Zero when the replica has replayed everything it received (an idle primary sends no
+# new transactions, so the replay timestamp alone would look like growing lag)
+LAG_SQL = '''SELECT CASE
+    WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END AS lag'''
+
+replica_reads = metrics.Counter('tracksite_replica_reads_total', 'Read-only requests by the database that served them', ('target',))
+
+
+class Replica:
+    def __init__(self, number, url):
+        self.name = f'replica{number}'
+        self.url = url
+        self.pool = None
+        self.probe = None  # the checker's own connection
+        self.healthy = False
+        self.lag = None
+
+    def check(self):
+        try:
+            if self.probe is None or self.probe.closed:
+                self.probe = psycopg2.connect(self.url, connect_timeout=CONNECT_TIMEOUT)
+                self.probe.autocommit = True
+            with self.probe.cursor() as cursor:
+                cursor.execute(LAG_SQL)
+                self.lag = float(cursor.fetchone()[0])
+            if self.pool is None:
+                self.pool = ThreadedConnectionPool(0, POOL_MAX, self.url, cursor_factory=metrics.InstrumentedCursor,
+                                                   connect_timeout=CONNECT_TIMEOUT)
+            healthy = self.lag <= MAX_LAG_SECONDS
+        except psycopg2.Error as e:
+            if self.healthy:
+                print(f"Replica {self.name} unavailable: {e}")
+            self.lag = None
+            healthy = False
+            if self.probe is not None:
+                self.probe.close()
+                self.probe = None
+        if healthy and not self.healthy:
+            print(f"Replica {self.name} serving reads (lag {self.lag:.1f}s)")
+        elif self.healthy and not healthy and self.lag is not None:
+            print(f"Replica {self.name} {self.lag:.1f}s behind, reads go elsewhere")
+        self.healthy = healthy
+
+    def close(self):
+        self.healthy = False
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
+        if self.probe is not None:
+            self.probe.close()
+            self.probe = None
+
+
+replicas = [Replica(number, url) for number, url in enumerate(REPLICA_URLS, 1)]
+turns = itertools.count()
+checker = None
+checker_lock = threading.Lock()
+stopping = threading.Event()
+
+
+def enabled():
+    return bool(replicas)
+
+
+def run_checks():
+    while not stopping.is_set():
+        for replica in replicas:
+            replica.check()
+        stopping.wait(CHECK_SECONDS)
+
+
+def start():
+    # After fork, with the primary pool; until the first check every read stays on the primary
+    global checker
+    with checker_lock:
+        if replicas and checker is None:
+            stopping.clear()
+            checker = threading.Thread(target=run_checks, name='replica-checker', daemon=True)
+            checker.start()
+
+
+def stop():
+    global checker
+    with checker_lock:
+        if checker is not None:
+            stopping.set()
+            checker.join(timeout=CHECK_SECONDS + CONNECT_TIMEOUT)
+            checker = None
+        for replica in replicas:
+            replica.close()
+
+
+def borrow():
+    # -> (replica, connection) from the next healthy replica, or None to use the primary
+    healthy = [replica for replica in replicas if replica.healthy]
+    if not healthy:
+        return None
+    first = next(turns)
+    for offset in range(len(healthy)):
+        replica = healthy[(first + offset) % len(healthy)]
+        try:
+            return replica, replica.pool.getconn()
+        except PoolError:
+            # Exhausted: try the next one, the primary takes the overflow
+            continue
+        except psycopg2.Error as e:
+            print(f"Replica {replica.name} unavailable: {e}")
+            replica.healthy = False
+    return None
+
+
+def give_back(replica, connection):
+    if not connection.closed:
+        connection.rollback()
+    if replica.pool is not None:
+        replica.pool.putconn(connection, close=bool(connection.closed))
+    else:
+        connection.close()
+
+
+def pinned(request):
+    # The client wrote less than PIN_SECONDS ago
+    value = request.headers.get(PIN_HEADER) or request.cookies.get(PIN_COOKIE)
+    try:
+        written = int(value) / 1000
+    except (TypeError, ValueError):
+        return False
+    return 0 <= time.time() - written < PIN_SECONDS
+
+
+def mark_write(response):
+    # On successful write responses
+    stamp = str(int(time.time() * 1000))
+    response.headers[PIN_HEADER] = stamp
+    response.set_cookie(PIN_COOKIE, stamp, max_age=max(1, int(PIN_SECONDS)), httponly=True, samesite='Lax')
+    return response
+
+
+def read_lag():
+    # How old the current request's reads may be
+    return STALE_SECONDS if has_app_context() and g.get('db_replica') is not None else 0.0
+
+
+metrics.Gauge('tracksite_replica_healthy', 'Whether each replica is serving reads',
+              lambda: {(replica.name,): int(replica.healthy) for replica in replicas} if replicas else None, ('replica',))
+metrics.Gauge('tracksite_replica_lag_seconds', 'Replay lag of each replica at the last check',
+              lambda: {(replica.name,): replica.lag for replica in replicas if replica.lag is not None} or None, ('replica',))
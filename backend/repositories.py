@@ -0,0 +1,339 @@
+# Data access for the API routes: shipments, tracking history, progress, the rate
+# tables and users. Each operation is a single Query written with ? placeholders;
+# configure() builds the statement for the running dialect once at startup, so the
+# routes no longer carry a Postgres and a SQLite copy of every statement. Inserts
+# return the new id through RETURNING on both dialects.
+#
+# Postgres: a pooled connection PREPAREs a query the first time it runs it and
+# EXECUTEs it by name afterwards, so the server parses and plans it once per
+# connection rather than once per request. Set DB_PREPARED_STATEMENTS=false behind a
+# transaction-mode pooler (pgbouncer), where the next transaction may land on a
+# server connection that never saw the PREPARE.
+# SQLite: the sqlite3 module keeps compiled statements per connection, keyed by SQL
+# text (SQLITE_STATEMENT_CACHE in sqlite_writer.py).
+#
+# Rows are tuples with access by column name (row['id'], dict(row)), one small class
+# per column list, instead of a dict per row; as_dict() makes the JSON form.
+import os
+import re
+import sqlite3
+import threading
+import time
+import weakref
+from functools import lru_cache
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+import current_state
+import metrics
+
+PREPARED_STATEMENTS = os.environ.get('DB_PREPARED_STATEMENTS', 'true').lower() == 'true'
+STATEMENT_PREFIX = 'tracksite_'
+# RETURNING arrived in SQLite 3.35; older libraries fall back to lastrowid
+SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+RETURNING_ID = re.compile(r'\s+RETURNING id$')
+
+postgres = None
+queries = []
+
+
+class Query:
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.inserts = bool(RETURNING_ID.search(sql))
+        self.statement = None
+        self.prepare = None
+        self.execute = None
+        queries.append(self)
+
+    def bind(self, use_postgres):
+        count = self.sql.count('?')
+        if use_postgres:
+            self.statement = self.sql.replace('?', '%s')
+            self.prepare = f'PREPARE {STATEMENT_PREFIX}{self.name} AS ' + numbered(self.sql)
+            self.execute = f'EXECUTE {STATEMENT_PREFIX}{self.name}' + (f" ({', '.join(['%s'] * count)})" if count else '')
+        elif self.inserts and not SQLITE_RETURNING:
+            self.statement = RETURNING_ID.sub('', self.sql)
+        else:
+            self.statement = self.sql
+
+
+def numbered(sql):
+    # ? placeholders as Postgres $1, $2... (PREPARE, asyncpg)
+    numbers = iter(range(1, sql.count('?') + 1))
+    return re.sub(r'\?', lambda _: f'${next(numbers)}', sql)
+
+
+def configure(use_postgres):
+    global postgres
+    postgres = use_postgres
+    for query in queries:
+        query.bind(use_postgres)
+
+
+class Row(tuple):
+    # Base of the per-column-list classes made by row_class()
+    __slots__ = ()
+    columns = ()
+    positions = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self.positions[key])
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return self.columns
+
+    def get(self, key, default=None):
+        position = self.positions.get(key)
+        return default if position is None else tuple.__getitem__(self, position)
+
+
+@lru_cache(maxsize=None)
+def row_class(columns):
+    return type('Row', (Row,), {'__slots__': (), 'columns': columns,
+                                'positions': {column: position for position, column in enumerate(columns)}})
+
+
+def as_dict(row):
+    return dict(zip(row.columns, row))
+
+
+def as_dicts(rows):
+    return [dict(zip(row.columns, row)) for row in rows]
+
+
+prepared = weakref.WeakKeyDictionary()  # connection -> names PREPAREd on it
+prepared_lock = threading.Lock()
+
+
+def prepared_names(db):
+    with prepared_lock:
+        names = prepared.get(db)
+        if names is None:
+            names = prepared[db] = set()
+    return names
+
+
+def run(db, query, params=()):
+    if not postgres:
+        cursor = db.execute(query.statement, params)
+        cursor.row_factory = None  # plain tuples, wrapped by fetch
+        return cursor
+    # A plain tuple cursor, timed here so the log shows the statement rather than EXECUTE
+    cursor = db.cursor(cursor_factory=psycopg2.extensions.cursor)
+    started = time.perf_counter()
+    try:
+        if PREPARED_STATEMENTS:
+            names = prepared_names(db)
+            if query.name not in names:
+                cursor.execute(query.prepare)
+                names.add(query.name)
+            cursor.execute(query.execute, params)
+        else:
+            cursor.execute(query.statement, params)
+    except psycopg2.errors.FeatureNotSupported:
+        # "cached plan must not change result type": a migration changed a table under a
+        # prepared SELECT *. The pool drops closed connections; the next one prepares anew.
+        db.close()
+        raise
+    finally:
+        metrics.record_query(query.statement, time.perf_counter() - started, params)
+    return cursor
+
+
+def wrap(cursor, rows):
+    cls = row_class(tuple(column[0] for column in cursor.description))
+    return [cls(values) for values in rows]
+
+
+def fetch_all(db, query, params=()):
+    cursor = run(db, query, params)
+    return wrap(cursor, cursor.fetchall())
+
+
+def fetch_one(db, query, params=()):
+    cursor = run(db, query, params)
+    values = cursor.fetchone()
+    return None if values is None else wrap(cursor, (values,))[0]
+
+
+def write(db, query, params=()):
+    # -> rows affected
+    return run(db, query, params).rowcount
+
+
+def insert(db, query, params=()):
+    # -> the new row's id
+    cursor = run(db, query, params)
+    if not postgres and not SQLITE_RETURNING:
+        return cursor.lastrowid
+    # fetchall: a RETURNING statement left unfinished would hold up the commit
+    return cursor.fetchall()[0][0]
+
+
+class Table:
+    # Create/update/delete by id and the full listing, for tables edited as whole rows.
+    # `insert_columns` adds columns set on creation only (created_at).
+    def __init__(self, table, columns, order_by, insert_columns=()):
+        inserted = columns + insert_columns
+        assignments = ', '.join(f'{column} = ?' for column in columns)
+        self.listing = Query(f'{table}_list', f'SELECT * FROM {table} ORDER BY {order_by}')
+        self.inserting = Query(f'{table}_insert', f"INSERT INTO {table} ({', '.join(inserted)}) VALUES ({', '.join('?' * len(inserted))}) RETURNING id")
+        self.updating = Query(f'{table}_update', f'UPDATE {table} SET {assignments} WHERE id = ?')
+        self.deleting = Query(f'{table}_delete', f'DELETE FROM {table} WHERE id = ?')
+
+    def list(self, db):
+        return fetch_all(db, self.listing)
+
+    def insert(self, db, values):
+        return insert(db, self.inserting, values)
+
+    def update(self, db, id, values):
+        return write(db, self.updating, tuple(values) + (id,))
+
+    def delete(self, db, id):
+        return write(db, self.deleting, (id,))
+
+
+# Rates and reference data
+locations = Table('locations', ('name', 'slug', 'country', 'latitude', 'longitude'), 'name')
+zones = Table('zones', ('name', 'slug', 'locations', 'description'), 'name')
+shipping_rates = Table('shipping_rates', ('name', 'type', 'min_weight', 'max_weight', 'rate', 'insurance', 'description'), 'name')
+pickup_rates = Table('pickup_rates', ('zone', 'min_weight', 'max_weight', 'rate', 'description'), 'zone')
+
+
+# Users
+users = Table('users', ('name', 'email', 'password', 'role', 'branch', 'status'), 'name', ('created_at',))
+USER_LOGIN = Query('users_login', 'SELECT * FROM users WHERE email = ? AND password = ?')
+USER_LAST_LOGIN = Query('users_last_login', 'UPDATE users SET last_login = ? WHERE id = ?')
+
+
+def find_user(db, email, password):
+    return fetch_one(db, USER_LOGIN, (email, password))
+
+
+def record_login(db, user_id, when):
+    write(db, USER_LAST_LOGIN, (when, user_id))
+
+
+# Shipments
+SHIPMENT_COLUMNS = ('tracking_number', 'shipper_name', 'shipper_address', 'shipper_phone', 'shipper_email',
+                    'receiver_name', 'receiver_address', 'receiver_phone', 'receiver_email',
+                    'origin', 'destination', 'status', 'packages', 'total_weight', 'product', 'quantity',
+                    'payment_mode', 'total_freight', 'expected_delivery', 'departure_time',
+                    'pickup_date', 'pickup_time', 'comments', 'date_created')
+# Everything but tracking_number and date_created, in the same order
+EDITABLE_SHIPMENT_COLUMNS = SHIPMENT_COLUMNS[1:-1]
+
+LISTING = f'SELECT s.*, {current_state.LISTED_COLUMNS} FROM shipments s LEFT JOIN shipment_current_state c ON c.shipment_id = s.id'
+SHIPMENTS_LIST = Query('shipments_list', f'{LISTING} ORDER BY s.date_created DESC')
+SHIPMENTS_BY_STATUS = Query('shipments_by_status', f'{LISTING} WHERE s.status = ? ORDER BY s.date_created DESC')
+SHIPMENT_BY_TRACKING_NUMBER = Query('shipments_by_tracking_number', 'SELECT * FROM shipments WHERE tracking_number = ?')
+SHIPMENT_ROUTE = Query('shipments_route', 'SELECT origin, destination FROM shipments WHERE id = ?')
+SHIPMENT_INSERT = Query('shipments_insert', f"INSERT INTO shipments ({', '.join(SHIPMENT_COLUMNS)}) VALUES ({', '.join('?' * len(SHIPMENT_COLUMNS))}) RETURNING id")
+SHIPMENT_UPDATE = Query('shipments_update', f"UPDATE shipments SET {', '.join(f'{column} = ?' for column in EDITABLE_SHIPMENT_COLUMNS)} WHERE id = ?")
+SHIPMENT_CONFIRM = Query('shipments_confirm', '''UPDATE shipments SET tracking_number = ?, status = 'processing',
+    total_freight = ?, expected_delivery = ?, comments = ? WHERE id = ?''')
+SHIPMENT_SET_STATUS = Query('shipments_set_status', 'UPDATE shipments SET status = ? WHERE id = ?')
+SHIPMENT_SET_STATUS_COMMENTS = Query('shipments_set_status_comments', 'UPDATE shipments SET status = ?, comments = ? WHERE id = ?')
+SHIPMENT_DELETE = Query('shipments_delete', 'DELETE FROM shipments WHERE id = ?')
+
+
+def list_shipments(db, status=None):
+    if status:
+        return fetch_all(db, SHIPMENTS_BY_STATUS, (status,))
+    return fetch_all(db, SHIPMENTS_LIST)
+
+
+def shipment_by_tracking_number(db, tracking_number):
+    return fetch_one(db, SHIPMENT_BY_TRACKING_NUMBER, (tracking_number,))
+
+
+def shipment_route(db, shipment_id):
+    return fetch_one(db, SHIPMENT_ROUTE, (shipment_id,))
+
+
+def insert_shipment(db, values):
+    # `values` maps every column of SHIPMENT_COLUMNS
+    return insert(db, SHIPMENT_INSERT, tuple(values[column] for column in SHIPMENT_COLUMNS))
+
+
+def update_shipment(db, shipment_id, values):
+    return write(db, SHIPMENT_UPDATE, tuple(values[column] for column in EDITABLE_SHIPMENT_COLUMNS) + (shipment_id,))
+
+
+def confirm_shipment(db, shipment_id, tracking_number, total_freight, expected_delivery, comments):
+    return write(db, SHIPMENT_CONFIRM, (tracking_number, total_freight, expected_delivery, comments, shipment_id))
+
+
+def set_shipment_status(db, shipment_id, status, comments=None):
+    if comments is None:
+        return write(db, SHIPMENT_SET_STATUS, (status, shipment_id))
+    return write(db, SHIPMENT_SET_STATUS_COMMENTS, (status, comments, shipment_id))
+
+
+def delete_shipment(db, shipment_id):
+    return write(db, SHIPMENT_DELETE, (shipment_id,))
+
+
+# Tracking history
+EVENT_COLUMNS = ('date_time', 'location', 'status', 'description', 'latitude', 'longitude')
+
+HISTORY = Query('tracking_history_of_shipment', 'SELECT * FROM tracking_history WHERE shipment_id = ? ORDER BY date_time DESC')
+TRACKED_HISTORY = Query('tracking_history_tracked', f"SELECT {', '.join(EVENT_COLUMNS)} FROM tracking_history WHERE shipment_id = ? ORDER BY date_time DESC")
+EVENT_INSERT = Query('tracking_history_insert', f"INSERT INTO tracking_history (shipment_id, {', '.join(EVENT_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id")
+EVENT_UPDATE = Query('tracking_history_update', f"UPDATE tracking_history SET {', '.join(f'{column} = ?' for column in EVENT_COLUMNS)} WHERE id = ?")
+EVENT_SHIPMENT = Query('tracking_history_shipment', 'SELECT shipment_id FROM tracking_history WHERE id = ?')
+EVENT_DELETE = Query('tracking_history_delete', 'DELETE FROM tracking_history WHERE id = ?')
+
+
+def history(db, shipment_id):
+    return fetch_all(db, HISTORY, (shipment_id,))
+
+
+def tracked_history(db, shipment_id):
+    # The columns shown on the public tracking page
+    return fetch_all(db, TRACKED_HISTORY, (shipment_id,))
+
+
+def add_event(db, shipment_id, date_time, location, status, description, latitude, longitude):
+    return insert(db, EVENT_INSERT, (shipment_id, date_time, location, status, description, latitude, longitude))
+
+
+def update_event(db, event_id, date_time, location, status, description, latitude, longitude):
+    return write(db, EVENT_UPDATE, (date_time, location, status, description, latitude, longitude, event_id))
+
+
+def event_shipment(db, event_id):
+    row = fetch_one(db, EVENT_SHIPMENT, (event_id,))
+    return row['shipment_id'] if row else None
+
+
+def delete_event(db, event_id):
+    return write(db, EVENT_DELETE, (event_id,))
+
+
+# Progress
+PROGRESS = Query('shipment_progress_latest', 'SELECT * FROM shipment_progress WHERE shipment_id = ? ORDER BY last_updated DESC LIMIT 1')
+# Backed by uq_shipment_progress_shipment
+PROGRESS_UPSERT = Query('shipment_progress_upsert', '''INSERT INTO shipment_progress (shipment_id, progress, current_lat, current_lng, last_updated)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (shipment_id) DO UPDATE SET
+        progress = excluded.progress,
+        current_lat = excluded.current_lat,
+        current_lng = excluded.current_lng,
+        last_updated = excluded.last_updated''')
+
+
+def progress(db, shipment_id):
+    return fetch_one(db, PROGRESS, (shipment_id,))
+
+
+def save_progress(db, shipment_id, value, current_lat, current_lng, last_updated):
+    write(db, PROGRESS_UPSERT, (shipment_id, value, current_lat, current_lng, last_updated))
@@ -0,0 +1,141 @@
+# Full-text search over shipments behind GET /api/shipments/search. A side table holds
+# one searchable document per shipment, kept in sync by triggers on insert and on
+# updates of the searched columns:
+# - Postgres: shipment_search(document, vector) with a GIN index on the tsvector and,
+#   when the pg_trgm extension is available, a trigram GIN index on the document.
+# - SQLite: an FTS5 table with the trigram tokenizer.
+#
+# Every whitespace-separated term of the query must match. Terms of three characters or
+# more match anywhere in the document (partial phone or tracking numbers); shorter ones
+# match the start of a word. Without pg_trgm every term matches word prefixes.
+import re
+
+import psycopg2
+
+from common import create_trigger, execute
+
+SEARCHED_COLUMNS = (
+    'tracking_number', 'shipper_name', 'shipper_phone', 'shipper_email', 'shipper_address',
+    'receiver_name', 'receiver_phone', 'receiver_email', 'receiver_address', 'origin', 'destination',
+)
+MIN_TERM_LENGTH = 3
+LIMIT = 20
+MAX_LIMIT = 100
+TRIGRAM_INDEX = 'idx_shipment_search_trgm'
+
+# Per worker: whether the trigram index exists, looked up on first search
+trigram_available = None
+
+
+def document_sql(prefix):
+    return 'lower(' + " || ' ' || ".join(f"coalesce({prefix}{column}, '')" for column in SEARCHED_COLUMNS) + ')'
+
+
+def install(db, postgres):
+    columns = ', '.join(SEARCHED_COLUMNS)
+    if postgres:
+        execute(db, postgres, '''CREATE TABLE IF NOT EXISTS shipment_search (
+            shipment_id INTEGER PRIMARY KEY REFERENCES shipments (id) ON DELETE CASCADE,
+            document TEXT NOT NULL,
+            vector TSVECTOR NOT NULL
+        )''')
+        execute(db, postgres, 'CREATE INDEX IF NOT EXISTS idx_shipment_search_vector ON shipment_search USING GIN (vector)')
+        execute(db, postgres, 'SAVEPOINT pg_trgm')
+        try:
+            execute(db, postgres, 'CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            execute(db, postgres, f'CREATE INDEX IF NOT EXISTS {TRIGRAM_INDEX} ON shipment_search USING GIN (document gin_trgm_ops)')
+            execute(db, postgres, 'RELEASE SAVEPOINT pg_trgm')
+        except psycopg2.Error as e:
+            # Managed databases without the extension still get word-prefix search
+            execute(db, postgres, 'ROLLBACK TO SAVEPOINT pg_trgm')
+            print(f"pg_trgm unavailable, shipment search falls back to word prefixes: {e}")
+        execute(db, postgres, f'''CREATE OR REPLACE FUNCTION index_shipment_search() RETURNS trigger AS $$
+        DECLARE
+            doc TEXT := {document_sql('NEW.')};
+        BEGIN
+            INSERT INTO shipment_search (shipment_id, document, vector) VALUES (NEW.id, doc, to_tsvector('simple', doc))
+            ON CONFLICT (shipment_id) DO UPDATE SET document = EXCLUDED.document, vector = EXCLUDED.vector;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql''')
+        create_trigger(db, postgres, 'trg_shipments_search', 'shipments', f'''AFTER INSERT OR UPDATE OF {columns} ON shipments
+            FOR EACH ROW EXECUTE FUNCTION index_shipment_search()''')
+        execute(db, postgres, f'''INSERT INTO shipment_search (shipment_id, document, vector)
+            SELECT id, {document_sql('')}, to_tsvector('simple', {document_sql('')}) FROM shipments
+            ON CONFLICT (shipment_id) DO NOTHING''')
+        return
+    # The FTS rowid is the shipment id
+    execute(db, postgres, "CREATE VIRTUAL TABLE IF NOT EXISTS shipment_search USING fts5(document, tokenize = 'trigram')")
+    execute(db, postgres, f'''CREATE TRIGGER IF NOT EXISTS trg_shipments_search_insert AFTER INSERT ON shipments BEGIN
+        INSERT INTO shipment_search (rowid, document) VALUES (NEW.id, {document_sql('NEW.')});
+    END''')
+    execute(db, postgres, f'''CREATE TRIGGER IF NOT EXISTS trg_shipments_search_update AFTER UPDATE OF {columns} ON shipments BEGIN
+        UPDATE shipment_search SET document = {document_sql('NEW.')} WHERE rowid = NEW.id;
+    END''')
+    execute(db, postgres, '''CREATE TRIGGER IF NOT EXISTS trg_shipments_search_delete AFTER DELETE ON shipments BEGIN
+        DELETE FROM shipment_search WHERE rowid = OLD.id;
+    END''')
+    execute(db, postgres, f'INSERT INTO shipment_search (rowid, document) SELECT id, {document_sql("")} FROM shipments')
+
+
+def has_trigram_index(db, postgres):
+    global trigram_available
+    if trigram_available is None:
+        trigram_available = execute(db, postgres, 'SELECT 1 FROM pg_indexes WHERE indexname = ?', (TRIGRAM_INDEX,)).fetchone() is not None
+    return trigram_available
+
+
+def normalize_terms(query):
+    return [term for term in query.lower().split() if term]
+
+
+def like_pattern(term):
+    return '%' + re.sub(r'([\\%_])', r'\\\1', term) + '%'
+
+
+def prefix_query(words, operator):
+    # Only \w runs reach to_tsquery, quoted, so user input cannot inject query syntax
+    return f' {operator} '.join(f"'{word}':*" for word in words)
+
+
+def search(db, postgres, query, limit=LIMIT, offset=0):
+    # Raises ValueError for a query without any term of MIN_TERM_LENGTH characters
+    terms = normalize_terms(query)
+    if not any(len(term) >= MIN_TERM_LENGTH for term in terms):
+        raise ValueError(f'q needs at least one term of {MIN_TERM_LENGTH} characters')
+    long_terms = [term for term in terms if len(term) >= MIN_TERM_LENGTH]
+    short_terms = [term for term in terms if len(term) < MIN_TERM_LENGTH]
+    # An exact tracking number always comes first
+    exact = query.strip().upper()
+    if postgres:
+        conditions, params = [], []
+        if has_trigram_index(db, postgres):
+            for term in long_terms:
+                conditions.append("x.document LIKE ? ESCAPE '\\'")
+                params.append(like_pattern(term))
+            prefixed = [word for term in short_terms for word in re.findall(r'\w+', term)]
+        else:
+            prefixed = [word for term in terms for word in re.findall(r'\w+', term)]
+        if prefixed:
+            conditions.append("x.vector @@ to_tsquery('simple', ?)")
+            params.append(prefix_query(prefixed, '&'))
+        ranking = prefix_query([word for term in terms for word in re.findall(r'\w+', term)] or ['_'], '|')
+        rows = execute(db, postgres, f'''SELECT s.*, ts_rank(x.vector, to_tsquery('simple', ?)) AS rank
+            FROM shipment_search x JOIN shipments s ON s.id = x.shipment_id
+            WHERE {' AND '.join(conditions or ['FALSE'])}
+            ORDER BY s.tracking_number = ? DESC, rank DESC, s.id DESC LIMIT ? OFFSET ?''',
+            (ranking, *params, exact, limit + 1, offset)).fetchall()
+    else:
+        match = ' AND '.join('"' + term.replace('"', '""') + '"' for term in long_terms)
+        # Short terms are below the trigram size: filter the matched rows on word starts
+        conditions = ['shipment_search MATCH ?'] + ["(' ' || shipment_search.document) LIKE ? ESCAPE '\\'"] * len(short_terms)
+        rows = execute(db, postgres, f'''SELECT s.*, -bm25(shipment_search) AS rank
+            FROM shipment_search JOIN shipments s ON s.id = shipment_search.rowid
+            WHERE {' AND '.join(conditions)}
+            ORDER BY s.tracking_number = ? DESC, rank DESC, s.id DESC LIMIT ? OFFSET ?''',
+            (match, *(like_pattern(' ' + term) for term in short_terms), exact, limit + 1, offset)).fetchall()
+    db.commit()
+    results = [dict(row) for row in rows[:limit]]
+    for row in results:
+        row['rank'] = round(float(row['rank']), 6)
+    return {'query': query, 'results': results, 'limit': limit, 'offset': offset, 'has_more': len(rows) > limit}
@@ -0,0 +1,85 @@
+# Delivery SLA sweep, run by the maintenance scheduler: shipments still on their way
+# after their expected_delivery day are switched to 'delayed' with a history event.
+# Each batch is one set-based UPDATE plus one INSERT ... SELECT; only the rows the
+# UPDATE actually changed get an event, so overlapping runs never double-flag.
+import os
+import time
+from datetime import datetime
+
+import metrics
+from common import execute
+
+# Statuses of shipments that are expected to arrive and can therefore be late
+OPEN_STATUSES = ('processing', 'picked_up', 'in_transit')
+BATCH_SIZE = int(os.environ.get('SLA_BATCH_SIZE', 1000))
+# Pause between batches so a large backlog never holds the write lock for long
+BATCH_PAUSE_SECONDS = float(os.environ.get('SLA_BATCH_PAUSE_SECONDS', 0.05))
+EVENT_LOCATION = 'SLA Monitor'
+
+flagged_total = metrics.Counter('tracksite_sla_flagged_total', 'Shipments flagged as delayed by the SLA sweep', ('previous_status',))
+
+OPEN_LIST = ', '.join(f"'{status}'" for status in OPEN_STATUSES)
+OVERDUE = f"status IN ({OPEN_LIST}) AND expected_delivery < ? AND expected_delivery <> ''"
+
+
+def create_index(db, postgres):
+    # Partial: only open shipments are ever candidates, delivered ones never enter it
+    execute(db, postgres, f'CREATE INDEX IF NOT EXISTS idx_shipments_open_expected ON shipments (expected_delivery) WHERE status IN ({OPEN_LIST})')
+
+
+def flag_batch(db, postgres, cutoff, now, batch_size):
+    # Returns {previous status: count} for the rows this batch switched to 'delayed'
+    if postgres:
+        # One statement: rows locked by a concurrent writer are skipped, not waited for
+        rows = execute(db, postgres, f'''WITH candidates AS (
+                SELECT id, status FROM shipments WHERE {OVERDUE} LIMIT ? FOR UPDATE SKIP LOCKED
+            ), flagged AS (
+                UPDATE shipments s SET status = 'delayed' FROM candidates c
+                WHERE s.id = c.id RETURNING s.id, s.expected_delivery, c.status AS previous_status
+            ), events AS (
+                INSERT INTO tracking_history (shipment_id, date_time, location, status, description)
+                SELECT id, ?, ?, 'delayed', 'Expected delivery date ' || expected_delivery || ' has passed' FROM flagged
+            )
+            SELECT previous_status, COUNT(*) AS shipments FROM flagged GROUP BY previous_status''',
+            (cutoff, batch_size, now, EVENT_LOCATION)).fetchall()
+        db.commit()
+        return {row['previous_status']: row['shipments'] for row in rows}
+    # SQLite has a single writer: select, update and insert within one short transaction
+    candidates = execute(db, postgres, f'SELECT id, status FROM shipments WHERE {OVERDUE} LIMIT ?',
+                         (cutoff, batch_size)).fetchall()
+    if not candidates:
+        db.commit()
+        return {}
+    ids = tuple(row['id'] for row in candidates)
+    placeholders = ', '.join('?' * len(ids))
+    flagged = {row['id'] for row in execute(db, postgres, f"UPDATE shipments SET status = 'delayed' WHERE id IN ({placeholders}) AND {OVERDUE} RETURNING id",
+                                             ids + (cutoff,)).fetchall()}
+    if flagged:
+        execute(db, postgres, f'''INSERT INTO tracking_history (shipment_id, date_time, location, status, description)
+            SELECT id, ?, ?, 'delayed', 'Expected delivery date ' || expected_delivery || ' has passed'
+            FROM shipments WHERE id IN ({', '.join('?' * len(flagged))})''', (now, EVENT_LOCATION) + tuple(sorted(flagged)))
+    db.commit()
+    counts = {}
+    for row in candidates:
+        if row['id'] in flagged:
+            counts[row['status']] = counts.get(row['status'], 0) + 1
+    return counts
+
+
+def flag_overdue(db, postgres, batch_size=BATCH_SIZE):
+    # expected_delivery is a YYYY-MM-DD day (a time part is tolerated): a shipment is
+    # overdue once that whole day has passed
+    cutoff = datetime.now().strftime('%Y-%m-%d')
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    flagged = {}
+    batches = 0
+    while True:
+        counts = flag_batch(db, postgres, cutoff, now, batch_size)
+        batches += 1
+        for status, count in counts.items():
+            flagged[status] = flagged.get(status, 0) + count
+            flagged_total.inc((status,), count)
+        if sum(counts.values()) < batch_size:
+            break
+        time.sleep(BATCH_PAUSE_SECONDS)
+    return {'flagged': sum(flagged.values()), 'by_previous_status': flagged, 'batches': batches, 'cutoff': cutoff}
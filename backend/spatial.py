@@ -0,0 +1,268 @@
+# Position queries over active shipments behind GET /api/shipments/nearby (within a
+# radius of a point) and GET /api/shipments/within (a map bounding box). A shipment's
+# position is its last reported GPS/progress position, else the coordinates of its
+# latest tracking event, both read from shipment_current_state.
+#
+# Candidates come from a spatial index, then exact distances and bounds are checked on
+# all candidates at once with numpy:
+# - SQLite: an R*Tree over the positions, kept in sync by triggers.
+# - Postgres with PostGIS: a GiST index on a generated geometry column.
+# - Otherwise (or with SPATIAL_INDEX=grid): an in-process grid of CELL_DEGREES cells,
+#   rebuilt per worker at most every REFRESH_SECONDS.
+import math
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import psycopg2
+
+import repositories
+import sla
+from common import add_column, execute
+from eta import EARTH_RADIUS_KM, haversine_km
+
+SPATIAL_INDEX = os.environ.get('SPATIAL_INDEX', 'auto')
+CELL_DEGREES = float(os.environ.get('SPATIAL_CELL_DEGREES', 0.5))
+REFRESH_SECONDS = float(os.environ.get('SPATIAL_REFRESH_SECONDS', 5))
+# Delayed shipments are still on their way
+ACTIVE_STATUSES = sla.OPEN_STATUSES + ('delayed',)
+LIMIT = 100
+MAX_LIMIT = 1000
+MAX_RADIUS_KM = 5000
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+GRID_COLUMNS = int(math.ceil(360 / CELL_DEGREES)) + 1
+
+# The live position when the shipment reports one, else its latest event's
+LATITUDE = 'CASE WHEN {0}current_lat IS NOT NULL AND {0}current_lng IS NOT NULL THEN {0}current_lat ELSE {0}latitude END'
+LONGITUDE = 'CASE WHEN {0}current_lat IS NOT NULL AND {0}current_lng IS NOT NULL THEN {0}current_lng ELSE {0}longitude END'
+POSITIONED = f"{LATITUDE.format('c.')} IS NOT NULL AND {LONGITUDE.format('c.')} IS NOT NULL"
+SELECTED = f'''SELECT s.id, s.tracking_number, s.status, c.location, c.last_event_at,
+        {LATITUDE.format('c.')} AS latitude, {LONGITUDE.format('c.')} AS longitude
+    FROM shipments s JOIN shipment_current_state c ON c.shipment_id = s.id'''
+RESPONSE_FIELDS = ('id', 'tracking_number', 'status', 'location', 'last_event_at', 'latitude', 'longitude')
+
+GRID_ROWS = repositories.Query('spatial_grid', f"{SELECTED} WHERE s.status IN ({', '.join('?' * len(ACTIVE_STATUSES))}) AND {POSITIONED}")
+
+
+def candidates_query(kind, ranges, statuses):
+    # `ranges` and `statuses` are counts: one or two longitude ranges, up to every active status
+    status_list = ', '.join('?' * statuses)
+    if kind == 'rtree':
+        boxes = ' OR '.join(['(p.min_lng <= ? AND p.max_lng >= ?)'] * ranges)
+        sql = f'''{SELECTED} JOIN shipment_positions p ON p.id = s.id
+            WHERE p.max_lat >= ? AND p.min_lat <= ? AND ({boxes}) AND s.status IN ({status_list})'''
+    else:
+        boxes = ' OR '.join(['c.position && ST_MakeEnvelope(?, ?, ?, ?, 4326)'] * ranges)
+        sql = f'{SELECTED} WHERE ({boxes}) AND s.status IN ({status_list})'
+    return repositories.Query(f'spatial_{kind}_{ranges}_{statuses}', sql)
+
+
+CANDIDATES = {(kind, ranges, statuses): candidates_query(kind, ranges, statuses)
+              for kind in ('rtree', 'postgis') for ranges in (1, 2) for statuses in range(1, len(ACTIVE_STATUSES) + 1)}
+
+
+def install(db, postgres):
+    if postgres:
+        # Optional: without PostGIS the in-process grid serves the queries
+        execute(db, postgres, 'SAVEPOINT postgis')
+        try:
+            execute(db, postgres, 'CREATE EXTENSION IF NOT EXISTS postgis')
+            add_column(db, postgres, 'shipment_current_state', 'position', f'''geometry(Point, 4326)
+                GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint({LONGITUDE.format('')}, {LATITUDE.format('')}), 4326)) STORED''')
+            execute(db, postgres, 'CREATE INDEX IF NOT EXISTS idx_shipment_current_state_position ON shipment_current_state USING GIST (position)')
+            execute(db, postgres, 'RELEASE SAVEPOINT postgis')
+        except psycopg2.Error as e:
+            execute(db, postgres, 'ROLLBACK TO SAVEPOINT postgis')
+            print(f"PostGIS unavailable, position queries use the in-process grid: {e}")
+        return
+    try:
+        execute(db, postgres, 'CREATE VIRTUAL TABLE IF NOT EXISTS shipment_positions USING rtree(id, min_lat, max_lat, min_lng, max_lng)')
+    except sqlite3.OperationalError as e:
+        print(f"R*Tree unavailable, position queries use the in-process grid: {e}")
+        return
+    # R*Tree boxes are float32, rounded outwards: exact positions are read from the state
+    position = f"SELECT NEW.shipment_id, lat, lat, lng, lng FROM (SELECT {LATITUDE.format('NEW.')} AS lat, {LONGITUDE.format('NEW.')} AS lng) WHERE lat IS NOT NULL AND lng IS NOT NULL"
+    execute(db, postgres, f'''CREATE TRIGGER IF NOT EXISTS trg_shipment_current_state_position_insert AFTER INSERT ON shipment_current_state BEGIN
+        INSERT OR REPLACE INTO shipment_positions (id, min_lat, max_lat, min_lng, max_lng) {position};
+    END''')
+    execute(db, postgres, f'''CREATE TRIGGER IF NOT EXISTS trg_shipment_current_state_position_update
+        AFTER UPDATE OF latitude, longitude, current_lat, current_lng ON shipment_current_state BEGIN
+        DELETE FROM shipment_positions WHERE id = NEW.shipment_id;
+        INSERT INTO shipment_positions (id, min_lat, max_lat, min_lng, max_lng) {position};
+    END''')
+    execute(db, postgres, '''CREATE TRIGGER IF NOT EXISTS trg_shipment_current_state_position_delete AFTER DELETE ON shipment_current_state BEGIN
+        DELETE FROM shipment_positions WHERE id = OLD.shipment_id;
+    END''')
+    execute(db, postgres, f'''INSERT INTO shipment_positions (id, min_lat, max_lat, min_lng, max_lng)
+        SELECT shipment_id, {LATITUDE.format('')}, {LATITUDE.format('')}, {LONGITUDE.format('')}, {LONGITUDE.format('')}
+        FROM shipment_current_state WHERE {LATITUDE.format('')} IS NOT NULL AND {LONGITUDE.format('')} IS NOT NULL''')
+
+
+# Per worker: 'rtree', 'postgis' or 'grid', looked up on first query
+backend = None
+
+
+def get_backend(db, postgres):
+    global backend
+    if backend is None:
+        if SPATIAL_INDEX == 'grid':
+            backend = 'grid'
+        elif postgres:
+            found = execute(db, postgres, "SELECT 1 FROM pg_indexes WHERE indexname = 'idx_shipment_current_state_position'").fetchone()
+            backend = 'postgis' if found else 'grid'
+        else:
+            found = execute(db, postgres, "SELECT 1 FROM sqlite_master WHERE name = 'shipment_positions'").fetchone()
+            backend = 'rtree' if found else 'grid'
+    return backend
+
+
+def longitude_ranges(west, east):
+    # A box crossing the antimeridian (west > east) is two ranges
+    if west <= east:
+        return [(west, east)]
+    return [(west, 180.0), (-180.0, east)]
+
+
+def box_around(latitude, longitude, radius_km):
+    # (south, north, longitude ranges) containing every point within radius_km
+    delta = radius_km / KM_PER_DEGREE
+    south, north = max(latitude - delta, -90.0), min(latitude + delta, 90.0)
+    widest = max(abs(south), abs(north))
+    if widest >= 89.9 or delta / math.cos(math.radians(widest)) >= 180:
+        return south, north, [(-180.0, 180.0)]
+    spread = delta / math.cos(math.radians(widest))
+    west = (longitude - spread + 180) % 360 - 180
+    east = (longitude + spread + 180) % 360 - 180
+    return south, north, longitude_ranges(west, east)
+
+
+def in_ranges(longitudes, ranges):
+    mask = np.zeros(len(longitudes), dtype=bool)
+    for low, high in ranges:
+        mask |= (longitudes >= low) & (longitudes <= high)
+    return mask
+
+
+class Grid:
+    # Active shipments' positions bucketed by cell; cells are contiguous runs of `order`
+    def __init__(self, rows):
+        self.rows = [dict(row) for row in rows]
+        self.latitudes = np.array([row['latitude'] for row in self.rows], dtype=np.float64)
+        self.longitudes = np.array([row['longitude'] for row in self.rows], dtype=np.float64)
+        self.statuses = np.array([row['status'] for row in self.rows], dtype=object)
+        cells = (np.floor((self.latitudes + 90) / CELL_DEGREES).astype(np.int64) * GRID_COLUMNS
+                 + np.floor((self.longitudes + 180) / CELL_DEGREES).astype(np.int64))
+        self.order = np.argsort(cells, kind='stable')
+        self.cells, self.starts = np.unique(cells[self.order], return_index=True)
+        self.ends = np.append(self.starts[1:], len(cells)).astype(np.int64)
+        self.loaded_at = time.monotonic()
+
+    def candidates(self, south, north, ranges):
+        cell_latitudes = (self.cells // GRID_COLUMNS) * CELL_DEGREES - 90
+        cell_longitudes = (self.cells % GRID_COLUMNS) * CELL_DEGREES - 180
+        # A cell overlaps the box when its [start, start + size) span does
+        mask = (cell_latitudes + CELL_DEGREES >= south) & (cell_latitudes <= north)
+        overlaps = np.zeros(len(self.cells), dtype=bool)
+        for low, high in ranges:
+            overlaps |= (cell_longitudes + CELL_DEGREES >= low) & (cell_longitudes <= high)
+        mask &= overlaps
+        if not mask.any():
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self.order[start:end] for start, end in zip(self.starts[mask], self.ends[mask])])
+
+
+grid = None
+grid_lock = threading.Lock()
+
+
+def load_grid(db, postgres):
+    global grid
+    with grid_lock:
+        if grid is None or time.monotonic() - grid.loaded_at > REFRESH_SECONDS:
+            rows = repositories.fetch_all(db, GRID_ROWS, ACTIVE_STATUSES)
+            db.commit()
+            grid = Grid(rows)
+        return grid
+
+
+def candidates(db, postgres, south, north, ranges, statuses):
+    # -> (rows, latitudes, longitudes) of active shipments in or near the box
+    kind = get_backend(db, postgres)
+    if kind == 'grid':
+        current = load_grid(db, postgres)
+        picked = current.candidates(south, north, ranges)
+        picked = picked[np.isin(current.statuses[picked], statuses)]
+        return [current.rows[i] for i in picked], current.latitudes[picked], current.longitudes[picked]
+    if kind == 'rtree':
+        params = (south, north) + tuple(value for low, high in ranges for value in (high, low)) + tuple(statuses)
+    else:
+        params = tuple(value for low, high in ranges for value in (low, south, high, north)) + tuple(statuses)
+    query = CANDIDATES[(kind, len(ranges), len(statuses))]
+    rows = repositories.as_dicts(repositories.fetch_all(db, query, params))
+    db.commit()
+    return (rows, np.array([row['latitude'] for row in rows], dtype=np.float64),
+            np.array([row['longitude'] for row in rows], dtype=np.float64))
+
+
+def parse_statuses(value):
+    # Raises ValueError for a status that is not an active one
+    if not value:
+        return ACTIVE_STATUSES
+    # Without repeats: a status list is at most every active status
+    statuses = tuple(dict.fromkeys(status.strip() for status in value.split(',') if status.strip()))
+    unknown = [status for status in statuses if status not in ACTIVE_STATUSES]
+    if unknown or not statuses:
+        raise ValueError(f"status must be among: {', '.join(ACTIVE_STATUSES)}")
+    return statuses
+
+
+def shipment(row, **extra):
+    result = {field: row[field] for field in RESPONSE_FIELDS}
+    result.update(extra)
+    return result
+
+
+def nearby(db, postgres, latitude, longitude, radius_km, limit=LIMIT, statuses=ACTIVE_STATUSES):
+    # Closest first; raises ValueError for coordinates or a radius out of range
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('lat must be within [-90, 90] and lng within [-180, 180]')
+    if not 0 < radius_km <= MAX_RADIUS_KM:
+        raise ValueError(f'radius must be positive and at most {MAX_RADIUS_KM} km')
+    south, north, ranges = box_around(latitude, longitude, radius_km)
+    rows, latitudes, longitudes = candidates(db, postgres, south, north, ranges, statuses)
+    distances = haversine_km(latitude, longitude, latitudes, longitudes)
+    inside = np.flatnonzero(distances <= radius_km)
+    closest = inside[np.argsort(distances[inside], kind='stable')][:limit]
+    return {
+        'center': {'lat': latitude, 'lng': longitude},
+        'radius_km': radius_km,
+        'index': get_backend(db, postgres),
+        'total': len(inside),
+        'shipments': [shipment(rows[i], distance_km=round(float(distances[i]), 3)) for i in closest],
+    }
+
+
+def parse_bbox(value):
+    # "west,south,east,north", as Leaflet's LatLngBounds.toBBoxString(); raises ValueError
+    try:
+        west, south, east, north = (float(part) for part in value.split(','))
+    except (AttributeError, ValueError):
+        raise ValueError('bbox must be west,south,east,north')
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError('bbox is outside valid coordinates')
+    return west, south, east, north
+
+
+def within(db, postgres, west, south, east, north, limit=MAX_LIMIT, statuses=ACTIVE_STATUSES):
+    ranges = longitude_ranges(west, east)
+    rows, latitudes, longitudes = candidates(db, postgres, south, north, ranges, statuses)
+    inside = np.flatnonzero((latitudes >= south) & (latitudes <= north) & in_ranges(longitudes, ranges))
+    inside = inside[np.argsort([rows[i]['id'] for i in inside], kind='stable')]
+    return {
+        'bbox': [west, south, east, north],
+        'index': get_backend(db, postgres),
+        'total': len(inside),
+        'shipments': [shipment(rows[i]) for i in inside[:limit]],
+    }
@@ -0,0 +1,322 @@
+# SQLite production mode (USE_POSTGRESQL=false). Every connection runs in WAL mode with
+# synchronous=NORMAL, a busy timeout, memory-mapped reads, a larger page cache and
+# foreign keys on. Readers keep one connection per thread, so the page cache survives
+# between requests, and run concurrently with the writer under WAL.
+#
+# Every write of a worker goes through a single writer connection, behind a session
+# standing in for the connection. A write request takes the writer at its first
+# statement, so what it reads cannot change before it writes; read requests, init_db,
+# CLI commands and background threads read on their thread's connection and only take
+# the writer at their first write. Either way, once a session holds the writer all its
+# statements run there, inside a savepoint. commit() releases the savepoint and hands
+# the writer to the next queued session; a writer thread commits everything released
+# so far in one SQLite transaction (group commit) and only then do the sessions'
+# commit() calls return. A failing session rolls back its savepoint alone; a failing
+# COMMIT fails every session of the group. With SQLITE_GROUP_COMMIT=false each session
+# commits its own transaction before handing the writer over.
+#
+# Other workers' writers wait on the busy timeout: run one worker with many threads to
+# get a single writer per database (see gunicorn.conf.py).
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import metrics
+
+JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'wal')
+SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'normal')
+BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+# Per connection, in KiB (a negative cache_size)
+CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 64 * 1024))
+# Compiled statements kept per connection (the sqlite3 default is 128); room for every
+# repository query plus the rest of the app's statements
+STATEMENT_CACHE = int(os.environ.get('SQLITE_STATEMENT_CACHE', 512))
+GROUP_COMMIT = os.environ.get('SQLITE_GROUP_COMMIT', 'true').lower() == 'true'
+# A group is committed once this many requests joined it, or when nobody else is queued
+# for the writer, or this long after it started
+GROUP_COMMIT_MAX = int(os.environ.get('SQLITE_GROUP_COMMIT_MAX', 64))
+GROUP_COMMIT_WAIT_MS = float(os.environ.get('SQLITE_GROUP_COMMIT_WAIT_MS', 2))
+
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+# Statements a session may run before taking the writer; anything else writes. PRAGMAs
+# that assign a value, or optimize (which may ANALYZE), run on the writer.
+READ_STATEMENT = re.compile(r'^\s*(SELECT|EXPLAIN|PRAGMA\s+(?!optimize\b)\w+\s*(\(|;|$))', re.IGNORECASE)
+# Statements SQLite refuses inside a transaction
+UNTRANSACTED_STATEMENT = re.compile(r'^\s*VACUUM\b', re.IGNORECASE)
+
+group_sizes = metrics.Histogram('tracksite_sqlite_group_commit_size', 'Write transactions per SQLite commit', buckets=metrics.COUNT_BUCKETS)
+writer_wait = metrics.Histogram('tracksite_sqlite_writer_wait_seconds', 'Time spent waiting for the SQLite writer')
+
+
+def configure(db):
+    db.execute(f'PRAGMA journal_mode = {JOURNAL_MODE}')
+    db.execute(f'PRAGMA synchronous = {SYNCHRONOUS}')
+    db.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    db.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    db.execute(f'PRAGMA cache_size = {-CACHE_SIZE_KB}')
+    # Off by default in SQLite: without it ON DELETE CASCADE is ignored
+    db.execute('PRAGMA foreign_keys = ON')
+    return db
+
+
+def connect(path, **kwargs):
+    db = sqlite3.connect(path, factory=metrics.InstrumentedSQLiteConnection, cached_statements=STATEMENT_CACHE, **kwargs)
+    db.row_factory = sqlite3.Row
+    return configure(db)
+
+
+readers = threading.local()
+
+
+def reader(path):
+    # This thread's connection, kept open across requests (see release_db in app.py)
+    db = getattr(readers, 'db', None)
+    if db is None or readers.path != path:
+        db = readers.db = connect(path)
+        readers.path = path
+    return db
+
+
+class Ticket:
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class Writer(threading.Thread):
+    def __init__(self, path):
+        super().__init__(name='sqlite-writer', daemon=True)
+        self.path = path
+        # Autocommit mode: transactions and savepoints are issued explicitly
+        self.db = connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()  # held by the request whose savepoint is open
+        self.condition = threading.Condition()
+        self.queued = 0
+        self.released = []  # tickets of requests waiting for the group commit
+        self.stopping = threading.Event()
+
+    def wait(self):
+        started = time.perf_counter()
+        with self.condition:
+            self.queued += 1
+        self.lock.acquire()
+        with self.condition:
+            self.queued -= 1
+        writer_wait.observe(time.perf_counter() - started)
+
+    def acquire(self):
+        self.wait()
+        try:
+            if not self.db.in_transaction:
+                self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute('SAVEPOINT request')
+        except Exception:
+            self.lock.release()
+            raise
+
+    def release(self):
+        # Called with the lock held, after a successful RELEASE; returns the ticket to wait on
+        ticket = Ticket()
+        with self.condition:
+            self.released.append(ticket)
+            self.condition.notify_all()
+        self.lock.release()
+        return ticket
+
+    def abort(self):
+        try:
+            self.db.execute('ROLLBACK TO request')
+            self.db.execute('RELEASE request')
+            with self.condition:
+                # Nothing else in the transaction: do not keep the database reserved
+                if not self.released and self.db.in_transaction:
+                    self.db.execute('ROLLBACK')
+        finally:
+            with self.condition:
+                self.condition.notify_all()
+            self.lock.release()
+
+    def wait_for_group(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.released or self.stopping.is_set())
+            deadline = time.monotonic() + GROUP_COMMIT_WAIT_MS / 1000
+            while self.queued and len(self.released) < GROUP_COMMIT_MAX:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+    def commit_released(self):
+        # Called with the lock held
+        with self.condition:
+            group, self.released = self.released, []
+        if not group:
+            return
+        error = None
+        try:
+            self.db.execute('COMMIT')
+        except sqlite3.Error as e:
+            error = e
+            if self.db.in_transaction:
+                self.db.execute('ROLLBACK')
+        group_sizes.observe(len(group))
+        for ticket in group:
+            ticket.error = error
+            ticket.done.set()
+
+    def commit_group(self):
+        with self.lock:
+            self.commit_released()
+
+    def commit_alone(self):
+        # SQLITE_GROUP_COMMIT=false; called with the lock held, after a successful RELEASE
+        try:
+            self.db.execute('COMMIT')
+            group_sizes.observe(1)
+        except sqlite3.Error:
+            if self.db.in_transaction:
+                self.db.execute('ROLLBACK')
+            raise
+        finally:
+            self.lock.release()
+
+    def run_alone(self, sql, parameters):
+        # VACUUM and the like: outside any transaction, once the pending group committed
+        self.wait()
+        try:
+            self.commit_released()
+            return self.db.execute(sql, parameters)
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.wait_for_group()
+                self.commit_group()
+            except Exception as e:
+                print(f"SQLite group commit failed: {e}")
+        self.commit_group()
+
+
+class SessionCursor:
+    # db.cursor() of a write session: statements go through the session
+    def __init__(self, session):
+        self.session = session
+        self.cursor = None
+
+    def execute(self, sql, parameters=()):
+        self.cursor = self.session.execute(sql, parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.cursor = self.session.executemany(sql, seq_of_parameters)
+        return self
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class WriteSession:
+    # Stands in for the connection of a request or app context, see the header.
+    # serialized: take the writer at the first statement, reads included.
+    def __init__(self, writer, read_db, serialized=False):
+        self.writer = writer
+        self.read_db = read_db
+        self.serialized = serialized
+        self.writing = False
+        # commit() leaves the transaction open while set (see idempotency.py)
+        self.deferred = False
+
+    def begin(self):
+        # Takes the writer now; every statement until commit() or rollback() runs on it
+        if not self.writing:
+            self.read_db.rollback()
+            self.writer.acquire()
+            self.writing = True
+
+    def connection(self, sql):
+        if not self.writing and not self.serialized and READ_STATEMENT.match(sql):
+            return self.read_db
+        self.begin()
+        return self.writer.db
+
+    def execute(self, sql, parameters=()):
+        if not self.writing and UNTRANSACTED_STATEMENT.match(sql):
+            return self.writer.run_alone(sql, parameters)
+        return self.connection(sql).execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.connection(sql).executemany(sql, seq_of_parameters)
+
+    def cursor(self):
+        return SessionCursor(self)
+
+    def commit(self):
+        if self.deferred:
+            return
+        if not self.writing:
+            self.read_db.commit()
+            return
+        self.writing = False
+        try:
+            self.writer.db.execute('RELEASE request')
+        except Exception:
+            self.writer.abort()
+            raise
+        if not GROUP_COMMIT:
+            self.writer.commit_alone()
+            return
+        ticket = self.writer.release()
+        ticket.done.wait()
+        if ticket.error is not None:
+            raise ticket.error
+
+    def rollback(self):
+        if not self.writing:
+            self.read_db.rollback()
+            return
+        self.writing = False
+        self.writer.abort()
+
+    def close(self):
+        self.rollback()
+
+
+writers = {}  # database path -> Writer
+writers_lock = threading.Lock()
+
+
+def start(path):
+    # Started by the first session of each worker
+    with writers_lock:
+        writer = writers.get(path)
+        if writer is None:
+            writer = writers[path] = Writer(path)
+            writer.start()
+    return writer
+
+
+def stop():
+    with writers_lock:
+        for writer in writers.values():
+            writer.stopping.set()
+            with writer.condition:
+                writer.condition.notify_all()
+            writer.join(timeout=5)
+            writer.db.close()
+        writers.clear()
+
+
+def session(path, serialized=False):
+    return WriteSession(start(path), reader(path), serialized)
+
+
+metrics.Gauge('tracksite_sqlite_writer_queued', 'Sessions waiting for the SQLite writer',
+              lambda: sum(writer.queued for writer in list(writers.values())) if writers else None)
@@ -0,0 +1,56 @@
+# The app reads its configuration at import: point it at a throwaway SQLite database
+# before the first test imports it. Run from backend/: python -m pytest tests
+# With TEST_DATABASE_URL set the suite runs on that Postgres database instead, emptied
+# first like the fresh SQLite file; tests marked `sqlite` are skipped there and the ASGI
+# ones run.
+import os
+import sys
+import tempfile
+
+import psycopg2
+import pytest
+
+POSTGRES_URL = os.environ.get('TEST_DATABASE_URL')
+if POSTGRES_URL:
+    with psycopg2.connect(POSTGRES_URL) as db:
+        db.cursor().execute('DROP SCHEMA public CASCADE; CREATE SCHEMA public')
+    db.close()
+    os.environ['USE_POSTGRESQL'] = 'true'
+    os.environ['DATABASE_URL'] = POSTGRES_URL
+else:
+    os.environ['USE_POSTGRESQL'] = 'false'
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='tracksite-tests-'), 'database.db')
+os.environ['MAINTENANCE_INTERVAL'] = '0'
+os.environ['ETA_LANE_REFRESH_SECONDS'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as tracksite  # noqa: E402
+
+ADMIN = {'X-Admin-Request': 'true'}
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'sqlite: needs the SQLite backend')
+
+
+def pytest_collection_modifyitems(config, items):
+    if POSTGRES_URL:
+        skip = pytest.mark.skip(reason='runs on SQLite only')
+        for item in items:
+            if 'sqlite' in item.keywords:
+                item.add_marker(skip)
+
+
+@pytest.fixture
+def client():
+    return tracksite.app.test_client()
+
+
+@pytest.fixture
+def shipment(client):
+    response = client.post('/api/shipments', json={
+        'shipper_name': 'Shipper', 'receiver_name': 'Receiver', 'shipper_email': 'shipper@example.com',
+        'shipper_phone': '0600000000', 'origin': 'Paris', 'destination': 'Lyon',
+    }, headers=ADMIN)
+    assert response.status_code in (200, 201), response.get_json()
+    return response.get_json()
@@ -0,0 +1,134 @@
+# The async routes of asgi.py must answer like their Flask versions. They only serve
+# Postgres: run with TEST_DATABASE_URL set (see conftest.py).
+import asyncio
+
+import pytest
+
+import app as tracksite
+import history_archive
+from common import execute
+from conftest import ADMIN
+
+pytestmark = pytest.mark.skipif(not tracksite.USE_POSTGRESQL, reason='the async routes serve Postgres only')
+asgi = pytest.importorskip('asgi')
+
+VALIDATORS = ('ETag', 'Last-Modified', 'Cache-Control', 'Access-Control-Allow-Origin')
+
+
+@pytest.fixture(autouse=True)
+def uncached(monkeypatch):
+    # Every request loads its payload, so each side is compared on what it read
+    async def load_async(key, tags, loader):
+        return await loader()
+    monkeypatch.setattr(tracksite.track_cache, 'get_or_load', lambda key, tags, loader: loader())
+    monkeypatch.setattr(tracksite.track_cache, 'get_or_load_async', load_async)
+
+
+def asgi_get(*requests):
+    # (path, headers) pairs -> (status, headers, body) each; served in one event loop,
+    # which the asyncpg pool belongs to
+    async def serve():
+        responses = []
+        try:
+            for path, headers in requests:
+                messages = []
+
+                async def receive():
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+                async def send(message):
+                    messages.append(message)
+
+                scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'http_version': '1.1',
+                         'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]}
+                await asgi.application(scope, receive, send)
+                start, body = messages
+                responses.append((start['status'], {name.decode('latin-1').lower(): value.decode('latin-1')
+                                                    for name, value in start['headers']}, body['body']))
+        finally:
+            if asgi.pool is not None:
+                await asgi.pool.close()
+                asgi.pool = None
+        return responses
+    return asyncio.run(serve())
+
+
+def create_shipment(client, email):
+    response = client.post('/api/shipments', json={
+        'shipper_name': 'Shipper', 'receiver_name': 'Receiver', 'shipper_email': email,
+        'shipper_phone': '0600000000', 'origin': 'Paris', 'destination': 'Lyon',
+    }, headers=ADMIN)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def assert_same(flask_response, asgi_response):
+    status, headers, body = asgi_response
+    assert status == flask_response.status_code
+    assert tracksite.app.json.loads(body) == flask_response.get_json()
+    for name in VALIDATORS:
+        assert headers.get(name.lower()) == flask_response.headers.get(name)
+
+
+def test_track_payload_matches_flask(client):
+    shipment = create_shipment(client, 'asgi-track@example.com')
+    client.post(f"/api/tracking-history/{shipment['id']}", json={
+        'location': 'Lyon', 'status': 'in_transit', 'description': 'Sorted', 'date_time': '2026-01-02T10:00',
+        'latitude': 45.76, 'longitude': 4.83,
+    })
+    client.put(f"/api/shipments/{shipment['id']}/progress", json={'progress': 40, 'current_lat': 46.1, 'current_lng': 4.5})
+    path = f"/api/track/{shipment['tracking_number']}"
+    headers = {'Origin': 'http://localhost:3000'}
+
+    flask_response = client.get(path, headers=headers)
+    assert flask_response.status_code == 200
+    payload = flask_response.get_json()
+    assert payload['current']['current_lat'] == 46.1
+    assert [event['latitude'] for event in payload['history'] if event['description'] == 'Sorted'] == [45.76]
+    served, revalidated = asgi_get((path, headers), (path, {'If-None-Match': flask_response.headers['ETag']}))
+    assert_same(flask_response, served)
+    assert revalidated[0] == 304
+    assert revalidated[2] == b''
+    assert revalidated[1]['etag'] == flask_response.headers['ETag']
+
+
+def test_archived_history_matches_flask(client):
+    shipment = create_shipment(client, 'asgi-archived@example.com')
+    client.post(f"/api/tracking-history/{shipment['id']}", json={
+        'location': 'Lyon', 'status': 'delivered', 'description': 'Delivered', 'date_time': '2020-01-02T10:00',
+    })
+    with tracksite.app.app_context():
+        db = tracksite.get_db()
+        execute(db, True, "UPDATE shipments SET status = 'delivered' WHERE id = ?", (shipment['id'],))
+        execute(db, True, 'UPDATE tracking_history SET date_time = ? WHERE shipment_id = ?', ('2020-01-02T10:00', shipment['id']))
+        db.commit()
+        assert history_archive.archive_closed_shipments(db, True, older_than_days=1)['events'] > 0
+    path = f"/api/track/{shipment['tracking_number']}"
+
+    flask_response = client.get(path)
+    assert any(event['description'] == 'Delivered' for event in flask_response.get_json()['history'])
+    assert_same(flask_response, asgi_get((path, {}))[0])
+
+
+def test_unknown_tracking_number_matches_flask(client):
+    path = '/api/track/NO-SUCH-NUMBER'
+    assert_same(client.get(path), asgi_get((path, {}))[0])
+
+
+def test_progress_matches_flask(client):
+    shipment = create_shipment(client, 'asgi-progress@example.com')
+    path = f"/api/shipments/{shipment['id']}/progress"
+    client.put(path, json={'progress': 65, 'current_lat': 45.2, 'current_lng': 5.1})
+    assert_same(client.get(path), asgi_get((path, {}))[0])
+
+
+def test_progress_without_reports_matches_flask(client):
+    shipment = create_shipment(client, 'asgi-no-progress@example.com')
+    path = f"/api/shipments/{shipment['id']}/progress"
+    flask_payload = client.get(path).get_json()
+    status, headers, body = asgi_get((path, {}))[0]
+    assert status == 200
+    payload = tracksite.app.json.loads(body)
+    # Both stamp the default with the time of the request
+    assert payload.pop('last_updated') and flask_payload.pop('last_updated')
+    assert payload == flask_payload
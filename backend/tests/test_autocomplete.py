@@ -0,0 +1,38 @@
+import time
+
+import pytest
+
+import autocomplete
+from conftest import ADMIN
+
+
+@pytest.fixture
+def indexer(client, monkeypatch):
+    # Only a notify_change() wake can make a write visible before the test times out
+    monkeypatch.setattr(autocomplete, 'REFRESH_SECONDS', 60)
+    autocomplete.stop()
+    assert client.get('/api/autocomplete?q=x').status_code == 200
+    yield
+    autocomplete.stop()
+
+
+def suggested(client, query, kind, expected, timeout=5):
+    # True once the suggestions for query are the expected texts
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if [s['text'] for s in client.get(f'/api/autocomplete?q={query}&kinds={kind}').get_json()['suggestions']] == expected:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_location_and_zone_writes_wake_the_index(client, indexer):
+    location = client.post('/api/locations', json={'name': 'Quimperle Depot', 'country': 'France'}, headers=ADMIN).get_json()
+    assert suggested(client, 'quimperle', 'location', ['Quimperle Depot'])
+    client.put(f"/api/locations/{location['id']}", json={'name': 'Quiberon Depot', 'slug': location['slug'], 'country': 'France'}, headers=ADMIN)
+    assert suggested(client, 'quiberon', 'location', ['Quiberon Depot'])
+
+    zone = client.post('/api/zones', json={'name': 'Xertigny Zone', 'locations': 'Quiberon'}, headers=ADMIN).get_json()
+    assert suggested(client, 'xertigny', 'zone', ['Xertigny Zone'])
+    client.delete(f"/api/zones/{zone['id']}", headers=ADMIN)
+    assert suggested(client, 'xertigny', 'zone', [])
@@ -0,0 +1,83 @@
+from datetime import datetime
+
+import app as tracksite
+import history_archive
+from common import execute
+
+
+def feed_cursor(client):
+    cursor = None
+    while True:
+        page = client.get('/api/changes', query_string={'since': cursor} if cursor else {}).get_json()
+        cursor = page['cursor']
+        if not page['has_more']:
+            return cursor
+
+
+def test_archiving_is_not_reported_as_deletion(client, shipment):
+    client.post(f"/api/tracking-history/{shipment['id']}", json={
+        'location': 'Lyon', 'status': 'delivered', 'description': 'Delivered', 'date_time': '2020-01-02T10:00',
+    })
+    with tracksite.app.app_context():
+        db = tracksite.get_db()
+        execute(db, tracksite.USE_POSTGRESQL, "UPDATE shipments SET status = 'delivered' WHERE id = ?", (shipment['id'],))
+        execute(db, tracksite.USE_POSTGRESQL, 'UPDATE tracking_history SET date_time = ? WHERE shipment_id = ?',
+                ('2020-01-02T10:00', shipment['id']))
+        db.commit()
+    cursor = feed_cursor(client)
+
+    with tracksite.app.app_context():
+        result = history_archive.archive_closed_shipments(tracksite.get_db(), tracksite.USE_POSTGRESQL, older_than_days=1)
+    assert result['events'] > 0
+
+    page = client.get('/api/changes', query_string={'since': cursor}).get_json()
+    assert page['deleted']['tracking_history'] == []
+    history = client.get(f"/api/track/{shipment['tracking_number']}").get_json()['history']
+    assert any(event['description'] == 'Delivered' for event in history)
+
+
+def test_deleted_event_leaves_tombstone(client, shipment):
+    client.post(f"/api/tracking-history/{shipment['id']}", json={
+        'location': 'Lyon', 'status': 'in_transit', 'description': 'Sorted', 'date_time': '2026-01-02T10:00',
+    })
+    with tracksite.app.app_context():
+        db = tracksite.get_db()
+        event_id = execute(db, tracksite.USE_POSTGRESQL, 'SELECT id FROM tracking_history WHERE shipment_id = ?',
+                           (shipment['id'],)).fetchone()['id']
+        db.commit()
+    cursor = feed_cursor(client)
+
+    with tracksite.app.app_context():
+        db = tracksite.get_db()
+        execute(db, tracksite.USE_POSTGRESQL, 'DELETE FROM tracking_history WHERE id = ?', (event_id,))
+        db.commit()
+
+    page = client.get('/api/changes', query_string={'since': cursor}).get_json()
+    assert page['deleted']['tracking_history'] == [event_id]
+
+
+def test_event_moved_to_another_month_is_not_deleted(client, shipment):
+    # On Postgres the event moves from this month's partition to the default one
+    client.post(f"/api/tracking-history/{shipment['id']}", json={
+        'location': 'Lyon', 'status': 'in_transit', 'description': 'Moved', 'date_time': datetime.now().strftime('%Y-%m-02T10:00'),
+    })
+    with tracksite.app.app_context():
+        db = tracksite.get_db()
+        event_id = execute(db, tracksite.USE_POSTGRESQL, "SELECT id FROM tracking_history WHERE description = 'Moved'").fetchone()['id']
+        db.commit()
+    cursor = feed_cursor(client)
+
+    client.put(f'/api/tracking-history/{event_id}', json={
+        'location': 'Lyon', 'status': 'in_transit', 'description': 'Moved', 'date_time': '2025-06-02T10:00',
+    })
+    page = client.get('/api/changes', query_string={'since': cursor, 'tables': 'tracking_history'}).get_json()
+    assert page['deleted']['tracking_history'] == []
+    assert [event['id'] for event in page['changes']['tracking_history']] == [event_id]
+
+
+def test_feed_omits_user_passwords(client):
+    cursor = feed_cursor(client)
+    client.post('/api/users', json={'name': 'Feed', 'email': 'feed@example.com', 'password': 'secret'})
+    users = client.get('/api/changes', query_string={'since': cursor, 'tables': 'users'}).get_json()['changes']['users']
+    assert [user['email'] for user in users] == ['feed@example.com']
+    assert 'password' not in users[0]
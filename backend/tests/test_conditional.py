@@ -0,0 +1,68 @@
+from conftest import ADMIN
+
+
+def create_shipment(client, email):
+    response = client.post('/api/shipments', json={
+        'shipper_name': 'Shipper', 'receiver_name': 'Receiver', 'shipper_email': email,
+        'shipper_phone': '0600000000', 'origin': 'Paris', 'destination': 'Lyon',
+    }, headers=ADMIN)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def test_reference_listing_revalidates_with_its_etag(client):
+    first = client.get('/api/locations')
+    assert first.status_code == 200
+    tag = first.headers['ETag']
+    assert first.headers['Last-Modified']
+    assert first.headers['Cache-Control'] == 'public, max-age=60, stale-while-revalidate=3600'
+    assert 'Origin' in first.headers['Vary']
+
+    cached = client.get('/api/locations', headers={'If-None-Match': tag})
+    assert cached.status_code == 304
+    assert cached.data == b''
+    assert cached.headers['ETag'] == tag
+
+
+def test_reference_write_changes_the_etag(client):
+    tag = client.get('/api/locations').headers['ETag']
+    created = client.post('/api/locations', json={'name': 'Conditional Town', 'country': 'France'})
+    assert created.status_code == 200
+
+    response = client.get('/api/locations', headers={'If-None-Match': tag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != tag
+    assert 'Conditional Town' in [location['name'] for location in response.get_json()]
+
+
+def test_if_modified_since_and_etag_precedence(client):
+    first = client.get('/api/zones')
+    modified = first.headers['Last-Modified']
+    assert client.get('/api/zones', headers={'If-Modified-Since': modified}).status_code == 304
+    # A stale tag wins over a current date
+    response = client.get('/api/zones', headers={'If-None-Match': '"zones-0-0"', 'If-Modified-Since': modified})
+    assert response.status_code == 200
+
+
+def test_tracking_payload_revalidates_until_the_shipment_changes(client):
+    shipment = create_shipment(client, 'conditional-track@example.com')
+    path = f"/api/track/{shipment['tracking_number']}"
+    first = client.get(path)
+    assert first.status_code == 200
+    tag = first.headers['ETag']
+    assert first.headers['Cache-Control'] == 'public, max-age=15, stale-while-revalidate=60'
+    assert client.get(path, headers={'If-None-Match': tag}).status_code == 304
+
+    client.post(f"/api/tracking-history/{shipment['id']}", json={
+        'location': 'Lyon', 'status': 'in_transit', 'description': 'Revalidated', 'date_time': '2026-01-02T10:00',
+    })
+    response = client.get(path, headers={'If-None-Match': tag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != tag
+    assert any(event['description'] == 'Revalidated' for event in response.get_json()['history'])
+
+
+def test_unknown_tracking_number_is_not_cached(client):
+    response = client.get('/api/track/NO-SUCH-NUMBER', headers={'If-None-Match': '*'})
+    assert response.status_code == 404
+    assert 'ETag' not in response.headers
@@ -0,0 +1,16 @@
+import app as tracksite
+import eta
+
+
+def test_requests_use_lane_snapshot(client, monkeypatch):
+    monkeypatch.setattr(eta, 'lanes', {})
+    calls = []
+    monkeypatch.setattr(eta, 'load_lanes', lambda db, postgres: calls.append(1) or {eta.lane_key('Paris', 'Lyon'): (10.0, 5)})
+    assert client.get('/api/eta?origin=Paris&destination=Lyon').get_json()['basis'] == 'distance'
+    assert calls == []
+
+    with tracksite.app.app_context():
+        eta.refresh_lanes(tracksite.get_db(), False)
+    body = client.get('/api/eta?origin=Paris&destination=Lyon').get_json()
+    assert (body['basis'], body['samples'], body['hours']) == ('history', 5, 10.0)
+    assert calls == [1]
@@ -0,0 +1,98 @@
+import threading
+
+import app as tracksite
+import idempotency
+import repositories
+from common import execute
+from conftest import ADMIN
+
+
+def shipment_body(email):
+    return {
+        'shipper_name': 'Shipper', 'receiver_name': 'Receiver', 'shipper_email': email,
+        'shipper_phone': '0600000000', 'origin': 'Paris', 'destination': 'Lyon',
+    }
+
+
+def post(client, key, body):
+    return client.post('/api/shipments', json=body, headers=dict(ADMIN, **{'Idempotency-Key': key}))
+
+
+def shipments_of(email):
+    with tracksite.app.app_context():
+        db = tracksite.get_db()
+        rows = execute(db, tracksite.USE_POSTGRESQL, 'SELECT id FROM shipments WHERE shipper_email = ?', (email,)).fetchall()
+        db.commit()
+    return [row['id'] for row in rows]
+
+
+def test_retry_replays_the_stored_response(client):
+    first = post(client, 'replay-1', shipment_body('replay@example.com'))
+    second = post(client, 'replay-1', shipment_body('replay@example.com'))
+    assert first.status_code == second.status_code == 200
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert second.get_json() == first.get_json()
+    assert shipments_of('replay@example.com') == [first.get_json()['id']]
+
+
+def test_key_reused_for_another_body_is_rejected(client):
+    assert post(client, 'mismatch-1', shipment_body('mismatch@example.com')).status_code == 200
+    response = post(client, 'mismatch-1', shipment_body('other@example.com'))
+    assert response.status_code == 422
+    assert shipments_of('other@example.com') == []
+
+
+def test_concurrent_duplicates_run_once():
+    responses = []
+
+    def send():
+        responses.append(post(tracksite.app.test_client(), 'concurrent-1', shipment_body('concurrent@example.com')))
+
+    threads = [threading.Thread(target=send) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [response.status_code for response in responses] == [200] * 6
+    assert len({response.get_json()['id'] for response in responses}) == 1
+    assert len(shipments_of('concurrent@example.com')) == 1
+
+
+def test_failed_request_releases_the_key(client, monkeypatch):
+    def broken(*args):
+        raise RuntimeError('event insert failed')
+    monkeypatch.setattr(repositories, 'add_event', broken)
+    assert post(client, 'failed-1', shipment_body('failed@example.com')).status_code == 500
+    monkeypatch.undo()
+    assert shipments_of('failed@example.com') == []
+    response = post(client, 'failed-1', shipment_body('failed@example.com'))
+    assert response.status_code == 200
+    assert 'Idempotent-Replayed' not in response.headers
+    assert shipments_of('failed@example.com') == [response.get_json()['id']]
+
+
+def test_writes_are_committed_with_the_stored_response(client, monkeypatch):
+    # A worker dying after the handler returned but before the response was stored
+    # must leave nothing a retry would duplicate
+    monkeypatch.setattr(idempotency, 'finish', lambda get_db, postgres, response: response)
+    assert post(client, 'crash-1', shipment_body('crash@example.com')).status_code == 200
+    monkeypatch.undo()
+    idempotency.in_flight.clear()
+    assert shipments_of('crash@example.com') == []
+
+    monkeypatch.setattr(idempotency, 'CLAIM_TIMEOUT_SECONDS', -1)
+    response = post(client, 'crash-1', shipment_body('crash@example.com'))
+    assert response.status_code == 200
+    assert shipments_of('crash@example.com') == [response.get_json()['id']]
+
+
+def test_expired_keys_are_deleted_in_batches():
+    with tracksite.app.app_context():
+        db = tracksite.get_db()
+        for number in range(5):
+            execute(db, tracksite.USE_POSTGRESQL, '''INSERT INTO idempotency_keys (key, fingerprint, created_at, expires_at)
+                VALUES (?, 'x', '2000-01-01 00:00:00', '2000-01-02 00:00:00')''', (f'expired-{number}',))
+        db.commit()
+        assert idempotency.expire(db, tracksite.USE_POSTGRESQL, batch_size=2) == {'deleted': 5}
+        assert execute(db, tracksite.USE_POSTGRESQL, "SELECT COUNT(*) AS n FROM idempotency_keys WHERE key LIKE 'expired-%'").fetchone()['n'] == 0
+        db.commit()
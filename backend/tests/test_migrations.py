@@ -0,0 +1,75 @@
+import sqlite3
+
+import pytest
+
+import app as tracksite
+import change_feed
+import gps
+from common import add_column, create_trigger
+
+pytestmark = pytest.mark.sqlite
+
+
+@pytest.fixture
+def fresh_database(tmp_path, monkeypatch):
+    path = str(tmp_path / 'migrations.db')
+    monkeypatch.setattr(tracksite, 'DATABASE', path)
+    return path
+
+
+def schema_version(path):
+    with sqlite3.connect(path) as db:
+        return db.execute('SELECT version FROM schema_version').fetchone()[0]
+
+
+def tables(path):
+    with sqlite3.connect(path) as db:
+        return {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def test_failed_step_keeps_previous_version_and_recovers(fresh_database, monkeypatch):
+    def broken(db, postgres):
+        raise RuntimeError('gps step failed')
+    monkeypatch.setattr(gps, 'create_table', broken)
+    with pytest.raises(RuntimeError):
+        tracksite.init_db()
+    assert schema_version(fresh_database) == tracksite.SCHEMA_MIGRATIONS.index(tracksite.create_gps_blocks)
+    assert 'gps_blocks' not in tables(fresh_database)
+
+    monkeypatch.undo()
+    monkeypatch.setattr(tracksite, 'DATABASE', fresh_database)
+    assert tracksite.init_db() is True
+    assert schema_version(fresh_database) == tracksite.SCHEMA_VERSION
+    assert 'gps_blocks' in tables(fresh_database)
+    with sqlite3.connect(fresh_database) as db:
+        assert db.execute('SELECT COUNT(*) FROM locations').fetchone()[0] > 0
+    assert tracksite.init_db() is False
+
+
+def test_step_failing_after_its_ddl_rolls_back(fresh_database, monkeypatch):
+    install = change_feed.install
+
+    def interrupted(db, postgres):
+        install(db, postgres)
+        raise RuntimeError('change feed step failed')
+    monkeypatch.setattr(change_feed, 'install', interrupted)
+    with pytest.raises(RuntimeError):
+        tracksite.init_db()
+    with sqlite3.connect(fresh_database) as db:
+        columns = {row[1] for row in db.execute('PRAGMA table_info(shipments)')}
+    assert 'version' not in columns
+
+    monkeypatch.setattr(change_feed, 'install', install)
+    assert tracksite.init_db() is True
+    assert schema_version(fresh_database) == tracksite.SCHEMA_VERSION
+
+
+def test_schema_steps_can_repeat(tmp_path):
+    db = sqlite3.connect(str(tmp_path / 'steps.db'))
+    db.row_factory = sqlite3.Row
+    db.execute('CREATE TABLE items (id INTEGER PRIMARY KEY)')
+    for _ in range(2):
+        add_column(db, False, 'items', 'label', 'TEXT')
+        create_trigger(db, False, 'trg_items_label', 'items', "AFTER INSERT ON items BEGIN UPDATE items SET label = 'new' WHERE id = NEW.id; END")
+    db.execute('INSERT INTO items (id) VALUES (1)')
+    assert db.execute('SELECT label FROM items').fetchone()['label'] == 'new'
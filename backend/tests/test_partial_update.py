@@ -0,0 +1,32 @@
+import pytest
+
+import partial_update
+
+
+@pytest.mark.parametrize('version', [[1], {}, 1.5, True])
+def test_patch_rejects_non_scalar_version(client, shipment, version):
+    response = client.patch(f"/api/shipments/{shipment['id']}", json={'comments': 'x', 'version': version})
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'Invalid version'}
+
+
+def test_patch_with_version(client, shipment):
+    etag = client.patch(f"/api/shipments/{shipment['id']}", json={'comments': 'first'}).headers['ETag']
+    version = etag.strip('"')
+    assert client.patch(f"/api/shipments/{shipment['id']}", json={'comments': 'second', 'version': version}).status_code == 200
+    assert client.patch(f"/api/shipments/{shipment['id']}", json={'comments': 'third', 'version': int(version)}).status_code == 409
+
+
+def test_update_statement_cache_is_bounded():
+    columns = partial_update.PATCHABLE_COLUMNS['shipments']
+    for size in range(1, len(columns) + 1):
+        for start in range(len(columns)):
+            partial_update.update_statement('shipments', (columns * 2)[start:start + size], True, False)
+    assert len(partial_update.statement_cache.entries) <= partial_update.STATEMENT_CACHE_SIZE
+
+
+def test_patch_rejects_unknown_status(client, shipment):
+    response = client.patch(f"/api/shipments/{shipment['id']}", json={'status': 'lost'})
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith("Invalid status 'lost', expected one of: pending_confirmation")
+    assert client.patch(f"/api/shipments/{shipment['id']}", json={'status': 'in_transit'}).status_code == 200
@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+import app as tracksite
+import sqlite_writer
+
+pytestmark = pytest.mark.sqlite
+
+
+@pytest.fixture
+def writer(tmp_path):
+    path = str(tmp_path / 'writer.db')
+    db = sqlite_writer.connect(path)
+    db.execute('CREATE TABLE counters (id INTEGER PRIMARY KEY, value INTEGER NOT NULL)')
+    db.execute('INSERT INTO counters (id, value) VALUES (1, 0)')
+    db.commit()
+    db.close()
+    writer = sqlite_writer.Writer(path)
+    writer.start()
+    yield writer
+    writer.stopping.set()
+    with writer.condition:
+        writer.condition.notify_all()
+    writer.join(timeout=5)
+    writer.db.close()
+
+
+def session(writer, serialized=False):
+    return sqlite_writer.WriteSession(writer, sqlite_writer.connect(writer.path, check_same_thread=False), serialized)
+
+
+def counter(writer):
+    return sqlite_writer.connect(writer.path).execute('SELECT value FROM counters WHERE id = 1').fetchone()['value']
+
+
+def increment(db):
+    value = db.execute('SELECT value FROM counters WHERE id = 1').fetchone()['value']
+    time.sleep(0.05)
+    db.execute('UPDATE counters SET value = ? WHERE id = 1', (value + 1,))
+    db.commit()
+
+
+def test_serialized_sessions_do_not_lose_updates(writer):
+    threads = [threading.Thread(target=increment, args=(session(writer, serialized=True),)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter(writer) == 4
+
+
+def test_reads_run_on_the_writer_once_it_is_held(writer):
+    db = session(writer)
+    db.execute('SELECT value FROM counters').fetchall()
+    assert not db.writing
+    db.execute('UPDATE counters SET value = 5 WHERE id = 1')
+    assert db.writing
+    # The reader has not seen the uncommitted write, the writer connection has
+    assert db.execute('SELECT value FROM counters WHERE id = 1').fetchone()['value'] == 5
+    db.commit()
+    assert counter(writer) == 5
+
+
+def test_commit_without_group_commit(writer, monkeypatch):
+    monkeypatch.setattr(sqlite_writer, 'GROUP_COMMIT', False)
+    db = session(writer)
+    db.execute('UPDATE counters SET value = 7 WHERE id = 1')
+    db.commit()
+    assert counter(writer) == 7
+    assert not writer.db.in_transaction
+    assert writer.lock.acquire(blocking=False)
+    writer.lock.release()
+
+
+def test_vacuum_runs_outside_the_transaction(writer):
+    db = session(writer)
+    db.execute('UPDATE counters SET value = 1 WHERE id = 1')
+    db.commit()
+    db.execute('VACUUM')
+    assert counter(writer) == 1
+
+
+@pytest.mark.parametrize('sql, reads', [
+    ('SELECT 1', True),
+    ('PRAGMA table_info(shipments)', True),
+    ('PRAGMA page_count', True),
+    ('PRAGMA analysis_limit = 1000', False),
+    ('PRAGMA optimize', False),
+    ('ANALYZE', False),
+])
+def test_read_statements(sql, reads):
+    assert bool(sqlite_writer.READ_STATEMENT.match(sql)) is reads
+
+
+def test_app_context_writes_wait_for_the_writer(client, shipment):
+    held = sqlite_writer.session(tracksite.DATABASE, serialized=True)
+    held.execute('SELECT 1')
+    done = threading.Event()
+
+    def background_write():
+        with tracksite.app.app_context():
+            db = tracksite.get_db()
+            assert isinstance(db, sqlite_writer.WriteSession)
+            db.execute("UPDATE shipments SET comments = 'background' WHERE id = ?", (shipment['id'],))
+            db.commit()
+        done.set()
+
+    thread = threading.Thread(target=background_write)
+    thread.start()
+    assert not done.wait(0.2)
+    held.commit()
+    assert done.wait(5)
+    thread.join()
@@ -0,0 +1,3 @@
+#!/bin/sh
+# Lets the db-replica service of docker-compose.yml stream WAL from this server
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
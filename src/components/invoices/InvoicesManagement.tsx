@@ -1,48 +1,34 @@
 import React, { useEffect, useState } from 'react';
-import { FileTextIcon, DownloadIcon, EyeIcon, PlusIcon, SearchIcon, CalendarIcon, DollarSignIcon } from 'lucide-react';
-import { shipmentsApi, Shipment } from '../../utils/api';
+import { FileTextIcon, DownloadIcon, EyeIcon, SearchIcon, CalendarIcon, DollarSignIcon } from 'lucide-react';
+import { invoicesApi, Invoice, InvoiceSummary } from '../../utils/api';
 
-interface Invoice {
-  id: number;
-  shipment_id: number;
-  invoice_number: string;
-  amount: number;
-  status: 'pending' | 'paid' | 'overdue';
-  issue_date: string;
-  due_date: string;
-  shipment?: Shipment;
-}
+const PAGE_SIZE = 50;
 
 export const InvoicesManagement: React.FC = () => {
   const [invoices, setInvoices] = useState<Invoice[]>([]);
-  const [shipments, setShipments] = useState<Shipment[]>([]);
+  const [summary, setSummary] = useState<InvoiceSummary | null>(null);
+  const [next, setNext] = useState<number | null>(null);
   const [searchTerm, setSearchTerm] = useState('');
   const [statusFilter, setStatusFilter] = useState<string>('all');
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   useEffect(() => {
-    loadData();
+    invoicesApi.summary().then(setSummary).catch(error => console.error('Failed to load summary:', error));
   }, []);
 
-  const loadData = async () => {
+  // Filtering and search run on the server; typing is debounced
+  useEffect(() => {
+    const timer = setTimeout(() => loadFirstPage(), searchTerm ? 300 : 0);
+    return () => clearTimeout(timer);
+  }, [searchTerm, statusFilter]);
+
+  const loadFirstPage = async () => {
     try {
       setLoading(true);
-      const shipmentsData = await shipmentsApi.getAll();
-      setShipments(shipmentsData);
-
-      // Generate invoices from shipments
-      const invoicesData = shipmentsData.map(shipment => ({
-        id: shipment.id,
-        shipment_id: shipment.id,
-        invoice_number: `INV-${shipment.id.toString().padStart(6, '0')}`,
-        amount: shipment.total_freight || 0,
-        status: getInvoiceStatus(shipment),
-        issue_date: shipment.date_created,
-        due_date: calculateDueDate(shipment.date_created),
-        shipment: shipment
-      }));
-
-      setInvoices(invoicesData);
+      const page = await invoicesApi.getPage({ status: statusFilter, q: searchTerm.trim(), limit: PAGE_SIZE });
+      setInvoices(page.invoices);
+      setNext(page.next);
     } catch (error) {
       console.error('Failed to load data:', error);
     } finally {
@@ -50,25 +36,20 @@ export const InvoicesManagement: React.FC = () => {
     }
   };
 
-  const getInvoiceStatus = (shipment: Shipment): 'pending' | 'paid' | 'overdue' => {
-    if (shipment.status === 'delivered') return 'paid';
-    if (shipment.status === 'delayed') return 'overdue';
-    return 'pending';
-  };
-
-  const calculateDueDate = (issueDate: string): string => {
-    const date = new Date(issueDate);
-    date.setDate(date.getDate() + 30); // 30 days payment terms
-    return date.toISOString().split('T')[0];
+  const loadMore = async () => {
+    if (next === null) return;
+    try {
+      setLoadingMore(true);
+      const page = await invoicesApi.getPage({ status: statusFilter, q: searchTerm.trim(), before: next, limit: PAGE_SIZE });
+      setInvoices(current => [...current, ...page.invoices]);
+      setNext(page.next);
+    } catch (error) {
+      console.error('Failed to load invoices:', error);
+    } finally {
+      setLoadingMore(false);
+    }
   };
 
-  const filteredInvoices = invoices.filter(invoice => {
-    const matchesSearch = invoice.invoice_number.toLowerCase().includes(searchTerm.toLowerCase()) ||
-                         (invoice.shipment?.tracking_number || '').toLowerCase().includes(searchTerm.toLowerCase());
-    const matchesStatus = statusFilter === 'all' || invoice.status === statusFilter;
-    return matchesSearch && matchesStatus;
-  });
-
   const getStatusBadgeClass = (status: string) => {
     switch (status) {
       case 'paid': return 'bg-green-100 text-green-800';
@@ -90,7 +71,7 @@ export const InvoicesManagement: React.FC = () => {
   const exportInvoicesCsv = () => {
     const csvContent = [
       ['Numéro Facture', 'Numéro Suivi', 'Montant', 'Statut', 'Date Émission', 'Date Échéance', 'Expéditeur', 'Destinataire'],
-      ...filteredInvoices.map(invoice => [
+      ...invoices.map(invoice => [
         invoice.invoice_number,
         invoice.shipment?.tracking_number || '',
         `€${invoice.amount.toFixed(2)}`,
@@ -145,7 +126,7 @@ STATUT: ${formatStatus(invoice.status)}
     window.URL.revokeObjectURL(url);
   };
 
-  if (loading) {
+  if (loading && invoices.length === 0 && summary === null) {
     return (
       <div className="flex justify-center items-center h-64">
         <div className="animate-spin rounded-full h-12 w-12 border-b-2 border-blue-600"></div>
@@ -179,7 +160,7 @@ STATUT: ${formatStatus(invoice.status)}
             <FileTextIcon className="h-8 w-8 text-blue-600" />
             <div className="ml-4">
               <p className="text-sm font-medium text-gray-600">Total Factures</p>
-              <p className="text-2xl font-bold text-gray-900">{invoices.length}</p>
+              <p className="text-2xl font-bold text-gray-900">{summary?.count ?? '-'}</p>
             </div>
           </div>
         </div>
@@ -190,7 +171,7 @@ STATUT: ${formatStatus(invoice.status)}
             <div className="ml-4">
               <p className="text-sm font-medium text-gray-600">Montant Total</p>
               <p className="text-2xl font-bold text-gray-900">
-                €{invoices.reduce((sum, inv) => sum + inv.amount, 0).toFixed(2)}
+                €{(summary?.amount ?? 0).toFixed(2)}
               </p>
             </div>
           </div>
@@ -202,7 +183,7 @@ STATUT: ${formatStatus(invoice.status)}
             <div className="ml-4">
               <p className="text-sm font-medium text-gray-600">En Attente</p>
               <p className="text-2xl font-bold text-gray-900">
-                {invoices.filter(inv => inv.status === 'pending').length}
+                {summary?.pending ?? '-'}
               </p>
             </div>
           </div>
@@ -214,7 +195,7 @@ STATUT: ${formatStatus(invoice.status)}
             <div className="ml-4">
               <p className="text-sm font-medium text-gray-600">Payées</p>
               <p className="text-2xl font-bold text-gray-900">
-                {invoices.filter(inv => inv.status === 'paid').length}
+                {summary?.paid ?? '-'}
               </p>
             </div>
           </div>
@@ -227,7 +208,7 @@ STATUT: ${formatStatus(invoice.status)}
           <div className="relative flex-grow max-w-md">
             <input
               type="text"
-              placeholder="Rechercher par numéro de facture ou suivi..."
+              placeholder="Numéro de facture ou de suivi (début)..."
               className="w-full pl-10 pr-4 py-2 border rounded-lg"
               value={searchTerm}
               onChange={(e) => setSearchTerm(e.target.value)}
@@ -267,7 +248,7 @@ STATUT: ${formatStatus(invoice.status)}
               </tr>
             </thead>
             <tbody>
-              {filteredInvoices.map((invoice) => (
+              {invoices.map((invoice) => (
                 <tr key={invoice.id} className="hover:bg-gray-50">
                   <td className="px-6 py-4 border-b font-medium">
                     {invoice.invoice_number}
@@ -315,7 +296,7 @@ STATUT: ${formatStatus(invoice.status)}
                   </td>
                 </tr>
               ))}
-              {filteredInvoices.length === 0 && (
+              {invoices.length === 0 && (
                 <tr>
                   <td colSpan={8} className="px-6 py-4 text-center text-gray-500">
                     Aucune facture trouvée
@@ -325,6 +306,17 @@ STATUT: ${formatStatus(invoice.status)}
             </tbody>
           </table>
         </div>
+        {next !== null && (
+          <div className="p-4 text-center border-t">
+            <button
+              onClick={loadMore}
+              disabled={loadingMore}
+              className="px-4 py-2 text-blue-600 border border-blue-600 rounded-lg hover:bg-blue-50 disabled:opacity-50"
+            >
+              {loadingMore ? 'Chargement...' : 'Afficher plus de factures'}
+            </button>
+          </div>
+        )}
       </div>
     </div>
   );
@@ -1,4 +1,5 @@
-import React, { useEffect, useRef } from 'react';
+import React, { useEffect, useId, useRef, useState } from 'react';
+import { autocompleteApi } from '../../utils/api';
 
 interface Props {
     value: string;
@@ -38,12 +39,16 @@ function loadGoogleMaps(apiKey: string): Promise<void> {
 
 export const AddressAutocomplete: React.FC<Props> = ({ value, onChange, placeholder }) => {
     const inputRef = useRef<HTMLInputElement | null>(null);
+    const listId = useId();
+    const [usesGoogle, setUsesGoogle] = useState(false);
+    const [suggestions, setSuggestions] = useState<string[]>([]);
     useEffect(() => {
         const raw = localStorage.getItem('cs_admin_map_settings');
         const cfg = raw ? JSON.parse(raw) : {};
         const apiKey: string = cfg.apiKey || '';
         const countriesCsv: string = cfg.countryRestrictions || '';
-        if (!apiKey) return; // fall back to normal input
+        if (!apiKey) return; // fall back to the backend's suggestions
+        setUsesGoogle(true);
         let autocomplete: any;
         loadGoogleMaps(apiKey).then(() => {
             if (!inputRef.current || !window.google) return;
@@ -67,7 +72,32 @@ export const AddressAutocomplete: React.FC<Props> = ({ value, onChange, placehol
             autocomplete = null;
         };
     }, []);
-    return <input ref={inputRef} type="text" className="w-full p-2 border rounded-lg" placeholder={placeholder} value={value} onChange={e => onChange(e.target.value)} />;
+    useEffect(() => {
+        // Without Google Places, suggest known locations and past addresses
+        if (usesGoogle || value.trim().length < 2) {
+            setSuggestions([]);
+            return;
+        }
+        let cancelled = false;
+        autocompleteApi.suggest(value.trim()).then(result => {
+            if (!cancelled) setSuggestions(result.suggestions.map(suggestion => suggestion.text));
+        }).catch(() => {
+            // suggestions are optional; the plain input keeps working
+        });
+        return () => {
+            cancelled = true;
+        };
+    }, [value, usesGoogle]);
+    return (
+        <>
+            <input ref={inputRef} type="text" className="w-full p-2 border rounded-lg" placeholder={placeholder} value={value} onChange={e => onChange(e.target.value)} list={usesGoogle ? undefined : listId} />
+            {!usesGoogle && (
+                <datalist id={listId}>
+                    {suggestions.map(text => <option key={text} value={text} />)}
+                </datalist>
+            )}
+        </>
+    );
 };
 
 
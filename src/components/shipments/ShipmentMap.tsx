@@ -1,7 +1,7 @@
 import React, { useEffect, useRef, useState, useMemo } from 'react';
 import { Shipment } from '../../utils/api';
 import { parseCoordinates, calculateDistance, calculateDeliveryTime, getTransportMethod } from '../../utils/coordinates';
-import { MapContainer, TileLayer, Marker, Polyline, Popup } from 'react-leaflet';
+import { MapContainer, TileLayer, Marker, Polyline, Popup, useMapEvents } from 'react-leaflet';
 import L from 'leaflet';
 import 'leaflet-defaulticon-compatibility';
 
@@ -10,7 +10,7 @@ import 'leaflet-defaulticon-compatibility';
 
 import { usePersistedState } from '../../hooks/usePersistedState';
 import { useShipmentWebSocket } from '../../hooks/useShipmentWebSocket';
-import { shipmentProgressApi } from '../../utils/api';
+import { shipmentProgressApi, gpsApi } from '../../utils/api';
 
 import { LatLngExpression } from 'leaflet';
 
@@ -54,6 +54,14 @@ const getTransportInfo = (speed: number, distance: number, travelTimeHours: numb
   return getTransportMethod(speed, distance, travelTimeHours);
 };
 
+// Signale le niveau de zoom pour recharger la route simplifiée à la bonne résolution
+const ZoomWatcher: React.FC<{ onZoom: (zoom: number) => void }> = ({ onZoom }) => {
+  useMapEvents({
+    zoomend: (event) => onZoom(event.target.getZoom()),
+  });
+  return null;
+};
+
 export const ShipmentMap: React.FC<ShipmentMapProps> = ({ shipment, className = '' }) => {
   const { id } = shipment;  // Utilise l'ID du shipment pour la clé localStorage
   const mapRef = useRef<L.Map>(null);
@@ -122,6 +130,22 @@ export const ShipmentMap: React.FC<ShipmentMapProps> = ({ shipment, className =
   // WebSocket pour updates live
   const { lastUpdate, readyState, sendHeartbeat } = useShipmentWebSocket(id);
 
+  // Route réelle issue des pings GPS, simplifiée pour le zoom courant
+  const [zoom, setZoom] = useState(4);
+  const [gpsPath, setGpsPath] = useState<[number, number][]>([]);
+
+  useEffect(() => {
+    let cancelled = false;
+    gpsApi.route(id, zoom)
+      .then(route => {
+        if (!cancelled) setGpsPath(route.path);
+      })
+      .catch(error => console.warn('Failed to load GPS route', error));
+    return () => {
+      cancelled = true;
+    };
+  }, [id, zoom, lastUpdate]);
+
   useEffect(() => {
     // Parse coordinates from shipment
     const origin = parseCoordinates(shipment.origin);
@@ -287,6 +311,8 @@ export const ShipmentMap: React.FC<ShipmentMapProps> = ({ shipment, className =
 
   // Polyline positions (route complète)
   const polylinePositions: LatLngExpression[] = useMemo(() => {
+    // Les pings GPS enregistrés donnent la route réelle
+    if (gpsPath.length > 1) return gpsPath;
     if (!originCoords || !destCoords) return [];
     const steps = 100;  // Résolution de la ligne
     return Array.from({ length: steps }, (_, i) => {
@@ -296,7 +322,7 @@ export const ShipmentMap: React.FC<ShipmentMapProps> = ({ shipment, className =
         originCoords.lng + (destCoords.lng - originCoords.lng) * t,
       ] as LatLngExpression;
     });
-  }, [originCoords, destCoords]);
+  }, [originCoords, destCoords, gpsPath]);
 
   if (!originCoords || !destCoords) {
     return (
@@ -326,6 +352,8 @@ export const ShipmentMap: React.FC<ShipmentMapProps> = ({ shipment, className =
           dragging={true}
           touchZoom={true}
         >
+          <ZoomWatcher onZoom={setZoom} />
+
           <TileLayer
             url="https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png"
             attribution='&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
@@ -337,7 +365,7 @@ export const ShipmentMap: React.FC<ShipmentMapProps> = ({ shipment, className =
             color="#3B82F6"
             weight={4}
             opacity={0.7}
-            dashArray="10, 10"
+            dashArray={gpsPath.length > 1 ? undefined : '10, 10'}
           />
 
           {/* Marqueur Départ */}
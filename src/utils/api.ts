@@ -7,6 +7,8 @@ export interface Location {
   name: string;
   slug: string;
   country: string;
+  latitude?: number | null;
+  longitude?: number | null;
 }
 
 export interface Zone {
@@ -63,6 +65,11 @@ export interface Shipment {
   pickup_time?: string;
   comments?: string;
   date_created: string;
+  // From shipment_current_state, in listings
+  current_location?: string | null;
+  last_event_at?: string | null;
+  event_count?: number;
+  progress?: number | null;
 }
 
 export interface TrackingHistory {
@@ -76,8 +83,25 @@ export interface TrackingHistory {
   longitude?: number;
 }
 
+export interface ShipmentCurrentState {
+  shipment_id: number;
+  status: string | null;
+  location: string | null;
+  description: string | null;
+  latitude: number | null;
+  longitude: number | null;
+  last_event_id: number | null;
+  last_event_at: string | null;
+  event_count: number;
+  progress: number | null;
+  current_lat: number | null;
+  current_lng: number | null;
+  progress_updated: string | null;
+}
+
 export interface TrackingResult {
   shipment: Shipment;
+  current: ShipmentCurrentState | null;
   history: TrackingHistory[];
 }
 
@@ -101,20 +125,36 @@ export interface AuthResponse {
   status: string;
 }
 
+// Time of our last write, echoed back so the backend reads it from the primary
+// database rather than a replica that may not have it yet. Once we have written,
+// cached GET responses are revalidated instead of reused until they expire.
+let recentWrite: string | null = null;
+
+function recentWriteHeaders(): Record<string, string> {
+  return recentWrite ? { 'X-Recent-Write': recentWrite } : {};
+}
+
+function rememberWrite(response: Response) {
+  recentWrite = response.headers.get('X-Recent-Write') ?? recentWrite;
+}
+
 // Generic API functions with better error handling
 async function apiRequest<T>(endpoint: string, options?: RequestInit): Promise<T> {
   const url = `${API_BASE_URL}${endpoint}`;
   
   const config: RequestInit = {
+    cache: recentWrite ? 'no-cache' : 'default',
+    ...options,
     headers: {
       'Content-Type': 'application/json',
+      ...recentWriteHeaders(),
       ...options?.headers,
     },
-    ...options,
   };
 
   try {
     const response = await fetch(url, config);
+    rememberWrite(response);
 
     if (!response.ok) {
       const errorText = await response.text();
@@ -248,6 +288,46 @@ export const usersApi = {
   }),
 };
 
+// Invoices API: issued when a shipment is confirmed, newest first. A page's `next`
+// is passed back as `before` for the following one (null on the last page).
+export interface Invoice {
+  id: number;
+  shipment_id: number;
+  invoice_number: string;
+  amount: number;
+  status: 'pending' | 'paid' | 'overdue';
+  issue_date: string;
+  due_date: string;
+  shipment: Pick<Shipment, 'tracking_number' | 'shipper_name' | 'shipper_email' | 'shipper_address' | 'origin'
+    | 'receiver_name' | 'receiver_address' | 'destination' | 'product' | 'total_weight' | 'quantity'>;
+}
+
+export interface InvoicePage {
+  invoices: Invoice[];
+  next: number | null;
+}
+
+export interface InvoiceSummary {
+  count: number;
+  amount: number;
+  pending: number;
+  paid: number;
+  overdue: number;
+}
+
+export const invoicesApi = {
+  getPage: (params: { status?: string; q?: string; before?: number | null; limit?: number } = {}) => {
+    const query = new URLSearchParams();
+    if (params.status && params.status !== 'all') query.set('status', params.status);
+    if (params.q) query.set('q', params.q);
+    if (params.before) query.set('before', String(params.before));
+    if (params.limit) query.set('limit', String(params.limit));
+    const search = query.toString();
+    return apiRequest<InvoicePage>(`/api/invoices${search ? `?${search}` : ''}`);
+  },
+  summary: () => apiRequest<InvoiceSummary>('/api/invoices/summary'),
+};
+
 // Auth API
 export const authApi = {
   login: (email: string, password: string) => apiRequest<AuthResponse>('/api/auth/login', {
@@ -260,13 +340,27 @@ export const authApi = {
   }),
 };
 
+// Autocomplete API: locations, zones and past shipment addresses, by word prefix
+export interface AutocompleteSuggestion {
+  text: string;
+  kind: 'location' | 'zone' | 'address';
+  uses: number;
+}
+
+export const autocompleteApi = {
+  suggest: (query: string, limit: number = 10) =>
+    apiRequest<{ query: string; suggestions: AutocompleteSuggestion[] }>(`/api/autocomplete?q=${encodeURIComponent(query)}&limit=${limit}`),
+};
+
 // Tracking API
 export const trackingApi = {
   track: async (trackingNumber: string): Promise<TrackingResult> => {
     const response = await fetch(`${API_BASE_URL}/api/track/${trackingNumber}`, {
       method: 'GET',
+      cache: recentWrite ? 'no-cache' : 'default',
       headers: {
         'Content-Type': 'application/json',
+        ...recentWriteHeaders(),
       },
     });
     if (!response.ok) {
@@ -295,6 +389,37 @@ export const trackingHistoryApi = {
   }),
 };
 
+// GPS pings and the recorded route, simplified for a map zoom level
+export interface GpsPing {
+  lat: number;
+  lng: number;
+  progress?: number;
+  timestamp?: number;
+}
+
+export interface ShipmentRoute {
+  shipment_id: number;
+  zoom: number;
+  points: number;
+  returned: number;
+  path: [number, number][];
+  timestamps: number[];
+}
+
+export const gpsApi = {
+  ingest: (shipmentId: number, pings: GpsPing[]) => apiRequest<{
+    shipment_id: number;
+    accepted: number;
+    blocks: number;
+    first_at: number;
+    last_at: number;
+  }>(`/api/shipments/${shipmentId}/gps`, {
+    method: 'POST',
+    body: JSON.stringify({ pings }),
+  }),
+  route: (shipmentId: number, zoom: number) => apiRequest<ShipmentRoute>(`/api/shipments/${shipmentId}/route?zoom=${Math.round(zoom)}`),
+};
+
 // Shipment Progress API for cross-device persistence
 export const shipmentProgressApi = {
   get: (shipmentId: number) => apiRequest<{